@@ -1,16 +1,22 @@
 import os
 import re
+import time
+import cProfile
+import warnings
 import compass
-from util import Result,Boolean,NullFn,Int,List,ResultEncoder,JSON
+from util import Result,Boolean,NullFn,Int,List,ResultEncoder,JSON,Timings,ResultCache,STREAM_FORMATS
 import json
 from flask import Flask, request, jsonify, render_template,Response
 
 app = Flask(__name__)
 
+result_cache = ResultCache()
+
 class Opt(object):
     option_details = {
       'by_as':(Boolean, False),
       'by_country':(Boolean, False),
+      'by':( List, [] ),
       'inactive':( Boolean, False ),
       'exits_only':( Boolean, False ),
       'guards_only': ( Boolean, False),
@@ -21,7 +27,9 @@ class Opt(object):
       'family':( NullFn, "" ),
       'ases':( List, [] ),
       'country':( JSON, [] ),
-      'exit_filter':( NullFn, "all_relays" )
+      'exit_filter':( NullFn, "all_relays" ),
+      'ipv4_prefix':( Int, compass.FAST_EXIT_IPV4_PREFIX ),
+      'ipv6_prefix':( Int, compass.FAST_EXIT_IPV6_PREFIX )
     }
 
 
@@ -46,6 +54,21 @@ class Opt(object):
         else:
           setattr(self,key,Opt.default(key))
 
+    def query(self):
+      return compass.Query.from_options(self)
+
+    @staticmethod
+    def query_from_json(values):
+      """
+      Convert a query object posted as JSON into a Query, with the same
+      defaults as query parameters.
+      """
+      if not isinstance(values, dict):
+        raise ValueError("A query must be an object, not %r" % (values,))
+      fields = dict((key, Opt.default(key)) for key in Opt.option_details)
+      fields.update(values)
+      return compass.Query.from_dict(fields)
+
 def parse(output_string, grouping=False, sort_key=None):
     results = []
     sorted_results = {}
@@ -115,6 +138,43 @@ def parse(output_string, grouping=False, sort_key=None):
     return results if results else sorted_results
 
 
+def current_datafile():
+    if "TESTING_DATAFILE" in app.config and "TESTING" in app.config:
+      return app.config['TESTING_DATAFILE']
+    return "details.json"
+
+def current_snapshot():
+    shared = app.config.get('COMPASS_SHARED_SNAPSHOT', False)
+    if shared and app.config.get('COMPASS_ENGINE', 'dict') != 'numpy':
+      # Only the numpy engine reads the shared relays in place; the dict
+      # engine decodes every one of them for each query.
+      warnings.warn("COMPASS_SHARED_SNAPSHOT without COMPASS_ENGINE=numpy decodes all "
+                    "relays on every query; set COMPASS_ENGINE to numpy", RuntimeWarning)
+    return compass.get_snapshot(current_datafile(), shared=shared)
+
+def start_refresher():
+    """
+    Start refreshing the datafile in the background every
+    COMPASS_REFRESH_INTERVAL seconds from COMPASS_DETAILS_URL (Onionoo by
+    default), with only the relay fields compass uses if
+    COMPASS_USED_FIELDS_ONLY is set.  Returns the refresher, or None if no
+    interval is set.
+    """
+    interval = app.config.get('COMPASS_REFRESH_INTERVAL')
+    if not interval:
+      return None
+    structures = list(compass.SnapshotRefresher.STRUCTURES)
+    if app.config.get('COMPASS_ENGINE') == 'numpy':
+      structures.remove('aggregates')
+      structures.extend(['table', 'table_aggregates'])
+    refresher = compass.SnapshotRefresher(current_datafile(),
+                                          app.config.get('COMPASS_DETAILS_URL', compass.DETAILS_URL),
+                                          interval, structures,
+                                          compass.DETAILS_FIELDS if app.config.get('COMPASS_USED_FIELDS_ONLY') else None,
+                                          app.config.get('COMPASS_SHARED_SNAPSHOT', False))
+    refresher.start()
+    return refresher
+
 @app.route('/')
 def index():
 
@@ -122,19 +182,142 @@ def index():
 
 @app.route('/result.json', methods=['GET'])
 def json_result():
-    options = Opt(dict(request.args.items()))
+    """
+    Answer a query, reporting the time spent per stage in a
+    Server-Timing header.  Encoded results are cached per snapshot
+    version and carry an ETag, so conditional requests for an unchanged
+    result get a 304 without any work.  If PROFILE_DIR is configured,
+    requests with a "profile" parameter bypass the cache and run under
+    cProfile, with the stats written to a file in that directory.
+    Queries that cannot be understood, such as grouping by an unknown
+    key, get a 400.  Requests with a "limit" or a "cursor" parameter get
+    a page of the results, see paged_result.
+    """
+    args = dict(request.args.items())
+    if 'limit' in args or 'cursor' in args:
+      return paged_result(args)
+    try:
+      query = Opt(args).query()
+    except ValueError, e:
+      return Response(str(e), status=400, mimetype='text/plain')
+    if app.config.get('PROFILE_DIR') and 'profile' in args:
+      profile = cProfile.Profile()
+      timings = Timings()
+      output = profile.runcall(compute_result, query, current_snapshot(), timings)
+      profile.dump_stats(os.path.join(app.config['PROFILE_DIR'],
+                                      "result-%d.prof" % (time.time() * 1000000)))
+      return Response(output, mimetype='application/json',
+                      headers={'Server-Timing': timings.server_timing()})
 
-    if "TESTING_DATAFILE" in app.config and "TESTING" in app.config:
-      stats = compass.RelayStats(options,app.config['TESTING_DATAFILE'])
-    else:
-      stats = compass.RelayStats(options)
+    timings = Timings()
+    with timings.stage("load"):
+      snapshot = current_snapshot()
+    etag = ResultCache.etag(snapshot.version, query)
+    if request.if_none_match.contains(etag):
+      response = Response(status=304)
+      response.set_etag(etag)
+      return response
+
+    with timings.stage("cache") as stage:
+      output = result_cache.get(snapshot.version, query)
+      stage.detail = "miss" if output is None else "hit"
+    if output is None:
+      output = compute_result(query, snapshot, timings)
+      result_cache.put(snapshot.version, query, output)
+
+    response = Response(output, mimetype='application/json',
+                        headers={'Server-Timing': timings.server_timing()})
+    response.set_etag(etag)
+    return response
+
+def paged_result(args):
+    """
+    Answer a query with the "limit" results from "offset" (default 0) on,
+    in the order of its sort options, rather than its top results.  The
+    answer has a "next" cursor; passing it as the "cursor" parameter,
+    with no other parameters, gets the next page of the same query.
+    Cursors are only good for the snapshot they were issued against and
+    get a 410 once it has been replaced.
+    """
+    timings = Timings()
+    with timings.stage("load"):
+      snapshot = current_snapshot()
+    try:
+      if 'cursor' in args:
+        query, offset, limit = compass.decode_cursor(args['cursor'], snapshot)
+      else:
+        query = Opt(args).query()
+        offset, limit = Int(args.get('offset', 0)), Int(args['limit'])
+      output = compass.page_query(query, snapshot, offset, limit,
+                                  app.config.get('COMPASS_ENGINE', 'dict'), timings)
+    except compass.StaleCursor, e:
+      return Response(str(e), status=410, mimetype='text/plain')
+    except ValueError, e:
+      return Response(str(e), status=400, mimetype='text/plain')
+    return Response(output, mimetype='application/json',
+                    headers={'Server-Timing': timings.server_timing()})
+
+@app.route('/results.json', methods=['POST'])
+def json_results():
+    """
+    Answer a batch of queries, posted as a JSON list of objects with the
+    same fields as the parameters of result.json (but JSON values, e.g.
+    {"country": ["de"], "by_as": true}), with the list of their results.
+    Results come from and go to the cache of result.json; the missing
+    ones are computed together, sharing the work of common filters, on
+    COMPASS_BATCH_PROCESSES worker processes if that is set.
+    """
+    try:
+      queries = [Opt.query_from_json(values) for values in json.loads(request.data)]
+    except (ValueError, TypeError), e:
+      return Response(str(e), status=400, mimetype='text/plain')
 
-    results = stats.select_relays(stats.relays, options)
+    timings = Timings()
+    with timings.stage("load"):
+      snapshot = current_snapshot()
+    outputs = [result_cache.get(snapshot.version, query) for query in queries]
+    missing = [i for i, output in enumerate(outputs) if output is None]
+    with timings.stage("batch", "%d queries, %d cached" % (len(queries),
+                                                           len(queries) - len(missing))):
+      computed = compass.run_queries([queries[i] for i in missing], snapshot,
+                                     app.config.get('COMPASS_ENGINE', 'dict'), None,
+                                     app.config.get('COMPASS_BATCH_PROCESSES', 0))
+    for i, output in zip(missing, computed):
+      outputs[i] = output
+      result_cache.put(snapshot.version, queries[i], output)
+    return Response("[%s]" % ", ".join(outputs), mimetype='application/json',
+                    headers={'Server-Timing': timings.server_timing()})
 
-    relays = stats.sort_and_reduce(results,
-                                   options)
+@app.route('/result.<any(%s):output_format>' % ", ".join(STREAM_FORMATS), methods=['GET'])
+def stream_result(output_format):
+    """
+    Answer a query like result.json, but stream the results line by line
+    as newline delimited JSON (result.ndjson) or CSV (result.csv), with
+    the excluded and total lines last.  Nothing is cached, so the whole
+    network can be exported without holding its encoding in memory.
+    """
+    try:
+      query = Opt(dict(request.args.items())).query()
+    except ValueError, e:
+      return Response(str(e), status=400, mimetype='text/plain')
+    snapshot = current_snapshot()
+    etag = ResultCache.etag(snapshot.version, (output_format, query))
+    if request.if_none_match.contains(etag):
+      response = Response(status=304)
+      response.set_etag(etag)
+      return response
+    lines = compass.stream_query(query, snapshot, output_format,
+                                 app.config.get('COMPASS_ENGINE', 'dict'))
+    response = Response(lines, mimetype=STREAM_FORMATS[output_format][1])
+    response.set_etag(etag)
+    return response
 
-    return Response(json.dumps(relays, cls=ResultEncoder), mimetype='application/json')
+def compute_result(query, snapshot, timings):
+    """
+    Run query against snapshot and return the encoded result.
+    """
+    return compass.run_query(query, snapshot, app.config.get('COMPASS_ENGINE', 'dict'),
+                             timings)
 
 @app.route('/result', methods=['GET'])
 def result():
@@ -183,4 +366,11 @@ def result():
 if __name__ == '__main__':
     # Bind to PORT if defined, otherwise default to 5000.
     port = int(os.environ.get('PORT', 5000))
+    app.config['COMPASS_REFRESH_INTERVAL'] = int(os.environ.get('REFRESH_INTERVAL', 0))
+    app.config['COMPASS_DETAILS_URL'] = os.environ.get('DETAILS_URL', compass.DETAILS_URL)
+    app.config['COMPASS_USED_FIELDS_ONLY'] = bool(os.environ.get('USED_FIELDS_ONLY'))
+    app.config['COMPASS_ENGINE'] = os.environ.get('ENGINE', 'dict')
+    app.config['COMPASS_SHARED_SNAPSHOT'] = bool(os.environ.get('SHARED_SNAPSHOT'))
+    app.config['COMPASS_BATCH_PROCESSES'] = int(os.environ.get('BATCH_PROCESSES', 0))
+    start_refresher()
     app.run(host='0.0.0.0', port=port)
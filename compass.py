@@ -10,211 +10,2346 @@ FAST_EXIT_BANDWIDTH_RATE = 95 * 125 * 1024     # 95 Mbit/s
 FAST_EXIT_ADVERTISED_BANDWIDTH = 5000 * 1024   # 5000 kB/s
 FAST_EXIT_PORTS = [80, 443, 554, 1755]
 FAST_EXIT_MAX_PER_NETWORK = 2
+# Prefix lengths of the networks FAST_EXIT_MAX_PER_NETWORK applies to;
+# IPv6 addresses are not limited if FAST_EXIT_IPV6_PREFIX is 0.
+FAST_EXIT_IPV4_PREFIX = 24
+FAST_EXIT_IPV6_PREFIX = 0
 
 ALMOST_FAST_EXIT_BANDWIDTH_RATE = 80 * 125 * 1024    # 80 Mbit/s
 ALMOST_FAST_EXIT_ADVERTISED_BANDWIDTH = 2000 * 1024  # 2000 kB/s
 ALMOST_FAST_EXIT_PORTS = [80, 443]
 
+DETAILS_URL = 'https://onionoo.torproject.org/details?type=relay'
+# The relay fields compass uses, for downloading only those.
+DETAILS_FIELDS = ['nickname', 'fingerprint', 'or_addresses', 'running', 'flags', 'country',
+                  'as_number', 'as_name', 'consensus_weight_fraction',
+                  'advertised_bandwidth_fraction', 'guard_probability', 'middle_probability',
+                  'exit_probability', 'bandwidth_rate', 'advertised_bandwidth',
+                  'exit_policy_summary', 'family', 'platform', 'contact']
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Sorted results kept per snapshot for paging through them.
+ORDERINGS_CACHED = 16
+
+# Share of relays that may change between two documents for
+# RelaySnapshot.update to update structures rather than rebuild them.
+UPDATE_MAX_CHURN = 0.1
+
+import base64
+import bisect
+import httplib
 import json
+import heapq
 import operator
 import sys
 import util
 import os
 from optparse import OptionParser, OptionGroup
-import urllib
+import urllib2
 import re
 import itertools
+import threading
+import tempfile
+import zlib
+import gc
+import hashlib
+import marshal
+import math
+import mmap
+import struct
+import fcntl
+import socket
+import multiprocessing
+from contextlib import contextmanager
+from collections import namedtuple, OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class BaseFilter(object):
+    # Filters that decide on each relay by itself, independent of the
+    # other relays passed to load.  Only those can be reordered or be
+    # answered from the snapshot's indexes.
+    per_relay = True
+    # Relative cost of accept(), used to order the predicates of a fused
+    # pass.
+    cost = 1
+
     def accept(self, relay):
         raise NotImplementedError("This isn't implemented by the subclass")
 
     def load(self, relays):
         return filter(self.accept, relays)
 
+    def lookup(self, snapshot):
+        """
+        Return the snapshot rows accepted by this filter in ascending
+        order, or None if the snapshot has no index to answer it.
+        """
+        return None
+
+    def mask(self, table):
+        """
+        Return a boolean array over the rows of a RelayTable telling
+        which relays this filter accepts, or None if accept() has to be
+        used instead.
+        """
+        return None
+
+    def describe(self):
+        return type(self).__name__
+
+    @property
+    def key(self):
+        """
+        A hashable value telling filters that select the same relays
+        apart from others, so that their work can be shared between the
+        queries of a batch.
+        """
+        return type(self).__name__
+
 class RunningFilter(BaseFilter):
     def accept(self, relay):
-        return relay['running']
+        return relay.running
+
+    def lookup(self, snapshot):
+        return snapshot.index.running
+
+    def mask(self, table):
+        return table.running
 
 class FamilyFilter(BaseFilter):
-    def __init__(self, family, all_relays):
-        self._family_fingerprint = None
-        self._family_nickname = None
-        self._family_relays = []
-        found_relay = None
-        for relay in all_relays:
-            if len(family) == 40 and relay['fingerprint'] == family:
-                found_relay = relay
-                break
-            if len(family) < 20 and 'Named' in relay['flags'] and relay['nickname'] == family:
-                found_relay = relay
-                break
-        if found_relay:
-            self._family_fingerprint = '$%s' % found_relay['fingerprint']
-            if 'Named' in found_relay['flags']:
-                self._family_nickname = found_relay['nickname']
-            self._family_relays = [self._family_fingerprint] + found_relay.get('family', [])
+    def __init__(self, family, snapshot):
+        self._family_rows = snapshot.family_graph.member_rows(family)
+        self._family_fingerprints = set(snapshot.relays[row].fingerprint
+                                        for row in self._family_rows)
 
     def accept(self, relay):
-        fingerprint = '$%s' % relay['fingerprint']
-        mentions = [fingerprint] + relay.get('family', [])
-        # Only show families as accepted by consensus (mutually listed relays)
-        listed = fingerprint in self._family_relays
-        listed = listed or 'Named' in relay['flags'] and relay['nickname'] in self._family_relays
-        mentioned = self._family_fingerprint in mentions
-        mentioned = mentioned or self._family_nickname in mentions
-        if listed and mentioned:
-            return True
-        return False
+        return relay.fingerprint in self._family_fingerprints
+
+    @property
+    def key(self):
+        return (type(self).__name__, tuple(self._family_rows))
+
+    def lookup(self, snapshot):
+        return self._family_rows
+
+    def mask(self, table):
+        return table.row_mask(self._family_rows)
 
 class CountryFilter(BaseFilter):
+    cost = 2
+
     def __init__(self, countries=[]):
         self._countries = [x.lower() for x in countries]
 
+    @property
+    def key(self):
+        return (type(self).__name__, tuple(sorted(set(self._countries))))
+
     def accept(self, relay):
-        return relay.get('country', None) in self._countries
+        return getattr(relay, 'country', None) in self._countries
+
+    def lookup(self, snapshot):
+        return snapshot.index.union('country', self._countries)
+
+    def mask(self, table):
+        return table.isin('country', self._countries)
 
 class ASFilter(BaseFilter):
+    cost = 2
+
     def __init__(self, as_sets=[]):
         self._as_sets = [x if not x.isdigit() else "AS" + x for x in as_sets]
 
+    @property
+    def key(self):
+        return (type(self).__name__, tuple(sorted(set(self._as_sets))))
+
     def accept(self, relay):
-        return relay.get('as_number', None) in self._as_sets
+        return getattr(relay, 'as_number', None) in self._as_sets
+
+    def lookup(self, snapshot):
+        return snapshot.index.union('as_number', self._as_sets)
+
+    def mask(self, table):
+        return table.isin('as_number', self._as_sets)
 
 class ExitFilter(BaseFilter):
     def accept(self, relay):
-        return relay.get('exit_probability', -1) > 0.0
+        return getattr(relay, 'exit_probability', -1) > 0.0
+
+    def lookup(self, snapshot):
+        return snapshot.index.exit
+
+    def mask(self, table):
+        return table.weights['exit_probability'] > 0.0
 
 class GuardFilter(BaseFilter):
     def accept(self, relay):
-        return relay.get('guard_probability', -1) > 0.0
+        return getattr(relay, 'guard_probability', -1) > 0.0
+
+    def lookup(self, snapshot):
+        return snapshot.index.guard
+
+    def mask(self, table):
+        return table.weights['guard_probability'] > 0.0
+
+def port_ranges(portlist):
+    """
+    Parse a list of ports and port ranges as found in exit policy
+    summaries ("80", "1000-2000") into a tuple of sorted, merged
+    (first, last) ranges.
+    """
+    ranges = []
+    for p in portlist:
+        if '-' in p:
+            first, last = p.split('-', 1)
+            ranges.append((int(first), int(last)))
+        else:
+            ranges.append((int(p), int(p)))
+    ranges.sort()
+    merged = []
+    for first, last in ranges:
+        if merged and first <= merged[-1][1] + 1:
+            if last > merged[-1][1]:
+                merged[-1] = (merged[-1][0], last)
+        else:
+            merged.append((first, last))
+    return tuple(merged)
+
+def ranges_subset(ranges, other):
+    """
+    Return True if every port in ranges is also in other.  Both must be
+    merged range tuples as returned by port_ranges.
+    """
+    j = 0
+    for first, last in ranges:
+        while j < len(other) and other[j][1] < first:
+            j += 1
+        if j == len(other) or other[j][0] > first or other[j][1] < last:
+            return False
+    return True
+
+def ranges_disjoint(ranges, other):
+    """
+    Return True if ranges and other have no port in common.
+    """
+    i, j = 0, 0
+    while i < len(ranges) and j < len(other):
+        if ranges[i][1] < other[j][0]:
+            i += 1
+        elif other[j][1] < ranges[i][0]:
+            j += 1
+        else:
+            return False
+    return True
+
+class ExitPolicy(object):
+    """
+    A relay's exit policy summary, kept as port ranges instead of
+    expanded port lists.
+    """
+    __slots__ = ('accept', 'ranges')
+
+    def __init__(self, accept, ranges):
+        self.accept = accept
+        self.ranges = ranges
+
+    @classmethod
+    def from_summary(cls, summary):
+        if 'accept' in summary:
+            return cls(True, port_ranges(summary['accept']))
+        elif 'reject' in summary:
+            return cls(False, port_ranges(summary['reject']))
+        return None
+
+    def allows_all(self, ranges):
+        """
+        Return True if exiting to every port in ranges is allowed.
+        """
+        if self.accept:
+            return ranges_subset(ranges, self.ranges)
+        return ranges_disjoint(ranges, self.ranges)
 
 class FastExitFilter(BaseFilter):
+    cost = 5
+
     class Relay(object):
         def __init__(self, relay):
-            self.exit = relay.get('exit_probability')
-            self.fp = relay.get('fingerprint')
+            self.exit = getattr(relay, 'exit_probability', None)
+            self.fp = relay.fingerprint
             self.relay = relay
 
     def __init__(self, bandwidth_rate=FAST_EXIT_BANDWIDTH_RATE,
                  advertised_bandwidth=FAST_EXIT_ADVERTISED_BANDWIDTH,
-                 ports=FAST_EXIT_PORTS):
+                 ports=FAST_EXIT_PORTS, snapshot=None):
         self.bandwidth_rate = bandwidth_rate
         self.advertised_bandwidth = advertised_bandwidth
         self.ports = ports
+        self._port_ranges = port_ranges(map(str, ports))
+        self._snapshot = snapshot
 
-    def load(self, all_relays):
-        # First, filter relays based on bandwidth and port requirements.
-        matching_relays = []
-        for relay in all_relays:
-            if relay.get('bandwidth_rate', -1) < self.bandwidth_rate:
-                continue
-            if relay.get('advertised_bandwidth', -1) < self.advertised_bandwidth:
-                continue
-            relevant_ports = set(self.ports)
-            summary = relay.get('exit_policy_summary', {})
-            if 'accept' in summary:
-                portlist = summary['accept']
-            elif 'reject' in summary:
-                portlist = summary['reject']
-            else:
-                continue
-            ports = []
-            for p in portlist:
-                if '-' in p:
-                    ports.extend(range(int(p.split('-')[0]),
-                                       int(p.split('-')[1]) + 1))
-                else:
-                    ports.append(int(p))
-            policy_ports = set(ports)
-            if 'accept' in summary and not relevant_ports.issubset(policy_ports):
-                continue
-            if 'reject' in summary and not relevant_ports.isdisjoint(policy_ports):
-                continue
-            matching_relays.append(relay)
-        return matching_relays
+    @property
+    def key(self):
+        return (type(self).__name__, self.bandwidth_rate, self.advertised_bandwidth,
+                tuple(self.ports))
+
+    def _exit_policy(self, relay):
+        if self._snapshot is not None:
+            return self._snapshot.exit_policy(relay)
+        return ExitPolicy.from_summary(getattr(relay, 'exit_policy_summary', {}))
+
+    def accept(self, relay):
+        # Filter relays based on bandwidth and port requirements.
+        if getattr(relay, 'bandwidth_rate', -1) < self.bandwidth_rate:
+            return False
+        if getattr(relay, 'advertised_bandwidth', -1) < self.advertised_bandwidth:
+            return False
+        policy = self._exit_policy(relay)
+        return policy is not None and policy.allows_all(self._port_ranges)
+
+    def mask(self, table):
+        allowed = numpy.array([policy is not None and policy.allows_all(self._port_ranges)
+                               for policy in table.policies], dtype=bool)
+        return ((table.bandwidth_rate >= self.bandwidth_rate) &
+                (table.advertised_bandwidth >= self.advertised_bandwidth) &
+                allowed[table.codes['exit_policy']])
 
 class SameNetworkFilter(BaseFilter):
-    def __init__(self, orig_filter, max_per_network=FAST_EXIT_MAX_PER_NETWORK):
+    """
+    Keep at most max_per_network of the relays orig_filter selects per
+    network, preferring those with the highest exit probability.  A
+    relay only displaces one with a lower exit probability, the first
+    of the lowest if there are several.  Networks are the IPv4
+    /ipv4_prefix and, unless ipv6_prefix is 0, the IPv6 /ipv6_prefix
+    prefixes of the relays' OR addresses.  A relay with addresses in
+    several networks is only kept if it is kept in each of them;
+    otherwise it is left out and the networks are filled again without
+    it, so that no network is left under its limit because of it.
+    """
+    per_relay = False
+
+    def __init__(self, orig_filter, max_per_network=FAST_EXIT_MAX_PER_NETWORK,
+                 ipv4_prefix=FAST_EXIT_IPV4_PREFIX, ipv6_prefix=FAST_EXIT_IPV6_PREFIX):
         self.orig_filter = orig_filter
         self.max_per_network = max_per_network
+        self.ipv4_prefix = ipv4_prefix
+        self.ipv6_prefix = ipv6_prefix
+
+    def describe(self):
+        return "%s(%s)" % (type(self).__name__, self.orig_filter.describe())
+
+    @property
+    def key(self):
+        return (type(self).__name__, self.orig_filter.key, self.max_per_network,
+                self.ipv4_prefix, self.ipv6_prefix)
+
+    def _networks(self, relay):
+        networks = set(or_address_network(or_address, self.ipv4_prefix, self.ipv6_prefix)
+                       for or_address in getattr(relay, 'or_addresses', ()))
+        networks.discard(None)
+        return networks
 
     def load(self, all_relays):
-        network_data = {}
-        for relay in self.orig_filter.load(all_relays):
-            or_addresses = relay.get("or_addresses")
-            no_of_addresses = 0
-            for ip in or_addresses:
-                ip, port = ip.rsplit(':', 1)
-                # skip if ipv6
-                if ':' in ip:
-                    continue
-                no_of_addresses += 1
-                if no_of_addresses > 1:
-                    print "[WARNING] - %s has more than one IPv4 OR address - %s" % relay.get("fingerprint"), or_addresses
-                network = ip.rsplit('.', 1)[0]
-                if network_data.has_key(network):
-                    if len(network_data[network]) >= FAST_EXIT_MAX_PER_NETWORK:
-                        # assume current relay to have smallest exit_probability
-                        min_exit = relay.get('exit_probability')
-                        min_id = -1
-                        for id, value in enumerate(network_data[network]):
-                            if value.get('exit_probability') < min_exit:
-                                min_exit = value.get('exit_probability')
-                                min_id = id
-                        if min_id != -1:
-                            del network_data[network][min_id]
-                            network_data[network].append(relay)
-                    else:
-                        network_data[network].append(relay)
-                else:
-                    network_data[network] = [relay]
-        return list(itertools.chain.from_iterable(network_data.values()))
+        relays = self.orig_filter.load(all_relays)
+        relay_networks = [self._networks(relay) for relay in relays]
+        candidates = [position for position, networks in enumerate(relay_networks) if networks]
+        while True:
+            # The relays kept so far per network as a min-heap of (exit
+            # probability, position), so the one to give way is at the top.
+            heaps = {}
+            for position in candidates:
+                entry = (getattr(relays[position], 'exit_probability', None), position)
+                for network in relay_networks[position]:
+                    heap = heaps.setdefault(network, [])
+                    if len(heap) < self.max_per_network:
+                        heapq.heappush(heap, entry)
+                    elif heap and entry[0] > heap[0][0]:
+                        heapq.heapreplace(heap, entry)
+            kept_in = {}
+            for heap in heaps.itervalues():
+                for _, position in heap:
+                    kept_in[position] = kept_in.get(position, 0) + 1
+            # Relays that are kept in some of their networks but not in all
+            # are dropped, and give up their places for the others.
+            dropped = set(position for position, count in kept_in.iteritems()
+                          if count < len(relay_networks[position]))
+            if not dropped:
+                return [relays[position] for position in candidates if position in kept_in]
+            candidates = [position for position in candidates if position not in dropped]
 
 class InverseFilter(BaseFilter):
+    per_relay = False
+
     def __init__(self, orig_filter):
         self.orig_filter = orig_filter
 
+    def describe(self):
+        return "%s(%s)" % (type(self).__name__, self.orig_filter.describe())
+
+    @property
+    def key(self):
+        return (type(self).__name__, self.orig_filter.key)
+
     def load(self, all_relays):
-        matching_relays = self.orig_filter.load(all_relays)
-        inverse_relays = []
-        for relay in all_relays:
-            if relay not in matching_relays:
-                inverse_relays.append(relay)
-        return inverse_relays
+        matching = set(relay.fingerprint for relay in self.orig_filter.load(all_relays))
+        return [relay for relay in all_relays if relay.fingerprint not in matching]
+
+def _family_names(relay):
+    """
+    Return the names other relays can use to list relay in their family.
+    """
+    names = ['$%s' % relay.fingerprint]
+    if 'Named' in relay.flags:
+        names.append(relay.nickname)
+    return names
+
+class FamilyGraph(object):
+    """
+    The mutual family relation of a set of relays.  Two relays are in the
+    same family only if each lists the other, either by fingerprint or,
+    for relays with the Named flag, by nickname.
+    """
+    def __init__(self, relays):
+        self._relays = relays
+        self._labels = None
+        self._by_fingerprint = {}
+        self._by_nickname = {}
+        self._listed_as = listed_as = {}
+        for row, relay in enumerate(relays):
+            self._by_fingerprint.setdefault(relay.fingerprint, row)
+            if 'Named' in relay.flags:
+                self._by_nickname.setdefault(relay.nickname, row)
+            for name in _family_names(relay):
+                listed_as.setdefault(name, []).append(row)
+
+        # Rows of the relays sharing a family with each relay (itself
+        # included), in document order.
+        self._members = [self._member_rows(row, listed_as) for row in xrange(len(relays))]
+
+    def _member_rows(self, row, listed_as):
+        relays = self._relays
+        relay = relays[row]
+        names = set(_family_names(relay))
+        members = set([row])
+        for name in getattr(relay, 'family', []):
+            for other in listed_as.get(name, []):
+                if names.intersection(getattr(relays[other], 'family', ())):
+                    members.add(other)
+        return sorted(members)
+
+    def state(self):
+        """
+        Return the graph as plain containers, for SnapshotCache.
+        """
+        return (self._by_fingerprint, self._by_nickname, self._members)
+
+    @classmethod
+    def from_state(cls, relays, state):
+        graph = cls.__new__(cls)
+        graph._relays = relays
+        graph._labels = None
+        graph._listed_as = None
+        graph._by_fingerprint, graph._by_nickname, graph._members = state
+        return graph
+
+    def updated(self, relays, moved, removed, added):
+        """
+        Return the graph of relays, which differ from this graph's relays
+        by removed and added (row, relay) pairs and in that the remaining
+        rows are moved (see RelayIndex.updated).  Only the families of the
+        removed and added relays are worked out again.
+        """
+        def move(rows):
+            return [moved[row] for row in rows if moved[row] is not None]
+        listed_as = self._listed_as
+        if listed_as is None:
+            listed_as = {}
+            for row, relay in enumerate(self._relays):
+                for name in _family_names(relay):
+                    listed_as.setdefault(name, []).append(row)
+        listed_as = dict((name, move(rows)) for name, rows in listed_as.iteritems())
+        for row, relay in added:
+            for name in _family_names(relay):
+                bisect.insort(listed_as.setdefault(name, []), row)
+
+        graph = FamilyGraph.__new__(FamilyGraph)
+        graph._relays = relays
+        graph._labels = None
+        graph._listed_as = {}
+        graph._by_fingerprint = {}
+        graph._by_nickname = {}
+        for name, rows in listed_as.iteritems():
+            if not rows:
+                continue
+            graph._listed_as[name] = rows
+            if name.startswith('$'):
+                graph._by_fingerprint[name[1:]] = rows[0]
+            else:
+                graph._by_nickname[name] = rows[0]
+
+        graph._members = members = [None] * len(relays)
+        for row, rows in enumerate(self._members):
+            if moved[row] is not None:
+                members[moved[row]] = move(rows)
+        affected = set()
+        for row, _ in removed:
+            affected.update(move(self._members[row]))
+        for row, _ in added:
+            members[row] = graph._member_rows(row, graph._listed_as)
+            affected.update(members[row])
+        for row in affected:
+            members[row] = graph._member_rows(row, graph._listed_as)
+        return graph
+
+    def find(self, family):
+        """
+        Return the row of the relay with fingerprint family or, for names
+        shorter than 20 characters, of the Named relay with that nickname.
+        """
+        if len(family) == 40:
+            return self._by_fingerprint.get(family)
+        if len(family) < 20:
+            return self._by_nickname.get(family)
+        return None
+
+    def member_rows(self, family):
+        """
+        Return the rows of the relay identified by family and of all
+        relays that are mutually listed with it, or an empty list if there
+        is no such relay.
+        """
+        row = self.find(family)
+        if row is None:
+            return []
+        return self._members[row]
+
+    def members(self, family):
+        return [self._relays[row] for row in self.member_rows(family)]
+
+    def components(self):
+        """
+        Return the rows of the relays connected through mutual family
+        declarations as sorted lists, one per component (single relays
+        included), ordered by their first row.
+        """
+        seen = set()
+        components = []
+        for row in xrange(len(self._members)):
+            if row in seen:
+                continue
+            component = []
+            pending = [row]
+            seen.add(row)
+            while pending:
+                current = pending.pop()
+                component.append(current)
+                for other in self._members[current]:
+                    if other not in seen:
+                        seen.add(other)
+                        pending.append(other)
+            components.append(sorted(component))
+        return components
+
+    def family_labels(self):
+        """
+        Return a list with the fingerprint of the first relay of each
+        relay's component, by row, for grouping relays by family.
+        """
+        if self._labels is None:
+            labels = [None] * len(self._members)
+            for component in self.components():
+                label = self._relays[component[0]].fingerprint
+                for row in component:
+                    labels[row] = label
+            self._labels = labels
+        return self._labels
+
+    def families(self):
+        """
+        Return all families of two or more relays as lists of relays,
+        joining relays that are connected through mutual family
+        declarations.  Families are ordered by their summed consensus
+        weight fraction, largest first.
+        """
+        families = [[self._relays[row] for row in component]
+                    for component in self.components() if len(component) > 1]
+        families.sort(key=family_weight, reverse=True)
+        return families
+
+# The text that completes the leading octets of an IPv4 /8, /16 or /24
+# network.
+IPV4_NETWORK_SUFFIXES = {8: '.0.0.0/8', 16: '.0.0/16', 24: '.0/24'}
+
+def or_address_network(or_address, ipv4_prefix=24, ipv6_prefix=0):
+    """
+    Return the network of an OR address as its leading ipv4_prefix or
+    ipv6_prefix bits, e.g. "1.2.3.0/24" or "2001:db8::/32", or None for
+    IPv6 addresses if ipv6_prefix is 0 and for malformed addresses.
+    """
+    ip = or_address.rsplit(':', 1)[0]
+    if ip.startswith('['):
+        if not ipv6_prefix:
+            return None
+        family, ip, prefix = socket.AF_INET6, ip[1:-1], ipv6_prefix
+    else:
+        family, prefix = socket.AF_INET, ipv4_prefix
+        if prefix in IPV4_NETWORK_SUFFIXES and ip.count('.') == 3 and ip.replace('.', '').isdigit():
+            # The common /8, /16 and /24 networks can be cut out as text.
+            return ip.rsplit('.', 4 - prefix // 8)[0] + IPV4_NETWORK_SUFFIXES[prefix]
+    try:
+        packed = socket.inet_pton(family, ip)
+    except (socket.error, ValueError):
+        return None
+    octets, bits = divmod(prefix, 8)
+    network = packed[:octets]
+    if bits:
+        network += chr(ord(packed[octets]) & (0xff << (8 - bits)) & 0xff)
+    network += '\0' * (len(packed) - len(network))
+    return "%s/%d" % (socket.inet_ntop(family, network), prefix)
+
+def first_ipv4_network(relay, prefix):
+    """
+    Return the /prefix network of the first IPv4 OR address of relay,
+    or None if it has none.
+    """
+    for or_address in getattr(relay, 'or_addresses', ()):
+        network = or_address_network(or_address, prefix)
+        if network is not None:
+            return network
+    return None
+
+PLATFORM_RE = re.compile(r'^Tor (\S+)(?: \([^)]*\))?(?: on (.+))?$')
+
+def parse_platform(platform):
+    """
+    Split a platform line like "Tor 0.2.2.39 (git-bec76476efb71549) on
+    Linux x86_64" into the Tor version and the operating system, either
+    of which may be None.
+    """
+    match = PLATFORM_RE.match(platform or '')
+    if match is None:
+        return None, None
+    return match.groups()
+
+# The keys relays can be grouped by, in the order their values make up
+# the key of a group, with the plural naming their groups.
+GROUP_KEYS = [('country', 'countries'), ('as', 'ASes'), ('network16', '/16 networks'),
+              ('network24', '/24 networks'), ('platform', 'platforms'),
+              ('version', 'Tor versions'), ('family', 'families'),
+              ('flags', 'flag combinations'), ('contact', 'contacts')]
+GROUP_KEY_NAMES = [name for name, _ in GROUP_KEYS]
+
+def group_key_function(name, snapshot):
+    """
+    Return the RelayTable column for the group key name and the function
+    mapping the relays of snapshot to their value of it.  Values that
+    are shared between relays are only worked out once.
+    """
+    if name == 'country':
+        return 'country', lambda relay: getattr(relay, 'country', None)
+    if name == 'as':
+        return 'as_number', lambda relay: getattr(relay, 'as_number', None)
+    if name == 'network16':
+        return name, lambda relay: first_ipv4_network(relay, 16)
+    if name == 'network24':
+        return name, lambda relay: first_ipv4_network(relay, 24)
+    if name in ('version', 'platform'):
+        part = 0 if name == 'version' else 1
+        parsed = {}
+        def platform(relay):
+            line = getattr(relay, 'platform', None)
+            if line not in parsed:
+                parsed[line] = parse_platform(line)[part]
+            return parsed[line]
+        return name, platform
+    if name == 'family':
+        graph = snapshot.family_graph
+        labels = graph.family_labels()
+        return name, lambda relay: labels[graph.find(relay.fingerprint)]
+    if name == 'flags':
+        combinations = {}
+        def flags(relay):
+            if relay.flags not in combinations:
+                combinations[relay.flags] = " ".join(sorted(set(relay.flags)))
+            return combinations[relay.flags]
+        return name, flags
+    if name == 'contact':
+        return name, lambda relay: getattr(relay, 'contact', None)
+    raise ValueError("Unknown group key: %s" % name)
+
+class RelayIndex(object):
+    """
+    Inverted indexes from relay attributes to the snapshot rows having
+    them.  All postings are tuples of row numbers in ascending order.
+    """
+    EMPTY = ()
+
+    def __init__(self, relays):
+        self._postings = {'country': {}, 'as_number': {}, 'flag': {}}
+        running, exit, guard = [], [], []
+        for row, relay in enumerate(relays):
+            self._add('country', getattr(relay, 'country', None), row)
+            self._add('as_number', getattr(relay, 'as_number', None), row)
+            for flag in set(relay.flags):
+                self._add('flag', flag, row)
+            if relay.running:
+                running.append(row)
+            if getattr(relay, 'exit_probability', -1) > 0.0:
+                exit.append(row)
+            if getattr(relay, 'guard_probability', -1) > 0.0:
+                guard.append(row)
+        for postings in self._postings.itervalues():
+            for key in postings:
+                postings[key] = tuple(postings[key])
+        self.running = tuple(running)
+        self.exit = tuple(exit)
+        self.guard = tuple(guard)
+
+    def _add(self, attribute, key, row):
+        self._postings[attribute].setdefault(key, []).append(row)
+
+    @staticmethod
+    def _entries(relay):
+        """
+        Return the (attribute, key) pairs of the postings that list
+        relay, with the running, exit and guard lists as attributes of
+        their own.
+        """
+        entries = set([('country', getattr(relay, 'country', None)),
+                       ('as_number', getattr(relay, 'as_number', None))])
+        entries.update(('flag', flag) for flag in relay.flags)
+        if relay.running:
+            entries.add(('running', None))
+        if getattr(relay, 'exit_probability', -1) > 0.0:
+            entries.add(('exit', None))
+        if getattr(relay, 'guard_probability', -1) > 0.0:
+            entries.add(('guard', None))
+        return entries
+
+    def updated(self, moved, added):
+        """
+        Return the index of relays that differ from the indexed ones in
+        that the relay in each row is moved to row moved[row] or dropped
+        if that is None, and (row, relay) pairs of added relays are
+        inserted.  Rows must keep their order when moved.  Only the
+        postings of the added relays are sorted again.
+        """
+        def move(rows):
+            return tuple(moved[row] for row in rows if moved[row] is not None)
+        index = RelayIndex.__new__(RelayIndex)
+        index._postings = {}
+        for attribute, postings in self._postings.iteritems():
+            postings = dict((key, move(rows)) for key, rows in postings.iteritems())
+            index._postings[attribute] = dict((key, rows) for key, rows in postings.iteritems()
+                                              if rows)
+        lists = {'running': move(self.running), 'exit': move(self.exit),
+                 'guard': move(self.guard)}
+        inserted = {}
+        for row, relay in added:
+            for entry in RelayIndex._entries(relay):
+                inserted.setdefault(entry, []).append(row)
+        for (attribute, key), rows in inserted.iteritems():
+            if attribute in lists:
+                lists[attribute] = tuple(sorted(lists[attribute] + tuple(rows)))
+            else:
+                postings = index._postings[attribute]
+                postings[key] = tuple(sorted(postings.get(key, RelayIndex.EMPTY) + tuple(rows)))
+        index.running, index.exit, index.guard = lists['running'], lists['exit'], lists['guard']
+        return index
+
+    def state(self):
+        """
+        Return the index as plain containers, for SnapshotCache.
+        """
+        return (self._postings, self.running, self.exit, self.guard)
+
+    @classmethod
+    def from_state(cls, state):
+        index = cls.__new__(cls)
+        index._postings, index.running, index.exit, index.guard = state
+        return index
+
+    def get(self, attribute, key):
+        """
+        Return the rows of relays whose attribute (one of 'country',
+        'as_number' or 'flag') is key.
+        """
+        return self._postings[attribute].get(key, RelayIndex.EMPTY)
+
+    def union(self, attribute, keys):
+        rows = set()
+        for key in keys:
+            rows.update(self.get(attribute, key))
+        return sorted(rows)
+
+def family_weight(relays):
+    return sum(getattr(relay, 'consensus_weight_fraction', 0) for relay in relays)
+
+def _select(relays, accepts):
+    for relay in relays:
+        for accept in accepts:
+            if not accept(relay):
+                break
+        else:
+            yield relay
+
+EXIT_BIT = 1
+GUARD_BIT = 2
+
+def _position_mask(flags):
+    """
+    Return the EXIT_BIT and GUARD_BIT of a relay with flags.
+    """
+    mask = 0
+    if 'Exit' in flags and 'BadExit' not in flags:
+        mask |= EXIT_BIT
+    if 'Guard' in flags:
+        mask |= GUARD_BIT
+    return mask
+
+def _encode(values):
+    """
+    Dictionary-encode values.  Return an array of integer codes and the
+    list of distinct values, indexed by code.
+    """
+    codes = {}
+    encoded = [codes.setdefault(value, len(codes)) for value in values]
+    vocabulary = [None] * len(codes)
+    for value, code in codes.iteritems():
+        vocabulary[code] = value
+    return numpy.array(encoded, dtype=numpy.int64), vocabulary
+
+class RelayTable(object):
+    """
+    A columnar copy of a snapshot's relays backed by NumPy arrays, used
+    by the numpy engine.  Filters turn into boolean masks over its rows
+    and grouped sums into bincounts.  String attributes are stored as
+    integer codes into a per-column vocabulary and flags as a bitmask.
+    """
+    CODED_COLUMNS = ['fingerprint', 'country', 'as_number']
+    ARRAYS = ['bandwidth_rate', 'advertised_bandwidth', 'running', 'flags', 'is_exit',
+              'is_guard']
+
+    def __init__(self, snapshot):
+        relays = snapshot.relays
+        self.relays = relays
+        self.size = len(relays)
+        self.weights = {}
+        for weight in RelayStats.WEIGHTS:
+            self.weights[weight] = numpy.array([getattr(relay, weight, 0) for relay in relays],
+                                               dtype=numpy.float64)
+        self.bandwidth_rate = numpy.array([getattr(relay, 'bandwidth_rate', -1)
+                                           for relay in relays], dtype=numpy.int64)
+        self.advertised_bandwidth = numpy.array([getattr(relay, 'advertised_bandwidth', -1)
+                                                 for relay in relays], dtype=numpy.int64)
+        self.running = numpy.array([bool(relay.running) for relay in relays], dtype=bool)
+
+        self.codes = {}
+        self.vocabulary = {}
+        for column in RelayTable.CODED_COLUMNS:
+            self.codes[column], self.vocabulary[column] = _encode(
+                getattr(relay, column, None) for relay in relays)
+        self.codes['as_info'], self.vocabulary['as_info'] = _encode(
+            "%s %s" % (getattr(relay, 'as_number', '??'), getattr(relay, 'as_name', '??'))
+            for relay in relays)
+        # ExitPolicy objects are shared between identical summaries, so
+        # encode them by identity.
+        policies = [snapshot.exit_policy(relay) for relay in relays]
+        self.codes['exit_policy'], policy_ids = _encode(id(policy) for policy in policies)
+        by_id = dict((id(policy), policy) for policy in policies)
+        self.policies = [by_id[policy_id] for policy_id in policy_ids]
+
+        flag_names = sorted(set(flag for relay in relays for flag in relay.flags))
+        if len(flag_names) > 64:
+            raise ValueError("Too many distinct flags for a 64 bit flag mask")
+        self.flag_bits = dict((flag, 1 << bit) for bit, flag in enumerate(flag_names))
+        self.flags = numpy.array([sum(self.flag_bits[flag] for flag in set(relay.flags))
+                                  for relay in relays], dtype=numpy.uint64)
+        self.is_exit = self.has_flag('Exit') & ~self.has_flag('BadExit')
+        self.is_guard = self.has_flag('Guard')
+
+    def has_flag(self, flag):
+        bit = numpy.uint64(self.flag_bits.get(flag, 0))
+        return (self.flags & bit) != 0
+
+    def state(self):
+        """
+        Return the table as plain containers and a dict of its arrays by
+        name, for SnapshotCache.
+        """
+        arrays = dict((name, getattr(self, name)) for name in RelayTable.ARRAYS)
+        for weight, array in self.weights.iteritems():
+            arrays['weights.' + weight] = array
+        for column, array in self.codes.iteritems():
+            arrays['codes.' + column] = array
+        policies = [policy and (policy.accept, policy.ranges) for policy in self.policies]
+        return ({'size': self.size, 'vocabulary': self.vocabulary, 'policies': policies,
+                 'flag_bits': self.flag_bits}, arrays)
+
+    @classmethod
+    def from_state(cls, relays, state, arrays):
+        table = cls.__new__(cls)
+        table.relays = relays
+        table.size = state['size']
+        table.vocabulary = state['vocabulary']
+        table.policies = [policy and ExitPolicy(*policy) for policy in state['policies']]
+        table.flag_bits = state['flag_bits']
+        table.weights = {}
+        table.codes = {}
+        for name, array in arrays.iteritems():
+            if name.startswith('weights.'):
+                table.weights[name[len('weights.'):]] = array
+            elif name.startswith('codes.'):
+                table.codes[name[len('codes.'):]] = array
+            else:
+                setattr(table, name, array)
+        return table
+
+    def row_mask(self, rows):
+        mask = numpy.zeros(self.size, dtype=bool)
+        mask[list(rows)] = True
+        return mask
+
+    def isin(self, column, values):
+        """
+        Return a mask of the rows whose column is one of values.
+        """
+        vocabulary = self.vocabulary[column]
+        codes = [code for code, value in enumerate(vocabulary) if value in values]
+        return numpy.in1d(self.codes[column], codes)
+
+    def add_column(self, column, extract):
+        """
+        Dictionary-encode the value extract returns for each relay as
+        column, unless the table has that column already.  Return column.
+        """
+        if column not in self.codes:
+            codes, vocabulary = _encode(extract(relay) for relay in self.relays)
+            self.vocabulary[column] = vocabulary
+            self.codes[column] = codes
+        return column
+
+    def group_codes(self, columns):
+        """
+        Return an array of integer group keys for grouping by columns.
+        """
+        codes = self.codes[columns[0]]
+        for column in columns[1:]:
+            codes = codes * len(self.vocabulary[column]) + self.codes[column]
+        return codes
+
+    def group_key(self, columns, code):
+        """
+        Turn a code returned by group_codes back into the group key the
+        dict engine uses: a column value or a tuple of them.
+        """
+        key = []
+        for column in reversed(columns):
+            code, value_code = divmod(code, len(self.vocabulary[column]))
+            key.append(self.vocabulary[column][value_code])
+        if len(key) == 1:
+            return key[0]
+        return tuple(reversed(key))
+
+class GroupedRows(object):
+    """
+    The rows of a RelayTable selected by a query, in selection order,
+    together with the group each of them belongs to.
+    """
+    def __init__(self, table, rows, group_columns):
+        self.table = table
+        self.rows = rows
+        codes = table.group_codes(group_columns)[rows]
+        unique, first, self.groups = numpy.unique(codes, return_index=True,
+                                                  return_inverse=True)
+        # Insert the group keys into a dict in the order the dict engine
+        # first sees them, so that groups are visited in the same order.
+        ordered = {}
+        for group in numpy.argsort(first, kind='mergesort'):
+            ordered[table.group_key(group_columns, int(unique[group]))] = group
+        self.order = list(ordered.itervalues())
+
+    def __len__(self):
+        return len(self.order)
+
+def _memoized(memo, key, compute):
+    """
+    Return memo[key], calling compute for it if it is missing, or just
+    call compute if there is no memo.
+    """
+    if memo is None:
+        return compute()
+    if key not in memo:
+        memo[key] = compute()
+    return memo[key]
+
+class QueryPlan(object):
+    """
+    A compiled selection.  The leading per-relay filters are answered
+    from the snapshot's indexes where possible; the rest of them are
+    fused into a single pass over the candidate relays, cheapest first,
+    which also groups the selected relays.  Only set-level filters
+    (those with per_relay = False) get a materialized list of relays.
+    Relays are grouped by group, and by the table columns of group_keys,
+    (column, function) pairs as returned by group_key_function, for the
+    numpy engine.
+
+    Plans can share work through a memo dict: index lookups, masks and
+    selections are then keyed by the filters they come from, so that
+    queries of a batch with common filters only compute them once.
+    """
+    def __init__(self, filters, group, group_keys):
+        self._group = group
+        self._group_keys = group_keys
+        self._key = tuple(f.key for f in filters)
+        self._per_relay = []
+        self._set_level = []
+        for i, f in enumerate(filters):
+            if not f.per_relay:
+                self._set_level = filters[i:]
+                break
+            self._per_relay.append(f)
+
+    def _candidates(self, snapshot, timings, memo):
+        """
+        Return the relays selected by indexed filters, in document
+        order, and the per-relay filters still to be applied to them.
+        """
+        postings = []
+        predicates = []
+        for f in self._per_relay:
+            with timings.stage("lookup", f.describe()) as stage:
+                rows = _memoized(memo, ('lookup', f.key), lambda: f.lookup(snapshot))
+                if rows is not None:
+                    stage.rows = len(rows)
+            if rows is None:
+                predicates.append(f)
+            else:
+                postings.append(rows)
+        predicates.sort(key=lambda f: f.cost)
+        if not postings:
+            return snapshot.relays, predicates
+        postings.sort(key=len)
+        rows = postings[0]
+        if len(postings) > 1:
+            rows = set(rows)
+            for posting in postings[1:]:
+                rows.intersection_update(posting)
+            rows = sorted(rows)
+        relays = snapshot.relays
+        return [relays[row] for row in rows], predicates
+
+    def _scan(self, relays, predicates):
+        if len(predicates) == 1:
+            return itertools.ifilter(predicates[0].accept, relays)
+        elif predicates:
+            return _select(relays, [f.accept for f in predicates])
+        return relays
+
+    def _group_relays(self, relays):
+        grouped = {}
+        group = self._group
+        for relay in relays:
+            key = group(relay)
+            if key in grouped:
+                grouped[key].append(relay)
+            else:
+                grouped[key] = [relay]
+        return grouped
+
+    def _filter_relays(self, snapshot, timings, memo):
+        """
+        Return the list of the relays of snapshot that pass all filters.
+        """
+        relays, predicates = self._candidates(snapshot, timings, memo)
+        with timings.stage("scan", ", ".join(f.describe() for f in predicates)) as stage:
+            relays = list(self._scan(relays, predicates))
+            stage.rows = len(relays)
+        for f in self._set_level:
+            with timings.stage("filter", f.describe()) as stage:
+                relays = f.load(relays)
+                stage.rows = len(relays)
+        return relays
+
+    def execute(self, snapshot, timings, memo=None):
+        """
+        Return the selected relays of snapshot grouped into a dict,
+        recording the time spent per stage in timings.
+        """
+        if memo is None and not self._set_level:
+            relays, predicates = self._candidates(snapshot, timings, memo)
+            with timings.stage("scan", ", ".join(f.describe() for f in predicates)) as stage:
+                grouped = self._group_relays(self._scan(relays, predicates))
+                stage.rows = sum(len(group) for group in grouped.itervalues())
+            return grouped
+        relays = _memoized(memo, ('relays', self._key),
+                           lambda: self._filter_relays(snapshot, timings, memo))
+        with timings.stage("group") as stage:
+            grouped = self._group_relays(relays)
+            stage.rows = len(grouped)
+        return grouped
+
+    def _filter_rows(self, table, timings, memo):
+        """
+        Return an array of the rows of table that pass all filters.
+        """
+        mask = numpy.ones(table.size, dtype=bool)
+        predicates = []
+        for f in self._per_relay:
+            with timings.stage("mask", f.describe()):
+                accepted = _memoized(memo, ('mask', f.key), lambda: f.mask(table))
+                if accepted is not None:
+                    mask &= accepted
+            if accepted is None:
+                predicates.append(f)
+        rows = numpy.flatnonzero(mask)
+        if predicates or self._set_level:
+            relays = [table.relays[row] for row in rows]
+            rows_by_id = dict((id(relay), row) for row, relay in zip(rows, relays))
+            if predicates:
+                with timings.stage("scan", ", ".join(f.describe() for f in predicates)) as stage:
+                    relays = list(_select(relays, [f.accept for f in predicates]))
+                    stage.rows = len(relays)
+            for f in self._set_level:
+                with timings.stage("filter", f.describe()) as stage:
+                    relays = f.load(relays)
+                    stage.rows = len(relays)
+            rows = numpy.array([rows_by_id[id(relay)] for relay in relays], dtype=numpy.intp)
+        return rows
+
+    def execute_columnar(self, table, timings, memo=None):
+        """
+        Like execute, but evaluate the per-relay filters as masks over
+        table and return the selection as GroupedRows.
+        """
+        rows = _memoized(memo, ('rows', self._key), lambda: self._filter_rows(table, timings, memo))
+        with timings.stage("group") as stage:
+            columns = [table.add_column(column, extract) for column, extract in self._group_keys]
+            grouped = GroupedRows(table, rows, columns)
+            stage.rows = len(grouped)
+        return grouped
+
+def datafile_path(datafile="details.json"):
+    """
+    Resolve a datafile name relative to the directory compass lives in.
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), datafile)
+
+class Relay(object):
+    """
+    The fields of a details document relay that compass uses.  Fields
+    missing from the document are left unset, so optional ones are read
+    with getattr and a default.  Equal countries, AS numbers and names,
+    platforms, contacts, flag lists and exit policy summaries are shared
+    between the relays of a snapshot.  Relays also offer the read-only
+    dict interface of the document's relays.
+    """
+    __slots__ = tuple(DETAILS_FIELDS)
+    SHARED = ['country', 'as_number', 'as_name', 'platform', 'contact']
+    # Positions of the fields whose lists are kept as tuples.
+    SEQUENCES = [__slots__.index(name) for name in ('flags', 'or_addresses', 'family')]
+
+    @classmethod
+    def from_details(cls, details, shared):
+        """
+        Project a relay of a details document, sharing values through
+        the dict shared.
+        """
+        relay = cls()
+        for name in Relay.__slots__:
+            if name in details:
+                setattr(relay, name, details[name])
+        for name in Relay.SHARED:
+            value = getattr(relay, name, None)
+            if value is not None:
+                setattr(relay, name, shared.setdefault(value, value))
+        flags = tuple(relay.flags)
+        relay.flags = shared.setdefault(flags, flags)
+        if hasattr(relay, 'or_addresses'):
+            relay.or_addresses = tuple(relay.or_addresses)
+        if hasattr(relay, 'family'):
+            relay.family = tuple(relay.family)
+        summary = getattr(relay, 'exit_policy_summary', None)
+        if summary is not None:
+            key = ('exit_policy_summary',) + tuple(sorted((rule, tuple(ports))
+                                                          for rule, ports in summary.iteritems()))
+            relay.exit_policy_summary = shared.setdefault(key, summary)
+        return relay
+
+    @classmethod
+    def project(cls, relays):
+        """
+        Return the relays of a details document as Relay objects.
+        """
+        shared = {}
+        return [relay if isinstance(relay, Relay) else cls.from_details(relay, shared)
+                for relay in relays]
+
+    def matches(self, details):
+        """
+        Return whether details, a relay of a details document, projects
+        to a relay equal to this one (taking missing fields for None),
+        without projecting it.
+        """
+        values = map(details.get, Relay.__slots__)
+        for position in Relay.SEQUENCES:
+            if values[position] is not None:
+                values[position] = tuple(values[position])
+        return values == [getattr(self, name, None) for name in Relay.__slots__]
+
+    def iteritems(self):
+        for name in Relay.__slots__:
+            if hasattr(self, name):
+                yield name, getattr(self, name)
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __contains__(self, name):
+        return hasattr(self, name)
+
+    def __eq__(self, other):
+        return isinstance(other, Relay) and dict(self.iteritems()) == dict(other.iteritems())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "Relay(%r)" % dict(self.iteritems())
+
+class _JSONStream(object):
+    """
+    Read JSON values one at a time from a file, keeping only the part
+    of the file that has not been consumed yet in memory.
+    """
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, datafile, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        self._file = datafile
+        self._chunk_size = chunk_size
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self):
+        """
+        Read the next chunk, dropping the consumed part of the buffer.
+        Returns False at the end of the file.
+        """
+        if self._eof:
+            return False
+        chunk = self._file.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def peek(self):
+        """
+        Return the next character that is not whitespace, or "" at the
+        end of the file.
+        """
+        while True:
+            self._pos = _JSONStream.WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, characters):
+        """
+        Consume and return the next character, which must be one of
+        characters.
+        """
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError("Expected one of %r at %r" % (characters, self._buffer[self._pos:][:20]))
+        self._pos += 1
+        return character
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                # The value may continue in the next chunk.
+                if self._fill():
+                    continue
+                raise
+            if end == len(self._buffer) and self._fill():
+                # So may a number that ends the buffer.
+                continue
+            self._pos = end
+            return value
+
+    def elements(self):
+        """
+        Yield the elements of the array that comes next one by one.
+        """
+        self.expect("[")
+        if self.peek() == "]":
+            self._pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(",]") == "]":
+                return
+
+def read_details(datafile, chunk_size=DOWNLOAD_CHUNK_SIZE, project=None):
+    """
+    Parse the details document in the file datafile one relay at a time,
+    projecting each into a Relay right away, so that the document is
+    never in memory as a whole.  Returns the document with its relays as
+    Relay objects and without its other arrays (bridges).  project, if
+    given, is called with each relay to do the projecting instead.
+    """
+    stream = _JSONStream(datafile, chunk_size)
+    document = {}
+    stream.expect("{")
+    if stream.peek() == "}":
+        stream.expect("}")
+    else:
+        while True:
+            key = stream.value()
+            stream.expect(":")
+            if stream.peek() != "[":
+                document[key] = stream.value()
+            elif key == "relays":
+                if project is None:
+                    shared = {}
+                    project = lambda relay: Relay.from_details(relay, shared)
+                document[key] = [project(relay) for relay in stream.elements()]
+            else:
+                for _ in stream.elements():
+                    pass
+            if stream.expect(",}") == "}":
+                break
+    if stream.peek():
+        raise ValueError("Extra data after the details document")
+    return document
+
+class RelaySnapshot(object):
+    """
+    A parsed details.json document.  Snapshots are shared between all
+    RelayStats instances (and threads) of a process and must be treated
+    as read-only; a changed datafile results in a new snapshot rather
+    than an update of an existing one.
+    """
+    def __init__(self, document, source_key=None, cache=None):
+        relays = document.get('relays', [])
+        if not isinstance(relays, RelayRecords):
+            relays = Relay.project(relays)
+        self.relays = relays
+        self.relays_published = document.get('relays_published')
+        self.source_key = source_key
+        self._cache = cache
+        self._exit_policies = None
+        self._family_graph = None
+        self._index = None
+        self._table = None
+        self._aggregates = {}
+        self._orderings = OrderedDict()
+        self._orderings_lock = threading.Lock()
+        if source_key is not None:
+            self.version = "%x-%x" % (int(source_key[0] * 1000000), source_key[1])
+        else:
+            self.version = "%x" % id(self)
 
-class RelayStats(object):
-    def __init__(self, options, custom_datafile="details.json"):
+    @property
+    def exit_policies(self):
+        """
+        Parsed exit policy summaries by fingerprint, built on first use.
+        Identical summaries share a single ExitPolicy.  Building is
+        idempotent, so racing threads at worst build it twice.
+        """
+        if self._exit_policies is None:
+            parsed = {}
+            policies = {}
+            for relay in self.relays:
+                summary = getattr(relay, 'exit_policy_summary', {})
+                key = (tuple(summary.get('accept', ())),
+                       tuple(summary.get('reject', ())), 'accept' in summary)
+                if key not in parsed:
+                    parsed[key] = ExitPolicy.from_summary(summary)
+                policies[relay.fingerprint] = parsed[key]
+            self._exit_policies = policies
+        return self._exit_policies
+
+    def exit_policy(self, relay):
+        """
+        Return the ExitPolicy of relay, or None if it has no summary.
+        """
+        return self.exit_policies.get(relay.fingerprint)
+
+    @property
+    def index(self):
+        """
+        The RelayIndex of all relays, built on first use.
+        """
+        if self._index is None:
+            state = self._cache and self._cache.section('index')
+            if state is not None:
+                self._index = RelayIndex.from_state(state)
+            else:
+                self._index = RelayIndex(self.relays)
+        return self._index
+
+    @property
+    def table(self):
+        """
+        The RelayTable of all relays, built on first use.  Requires
+        NumPy.
+        """
+        if self._table is None:
+            state = self._cache and self._cache.table_state()
+            if state is not None:
+                self._table = RelayTable.from_state(self.relays, *state)
+            else:
+                self._table = RelayTable(self)
+        return self._table
+
+    @property
+    def family_graph(self):
+        """
+        The FamilyGraph of all relays, built on first use.
+        """
+        if self._family_graph is None:
+            state = self._cache and self._cache.section('family_graph')
+            if state is not None:
+                self._family_graph = FamilyGraph.from_state(self.relays, state)
+            else:
+                self._family_graph = FamilyGraph(self.relays)
+        return self._family_graph
+
+    def group_aggregates(self, engine="dict"):
+        """
+        The GroupAggregates of the relays for engine.
+        """
+        aggregates = self._aggregates.get(engine)
+        if aggregates is None:
+            aggregates = self._aggregates[engine] = GroupAggregates(self, engine)
+        return aggregates
+
+    @property
+    def aggregates(self):
+        """
+        The GroupAggregates of the dict engine, all of them built on first
+        use.
+        """
+        aggregates = self.group_aggregates("dict")
+        aggregates.build()
+        return aggregates
+
+    @property
+    def table_aggregates(self):
+        """
+        The GroupAggregates of the numpy engine, all of them built on
+        first use.
+        """
+        aggregates = self.group_aggregates("numpy")
+        aggregates.build()
+        return aggregates
+
+    def ordering(self, key, compute):
+        """
+        Return the ResultOrdering cached under key, computing it with
+        compute() if it is not.  The ORDERINGS_CACHED most recently used
+        orderings are kept, for as long as the snapshot is.
+        """
+        with self._orderings_lock:
+            ordering = self._orderings.pop(key, None)
+            if ordering is not None:
+                self._orderings[key] = ordering
+                return ordering
+        ordering = compute()
+        with self._orderings_lock:
+            self._orderings[key] = ordering
+            while len(self._orderings) > ORDERINGS_CACHED:
+                self._orderings.popitem(last=False)
+        return ordering
+
+    def build(self, structures):
+        """
+        Build the named derived structures (e.g. "index") now rather
+        than on first use.
+        """
+        for name in structures:
+            getattr(self, name)
+
+    def update(self, document, source_key=None):
+        """
+        Return a snapshot of document, a details document that follows
+        the one of this snapshot, together with the SnapshotChanges
+        between them.  Relays are matched by fingerprint, and unchanged
+        relays keep their Relay objects.  The rows of the snapshot are
+        in document order, just like those of a snapshot loaded from
+        the document.  If the unchanged relays are in the same order
+        as before, the index, exit policies, family graph and aggregates
+        that are built are moved to the new rows, and only the parts
+        for changed, added and removed relays are worked out again.
+        Otherwise, if more than UPDATE_MAX_CHURN of the relays changed
+        or if fingerprints were not unique, they are built from scratch
+        when they are needed.
+        """
+        old_relays = self.relays
+        old_rows = {}
+        for row, relay in enumerate(old_relays):
+            old_rows.setdefault(relay.fingerprint, row)
+        unique = len(old_rows) == len(old_relays)
+        # The new row of each old row, or None for removed and changed
+        # relays, which leave their rows to be added again.
+        moved = [None] * len(old_relays)
+        relays = []
+        added = []
+        replaced = set()
+        changes = SnapshotChanges()
+        shared = {}
+        for details in document.get('relays', []):
+            row = old_rows.pop(details['fingerprint'], None)
+            if row is not None and (details is old_relays[row] or
+                                    old_relays[row].matches(details)):
+                moved[row] = len(relays)
+                relays.append(old_relays[row])
+                continue
+            if isinstance(details, Relay):
+                relay = details
+            else:
+                relay = Relay.from_details(details, shared)
+            if row is not None:
+                replaced.add(row)
+            changes.add(old_relays[row] if row is not None else None, relay)
+            added.append((len(relays), relay))
+            relays.append(relay)
+        removed = [(row, relay) for row, relay in enumerate(old_relays) if moved[row] is None]
+        for row, relay in removed:
+            if row not in replaced:
+                changes.add(relay, None)
+
+        snapshot = RelaySnapshot({'relays': relays,
+                                  'relays_published': document.get('relays_published')},
+                                 source_key)
+        kept = [row for row in moved if row is not None]
+        if (len(removed) + len(added) - len(replaced) > UPDATE_MAX_CHURN * len(relays)
+                or kept != sorted(kept) or not unique):
+            return snapshot, changes
+        if self._index is not None:
+            snapshot._index = self._index.updated(moved, added)
+        if self._exit_policies is not None:
+            policies = dict(self._exit_policies)
+            for _, relay in removed:
+                policies.pop(relay.fingerprint, None)
+            for _, relay in added:
+                policies[relay.fingerprint] = ExitPolicy.from_summary(
+                    getattr(relay, 'exit_policy_summary', {}))
+            snapshot._exit_policies = policies
+        if self._family_graph is not None:
+            snapshot._family_graph = self._family_graph.updated(relays, moved, removed, added)
+        aggregates = self._aggregates.get("dict")
+        if aggregates is not None:
+            snapshot._aggregates["dict"] = aggregates.updated(snapshot, moved, removed, added)
+        return snapshot, changes
+
+    def update_from(self, path):
+        """
+        Like update, for the details document at path.  Unchanged relays
+        are recognized while parsing and never projected.
+        """
+        source_key = _source_key(path)
+        relays = self.relays
+        rows = dict((relay.fingerprint, row) for row, relay in enumerate(relays))
+        shared = {}
+        def project(details):
+            row = rows.get(details.get('fingerprint'))
+            if row is not None and relays[row].matches(details):
+                return relays[row]
+            return Relay.from_details(details, shared)
+        with _gc_paused(), open(path) as datafile:
+            return self.update(read_details(datafile, project=project), source_key)
+
+    @classmethod
+    def load(cls, path, cache=False, shared=False):
+        """
+        Parse the details document at path.  With cache, the snapshot
+        comes from path's SnapshotCache, which is written first if it is
+        not up to date.  With shared, the relays are also left in the
+        mapped cache and decoded on access, so that all processes using
+        the cache share a single copy of them.
+        """
+        if cache or shared:
+            return SnapshotCache(path).snapshot(shared)
+        source_key = _source_key(path)
+        with _gc_paused(), open(path) as datafile:
+            return cls(read_details(datafile), source_key)
+
+def _source_key(path):
+    st = os.stat(path)
+    return (st.st_mtime, st.st_size)
+
+@contextmanager
+def _gc_paused():
+    """
+    Suspend the cyclic garbage collector while building large object
+    graphs that contain no garbage, such as parsed documents.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+class SnapshotChanges(object):
+    """
+    The differences between two consecutive details documents: the
+    fingerprints of the relays that joined, left or changed, and the
+    shift of the consensus weight fraction of each country and AS.
+    """
+    def __init__(self):
+        self.joined = []
+        self.left = []
+        self.changed = []
+        self.country_weights = {}
+        self.as_weights = {}
+
+    def add(self, old, new):
+        """
+        Record the change of a relay from old to new, either of which is
+        None for relays that joined or left.
+        """
+        if old is None:
+            self.joined.append(new.fingerprint)
+        elif new is None:
+            self.left.append(old.fingerprint)
+        else:
+            self.changed.append(new.fingerprint)
+        for relay, sign in ((old, -1), (new, 1)):
+            if relay is None:
+                continue
+            weight = sign * getattr(relay, 'consensus_weight_fraction', 0)
+            for shifts, key in ((self.country_weights, getattr(relay, 'country', None)),
+                                (self.as_weights, getattr(relay, 'as_number', None))):
+                shifts[key] = shifts.get(key, 0) + weight
+
+    def largest_shifts(self, shifts, count=5):
+        """
+        Return the count largest (key, shift) pairs of shifts by size.
+        """
+        return sorted(((key, shift) for key, shift in shifts.iteritems() if shift),
+                      key=lambda item: abs(item[1]), reverse=True)[:count]
+
+    def summary(self):
+        """
+        Return a one line description of the changes.
+        """
+        parts = ["%d relays joined, %d left, %d changed" % (
+            len(self.joined), len(self.left), len(self.changed))]
+        for name, shifts in (("countries", self.country_weights), ("ASes", self.as_weights)):
+            largest = self.largest_shifts(shifts)
+            if largest:
+                parts.append("%s %s" % (name, ", ".join(
+                    "%s %+.4f%%" % (key or "??", shift * 100.0) for key, shift in largest)))
+        return "; ".join(parts)
+
+class RelayRecords(object):
+    """
+    A read-only sequence of the relays stored in a SnapshotCache, each
+    decoded from the mapped file when accessed.
+    """
+    def __init__(self, data, offsets, records, count):
+        self._data = data
+        self._offsets = offsets
+        self._records = records
+        self._count = count
+        self._shared = {}
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, row):
+        row = int(row)
+        if row < 0:
+            row += self._count
+        if not 0 <= row < self._count:
+            raise IndexError("relay row out of range")
+        start, end = struct.unpack_from("<qq", self._data, self._offsets + 8 * row)
+        return Relay.from_details(marshal.loads(self._data[self._records + start:
+                                                          self._records + end]),
+                                  self._shared)
+
+    def __iter__(self):
+        for row in xrange(self._count):
+            yield self[row]
+
+class SnapshotCache(object):
+    """
+    A binary copy of a parsed datafile and its index, family graph and
+    (with NumPy) RelayTable, stored as "<datafile>.cache" so that later
+    processes can skip parsing the document and building the structures.
+    The file holds a marshalled header, keyed by the datafile's mtime,
+    size and SHA-1, followed by sections: one marshalled record per relay
+    plus their offsets, one marshalled section per structure and the
+    table's arrays in raw form.  It is mapped into memory and read only
+    as far as needed, the arrays are used in place.
+    """
+    FORMAT = 5
+    MAGIC = "compass-snapshot-cache\n"
+    SECTIONS = ['index', 'family_graph']
+
+    def __init__(self, path, cache_path=None):
+        self.path = path
+        self.cache_path = cache_path or path + ".cache"
         self._data = None
+        self._base = 0
+        self._sections = {}
+        self._arrays = {}
+
+    def snapshot(self, shared=False):
+        """
+        Return the snapshot of the datafile, read from the cache if that
+        is up to date and parsed from the datafile (writing the cache)
+        otherwise.  Processes doing this at the same time take turns, so
+        that only the first one parses.
+        """
+        with open(self.path, 'rb') as datafile:
+            fcntl.flock(datafile, fcntl.LOCK_EX)
+            st = os.fstat(datafile.fileno())
+            source_key = (st.st_mtime, st.st_size)
+            digest = hashlib.sha1()
+            for chunk in iter(lambda: datafile.read(DOWNLOAD_CHUNK_SIZE), ''):
+                digest.update(chunk)
+            key = (source_key[0], source_key[1], digest.hexdigest())
+            snapshot = self.load(key, source_key, shared)
+            if snapshot is None:
+                datafile.seek(0)
+                with _gc_paused():
+                    snapshot = RelaySnapshot(read_details(datafile), source_key)
+                if self.write(snapshot, key) and shared:
+                    snapshot = self.load(key, source_key, shared) or snapshot
+        return snapshot
+
+    def load(self, key, source_key, shared=False):
+        """
+        Return the cached snapshot, or None if there is no cache for key.
+        """
+        try:
+            with open(self.cache_path, 'rb') as cache_file:
+                data = mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError, mmap.error):
+            return None
+        try:
+            start = len(self.MAGIC) + 4
+            if data[:len(self.MAGIC)] != self.MAGIC:
+                return None
+            end = start + struct.unpack("<I", data[len(self.MAGIC):start])[0]
+            header = marshal.loads(data[start:end])
+            if header['format'] != self.FORMAT or header['key'] != key:
+                return None
+            if len(data) != end + header['size']:
+                return None
+            self._data = data
+            self._base = end
+            self._sections = header['sections']
+            self._arrays = header['arrays']
+            relays = RelayRecords(data, end + self._sections['offsets'][0],
+                                  end + self._sections['records'][0], header['count'])
+            if not shared:
+                with _gc_paused():
+                    relays = list(relays)
+        except (ValueError, EOFError, TypeError, KeyError, struct.error):
+            return None
+        document = {'relays_published': header['relays_published'], 'relays': relays}
+        return RelaySnapshot(document, source_key, self)
+
+    def section(self, name):
+        """
+        Return the contents of section name, or None if there is none.
+        """
+        if name not in self._sections:
+            return None
+        # Offsets are relative to the end of the header.
+        start, end = self._sections[name]
+        return marshal.loads(self._data[self._base + start:self._base + end])
+
+    def table_state(self):
+        """
+        Return the state of the cached RelayTable with its arrays mapped
+        from the file, or None if there is none.
+        """
+        state = self.section('table')
+        if state is None or numpy is None:
+            return None
+        arrays = {}
+        for name, (start, end, dtype) in self._arrays.iteritems():
+            dtype = numpy.dtype(dtype)
+            arrays[name] = numpy.frombuffer(self._data, dtype, (end - start) // dtype.itemsize,
+                                            self._base + start)
+        return state, arrays
+
+    def write(self, snapshot, key):
+        """
+        Build the structures of snapshot and write them with its relays
+        to the cache.  Returns False if the cache could not be written,
+        which is not an error.
+        """
+        chunks = []
+        sections = {}
+        arrays = {}
+        position = [0]
+        def add(data):
+            # Sections start 8 byte aligned, so that arrays can be used in
+            # place.
+            padding = -position[0] % 8
+            start = position[0] + padding
+            chunks.extend(["\0" * padding, data])
+            position[0] = start + len(data)
+            return (start, position[0])
+
+        records = [marshal.dumps(dict(relay.iteritems()), 2) for relay in snapshot.relays]
+        offsets = [0]
+        for record in records:
+            offsets.append(offsets[-1] + len(record))
+        sections['records'] = add("".join(records))
+        del records
+        sections['offsets'] = add(struct.pack("<%dq" % len(offsets), *offsets))
+        for name in self.SECTIONS:
+            sections[name] = add(marshal.dumps(getattr(snapshot, name).state(), 2))
+        if numpy is not None:
+            state, table_arrays = snapshot.table.state()
+            sections['table'] = add(marshal.dumps(state, 2))
+            for name, array in table_arrays.iteritems():
+                array = numpy.ascontiguousarray(array)
+                arrays[name] = add(array.tostring()) + (array.dtype.str,)
+        header = marshal.dumps({'format': self.FORMAT, 'key': key, 'sections': sections,
+                                'arrays': arrays, 'count': len(snapshot.relays),
+                                'size': position[0],
+                                'relays_published': snapshot.relays_published}, 2)
+        # The header is padded so that sections stay aligned in the file.
+        header += " " * (-(len(self.MAGIC) + 4 + len(header)) % 8)
+        try:
+            fd, tmp_path = tempfile.mkstemp(prefix=".%s-" % os.path.basename(self.cache_path),
+                                            dir=os.path.dirname(self.cache_path))
+        except (IOError, OSError):
+            return False
+        try:
+            with os.fdopen(fd, 'wb') as cache_file:
+                cache_file.write(self.MAGIC)
+                cache_file.write(struct.pack("<I", len(header)))
+                cache_file.write(header)
+                for chunk in chunks:
+                    cache_file.write(chunk)
+            os.chmod(tmp_path, 0644)
+            os.rename(tmp_path, self.cache_path)
+        except (IOError, OSError):
+            os.unlink(tmp_path)
+            return False
+        return True
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+def get_snapshot(datafile="details.json", cache=False, shared=False):
+    """
+    Return the snapshot for datafile, parsing it only on first use or
+    when its mtime or size changed since it was last loaded.  Loading is
+    serialized so that concurrent callers never parse the same document
+    twice; a datafile that fails to parse (e.g. because it is being
+    rewritten) keeps the previous snapshot in service.  cache and shared
+    are passed on to RelaySnapshot.load; without them, a changed datafile
+    updates the previous snapshot (see RelaySnapshot.update).
+    """
+    path = datafile_path(datafile)
+    snapshot = _snapshots.get(path)
+    if snapshot is not None and snapshot.source_key == _source_key(path):
+        return snapshot
+    with _snapshots_lock:
+        snapshot = _snapshots.get(path)
+        if snapshot is not None and snapshot.source_key == _source_key(path):
+            return snapshot
+        try:
+            if snapshot is not None and not (cache or shared) and isinstance(snapshot.relays, list):
+                snapshot, _ = snapshot.update_from(path)
+            else:
+                snapshot = RelaySnapshot.load(path, cache, shared)
+        except ValueError:
+            if snapshot is None:
+                raise
+            return snapshot
+        _snapshots[path] = snapshot
+    return snapshot
+
+class SnapshotRefresher(threading.Thread):
+    """
+    Download a new details document for datafile every interval seconds
+    in the background.  Each document is parsed and its structures are
+    built before it replaces the datafile and the snapshot in service
+    in one step, so callers of get_snapshot never wait for a download
+    or see a partially written datafile.  A failed refresh keeps the
+    current snapshot.  With shared, the new snapshot is published as a
+    shared SnapshotCache (see RelaySnapshot.load) for all processes
+    using the datafile.  Otherwise, the current snapshot is updated with
+    the relays that changed (see RelaySnapshot.update), and changes is
+    set to the SnapshotChanges of the last refresh.
+    """
+    STRUCTURES = ['index', 'exit_policies', 'family_graph', 'aggregates']
+
+    def __init__(self, datafile="details.json", url=DETAILS_URL, interval=3600,
+                 structures=STRUCTURES, fields=None, shared=False):
+        threading.Thread.__init__(self, name="snapshot-refresher")
+        self.daemon = True
+        self.path = datafile_path(datafile)
+        self.url = details_url(url, fields)
+        self.interval = interval
+        self.structures = structures
+        self.shared = shared
+        self.changes = None
+        self._stopped = threading.Event()
+
+    def refresh(self):
+        """
+        Download, load and install a new snapshot, and return it.
+        Returns None if the document did not change since the last
+        download.
+        """
+        self.changes = None
+        download = _download(self.url, self.path)
+        if download is None:
+            return None
+        tmp_path, validators = download
+        try:
+            # rename keeps mtime and size, so the snapshot's source key
+            # stays valid for the datafile.
+            if self.shared:
+                snapshot = SnapshotCache(tmp_path, self.path + ".cache").snapshot(shared=True)
+            else:
+                previous = _snapshots.get(self.path)
+                if previous is not None and isinstance(previous.relays, list):
+                    snapshot, self.changes = previous.update_from(tmp_path)
+                else:
+                    snapshot = RelaySnapshot.load(tmp_path)
+            snapshot.build(self.structures)
+            with _snapshots_lock:
+                _install_download(tmp_path, self.path, validators)
+                _snapshots[self.path] = snapshot
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        return snapshot
+
+    def run(self):
+        if not os.path.exists(self.path):
+            self._refresh()
+        while not self._stopped.wait(self.interval):
+            self._refresh()
+
+    def _refresh(self):
+        try:
+            if self.refresh() is not None and self.changes is not None:
+                sys.stderr.write("Refreshed %s: %s\n" % (self.path, self.changes.summary()))
+        except (IOError, OSError, ValueError), e:
+            sys.stderr.write("Refreshing %s from %s failed: %s\n" % (self.path, self.url, e))
+
+    def stop(self):
+        self._stopped.set()
+
+ENGINES = ['dict', 'numpy']
+SORT_KEYS = ["cw", "adv_bw", "p_guard", "p_exit", "p_middle", "nick", "fp"]
+EXIT_FILTERS = ["fast_exits_only", "almost_fast_exits_only", "all_relays",
+                "fast_exits_only_any_network"]
+
+class Query(namedtuple('Query', ['inactive', 'family', 'country', 'ases', 'exits_only',
+                                 'guards_only', 'exit_filter', 'ipv4_prefix', 'ipv6_prefix',
+                                 'by_country', 'by_as', 'by', 'sort', 'sort_reverse', 'top',
+                                 'links'])):
+    """
+    An immutable, hashable description of a selection and how to sort
+    and cut it.  Equivalent queries compare equal, e.g. regardless of
+    the order and case of countries, so they can be used as cache keys
+    and shared between threads.  The group keys of by are kept in the
+    order of GROUP_KEYS and include country and as if by_country and
+    by_as are set, and the other way around.
+    """
+    __slots__ = ()
+
+    DEFAULTS = {'inactive': False, 'family': None, 'country': (), 'ases': (),
+                'exits_only': False, 'guards_only': False, 'exit_filter': 'all_relays',
+                'ipv4_prefix': FAST_EXIT_IPV4_PREFIX, 'ipv6_prefix': FAST_EXIT_IPV6_PREFIX,
+                'by_country': False, 'by_as': False, 'by': (), 'sort': 'cw',
+                'sort_reverse': True, 'top': 10, 'links': None}
+
+    @classmethod
+    def create(cls, **values):
+        for field, default in cls.DEFAULTS.iteritems():
+            values.setdefault(field, default)
+        for field in ['inactive', 'exits_only', 'guards_only', 'by_country', 'by_as',
+                      'sort_reverse', 'links']:
+            if values[field] is not None and not isinstance(values[field], bool):
+                raise ValueError("Not a boolean for %s: %r" % (field, values[field]))
+            if field != 'links':
+                values[field] = bool(values[field])
+        values['family'] = values['family'] or None
+        if not isinstance(values['family'], (basestring, type(None))):
+            raise ValueError("Not a relay for family: %r" % (values['family'],))
+        if values['sort'] not in SORT_KEYS:
+            raise ValueError("Unknown sort key: %r" % (values['sort'],))
+        if values['exit_filter'] not in EXIT_FILTERS:
+            raise ValueError("Unknown exit filter: %r" % (values['exit_filter'],))
+        country = cls._strings('country', values['country'])
+        values['country'] = tuple(sorted(set(x.lower() for x in country)))
+        by = cls._strings('by', values['by'])
+        by = set(name.strip().lower() for names in by for name in names.split(','))
+        by.discard('')
+        for name in by:
+            if name not in GROUP_KEY_NAMES:
+                raise ValueError("Unknown group key: %s" % name)
+        if values['by_country']:
+            by.add('country')
+        if values['by_as']:
+            by.add('as')
+        values['by'] = tuple(name for name in GROUP_KEY_NAMES if name in by)
+        values['by_country'] = 'country' in by
+        values['by_as'] = 'as' in by
+        ases = cls._strings('ases', values['ases'])
+        values['ases'] = tuple(sorted(set(x if not x.isdigit() else "AS" + x for x in ases)))
+        for field, bits in [('ipv4_prefix', 32), ('ipv6_prefix', 128)]:
+            if values[field] is None:
+                values[field] = cls.DEFAULTS[field]
+            values[field] = cls._integer(field, values[field])
+            if not 0 <= values[field] <= bits:
+                raise ValueError("Not a valid prefix length for %s: %d" % (field, values[field]))
+        if values['top'] is not None:
+            values['top'] = cls._integer('top', values['top'])
+        # Any negative or invalid top means all results.
+        if values['top'] is None or values['top'] < 0:
+            values['top'] = -1
+        return cls(**values)
+
+    @staticmethod
+    def _strings(field, value):
+        """
+        Return value, a string or a list of strings, as a list of strings.
+        """
+        if not value:
+            return []
+        if isinstance(value, basestring):
+            return [value]
+        if (not isinstance(value, (list, tuple))
+            or not all(isinstance(x, basestring) for x in value)):
+            raise ValueError("Not a string or list of strings for %s: %r" % (field, value))
+        return list(value)
+
+    @staticmethod
+    def _integer(field, value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise ValueError("Not a number for %s: %r" % (field, value))
+
+    @classmethod
+    def from_options(cls, options):
+        """
+        Convert parsed command line options, a web Opt or anything else
+        with the same attributes into a Query.
+        """
+        if isinstance(options, Query):
+            return options
+        return cls.create(**dict((field, getattr(options, field, cls.DEFAULTS[field]))
+                                 for field in cls._fields))
+
+    @classmethod
+    def from_dict(cls, values):
+        """
+        Create a Query from a dict of its fields, such as a decoded JSON
+        object, raising ValueError for anything that is not a valid query.
+        """
+        if not isinstance(values, dict):
+            raise ValueError("A query must be an object, not %r" % (values,))
+        unknown = set(values) - set(cls._fields)
+        if unknown:
+            raise ValueError("Unknown query fields: %s" % ", ".join(sorted(unknown)))
+        try:
+            return cls.create(**dict((str(field), value) for field, value in values.iteritems()))
+        except (TypeError, AttributeError):
+            raise ValueError("Invalid query: %r" % (values,))
+
+    def selection(self):
+        """
+        Return the part of the query that decides which relays are
+        selected, as opposed to how they are grouped and shown.
+        """
+        return (self.inactive, self.family, self.country, self.ases, self.exits_only,
+                self.guards_only, self.exit_filter, self.ipv4_prefix, self.ipv6_prefix)
+
+class AggregatedGroups(list):
+    """
+    The aggregates of groups of relays in group order, as tuples of the
+    last relay of the group, its weights by name and its numbers of
+    relays, exits, guards and ASes.
+    """
+
+def aggregate_groups(grouped_relays):
+    """
+    Return the AggregatedGroups of the groups a QueryPlan selected,
+    either a dict of relay lists or GroupedRows.
+    """
+    if isinstance(grouped_relays, GroupedRows):
+        return _aggregate_rows(grouped_relays)
+
+    # Flag lists are shared between relays, so work out the exit and
+    # guard bits of each of them once.
+    masks = {}
+    groups = AggregatedGroups()
+    for group in grouped_relays.itervalues():
+        cw = adv_bw = p_guard = p_middle = p_exit = 0
+        exits_in_group, guards_in_group = 0, 0
+        ases_in_group = set()
+        for relay in group:
+            cw += getattr(relay, 'consensus_weight_fraction', 0)
+            adv_bw += getattr(relay, 'advertised_bandwidth_fraction', 0)
+            p_guard += getattr(relay, 'guard_probability', 0)
+            p_middle += getattr(relay, 'middle_probability', 0)
+            p_exit += getattr(relay, 'exit_probability', 0)
+            mask = masks.get(id(relay.flags))
+            if mask is None:
+                mask = masks[id(relay.flags)] = _position_mask(relay.flags)
+            if mask & EXIT_BIT:
+                exits_in_group += 1
+            if mask & GUARD_BIT:
+                guards_in_group += 1
+            ases_in_group.add((getattr(relay, 'as_number', '??'),
+                               getattr(relay, 'as_name', '??')))
+
+        group_weights = {'consensus_weight_fraction': cw, 'advertised_bandwidth_fraction': adv_bw,
+                         'guard_probability': p_guard, 'middle_probability': p_middle,
+                         'exit_probability': p_exit}
+        groups.append((group[-1], group_weights, len(group), exits_in_group,
+                       guards_in_group, len(ases_in_group)))
+    return groups
+
+def _aggregate_rows(grouped):
+    """
+    aggregate_groups for the numpy engine: compute the aggregates of
+    GroupedRows with bincounts.
+    """
+    table, rows, groups = grouped.table, grouped.rows, grouped.groups
+    n = len(grouped)
+    sums = dict((weight, numpy.bincount(groups, weights=table.weights[weight][rows],
+                                        minlength=n))
+                for weight in RelayStats.WEIGHTS)
+    relays_in_group = numpy.bincount(groups, minlength=n)
+    exits_in_group = numpy.bincount(groups[table.is_exit[rows]], minlength=n)
+    guards_in_group = numpy.bincount(groups[table.is_guard[rows]], minlength=n)
+    as_count = len(table.vocabulary['as_info'])
+    group_ases = numpy.unique(groups * as_count + table.codes['as_info'][rows])
+    ases_in_group = numpy.bincount(group_ases // as_count, minlength=n)
+    # The last relay of each group provides nickname, flags and so on.
+    reverse_first = numpy.unique(groups[::-1], return_index=True)[1]
+    last = len(rows) - 1 - reverse_first
+
+    aggregated = AggregatedGroups()
+    for group in grouped.order:
+        group_weights = dict((weight, float(sums[weight][group]))
+                             for weight in RelayStats.WEIGHTS)
+        aggregated.append((table.relays[rows[last[group]]], group_weights,
+                           int(relays_in_group[group]), int(exits_in_group[group]),
+                           int(guards_in_group[group]), int(ases_in_group[group])))
+    return aggregated
+
+class GroupAggregates(object):
+    """
+    The aggregates of the groups of relays by country and by AS that
+    queries filtering by nothing but the running, exit and guard flags
+    select, computed once per snapshot and engine.  Such queries take
+    their groups from here instead of filtering and aggregating all
+    relays.  Each combination of options is aggregated on first use, or
+    all of them by build().
+    """
+    GROUP_KEYS = [('country',), ('as',)]
+    FLAG_OPTIONS = [(inactive, exits_only, guards_only) for inactive in (False, True)
+                    for exits_only in (False, True) for guards_only in (False, True)]
+
+    def __init__(self, snapshot, engine="dict"):
+        self._snapshot = snapshot
+        self._engine = engine
+        self._groups = {}
+        # For updates, the dict engine also keeps the aggregates and first
+        # rows of the groups by group, unless relays are decoded on access.
+        self._parts = {}
+        self._rows = None
+
+    @classmethod
+    def key(cls, query):
+        """
+        Return the key of query's aggregates, or None if query selects
+        relays by more than flags or groups them otherwise.
+        """
+        if (query.by not in cls.GROUP_KEYS or query.family or query.country or query.ases
+            or query.exit_filter != 'all_relays'):
+            return None
+        return (query.by, query.inactive, query.exits_only, query.guards_only)
+
+    def get(self, key):
+        groups = self._groups.get(key)
+        if groups is None:
+            by, inactive, exits_only, guards_only = key
+            query = Query.create(by=by, inactive=inactive, exits_only=exits_only,
+                                 guards_only=guards_only)
+            stats = RelayStats(query, snapshot=self._snapshot, engine=self._engine)
+            grouped = stats._execute()
+            groups = aggregate_groups(grouped)
+            if self._engine == "dict" and isinstance(self._snapshot.relays, list):
+                if self._rows is None:
+                    self._rows = dict((id(relay), row)
+                                      for row, relay in enumerate(self._snapshot.relays))
+                self._parts[key] = (dict(zip(grouped.iterkeys(), groups)),
+                                    dict((group, self._rows[id(relays[0])])
+                                         for group, relays in grouped.iteritems()))
+            self._groups[key] = groups
+        return groups
+
+    def _store(self, key, by_group, first_rows):
+        # Insert the groups into a dict in the order QueryPlan sees them
+        # first, so that they are visited in the same order.
+        ordered = {}
+        for group in sorted(first_rows, key=first_rows.get):
+            ordered[group] = None
+        self._groups[key] = AggregatedGroups(by_group[group] for group in ordered)
+        self._parts[key] = (by_group, first_rows)
+
+    def updated(self, snapshot, moved, removed, added):
+        """
+        Return the aggregates of snapshot, whose relays differ from this
+        one's by removed and added relays and moved rows (see
+        FamilyGraph.updated), and have its index.  The groups of the
+        removed and added relays are aggregated again, the others are
+        kept.  Only the dict engine keeps what this needs; the numpy
+        engine starts afresh, as its table is rebuilt anyway.
+        """
+        aggregates = GroupAggregates(snapshot, self._engine)
+        edited = [relay for _, relay in removed] + [relay for _, relay in added]
+        selected = {}
+        for key, (by_group, first_rows) in self._parts.iteritems():
+            by, inactive, exits_only, guards_only = key
+            column, extract = group_key_function(by[0], snapshot)
+            query = Query.create(by=by, inactive=inactive, exits_only=exits_only,
+                                 guards_only=guards_only)
+            filters = RelayStats(query, snapshot=snapshot)._filters
+            # Only groups with removed or added relays that pass the
+            # filters change.
+            groups = set(extract(relay) for relay in edited
+                         if all(f.accept(relay) for f in filters))
+            if filters:
+                if key[1:] not in selected:
+                    selected[key[1:]] = set(filters[0].lookup(snapshot)).intersection(
+                        *[f.lookup(snapshot) for f in filters[1:]])
+                passing = selected[key[1:]]
+            by_group = dict(by_group)
+            first_rows = dict((group, moved[row]) for group, row in first_rows.iteritems()
+                              if group not in groups)
+            for group in groups:
+                rows = snapshot.index.get(column, group)
+                if filters:
+                    rows = sorted(passing.intersection(rows))
+                if rows:
+                    by_group[group] = aggregate_groups({group: [snapshot.relays[row]
+                                                                for row in rows]})[0]
+                    first_rows[group] = rows[0]
+                else:
+                    by_group.pop(group, None)
+            aggregates._store(key, by_group, first_rows)
+        return aggregates
+
+    def build(self):
+        for by in self.GROUP_KEYS:
+            for flags in self.FLAG_OPTIONS:
+                self.get((by,) + flags)
+
+def filtered_label(group_keys):
+    """
+    Return what the rows of a selection grouped by group_keys are, as
+    in "(5 other relays)".
+    """
+    if not group_keys:
+        return "relays"
+    plurals = dict(GROUP_KEYS)
+    return " and ".join(plurals[name] for name in group_keys)
+
+class RelayStats(object):
+    def __init__(self, options, custom_datafile="details.json", snapshot=None,
+                 engine="dict", timings=None, memo=None):
+        options = Query.from_options(options)
+        if engine not in ENGINES:
+            raise ValueError("Unknown engine: %s" % engine)
+        if engine == "numpy" and numpy is None:
+            raise ValueError("The numpy engine requires NumPy")
+        self._engine = engine
+        self._snapshot = snapshot
+        self.timings = timings if timings is not None else util.Timings()
         self._datafile_name = custom_datafile
         self._filters = self._create_filters(options)
-        self._get_group = self._get_group_function(options)
+        group_keys = self._get_group_keys(options)
+        self._get_group = self._get_group_function(group_keys)
+        # Groups by keys other than country and AS are labelled by their
+        # values in the nickname column.
+        self._get_labels = [extract for name, (_, extract) in zip(options.by, group_keys)
+                            if name not in ('country', 'as')]
+        self._plan = QueryPlan(self._filters, self._get_group, group_keys)
+        self._aggregates_key = GroupAggregates.key(options)
+        self._memo = memo
         self._relays = None
 
+    @property
+    def snapshot(self):
+        if self._snapshot is None:
+            with self.timings.stage("load"):
+                self._snapshot = get_snapshot(self._datafile_name)
+        return self._snapshot
+
     @property
     def data(self):
-      if not self._data:
-        self._data = json.load(file(os.path.join(os.path.dirname(os.path.abspath(__file__)), self._datafile_name)))
-      return self._data
+        return {'relays_published': self.snapshot.relays_published,
+                'relays': self.snapshot.relays}
 
     @property
     def relays(self):
         if self._relays:
             return self._relays
-        self._relays = {}
-        relays = self.data['relays']
-        for f in self._filters:
-            relays = f.load(relays)
-        for relay in relays:
-            self.add_relay(relay)
+        if self._aggregates_key is not None:
+            with self.timings.stage("aggregates") as stage:
+                self._relays = self.snapshot.group_aggregates(self._engine).get(
+                    self._aggregates_key)
+                stage.rows = len(self._relays)
+        else:
+            self._relays = self._execute()
         return self._relays
 
+    def _execute(self):
+        if self._engine == "numpy":
+            with self.timings.stage("table"):
+                table = self.snapshot.table
+            return self._plan.execute_columnar(table, self.timings, self._memo)
+        return self._plan.execute(self.snapshot, self.timings, self._memo)
+
     def _create_filters(self, options):
         filters = []
         if not options.inactive:
             filters.append(RunningFilter())
         if options.family:
-            filters.append(FamilyFilter(options.family, self.data['relays']))
+            filters.append(FamilyFilter(options.family, self.snapshot))
         if options.country:
             filters.append(CountryFilter(options.country))
         if options.ases:
@@ -226,25 +2361,31 @@ class RelayStats(object):
         if options.exit_filter == 'all_relays':
             pass
         elif options.exit_filter == 'fast_exits_only':
-            filters.append(SameNetworkFilter(FastExitFilter()))
+            filters.append(SameNetworkFilter(FastExitFilter(snapshot=self.snapshot),
+                                             ipv4_prefix=options.ipv4_prefix,
+                                             ipv6_prefix=options.ipv6_prefix))
         elif options.exit_filter == 'almost_fast_exits_only':
             filters.append(FastExitFilter(ALMOST_FAST_EXIT_BANDWIDTH_RATE,
                                           ALMOST_FAST_EXIT_ADVERTISED_BANDWIDTH,
-                                          ALMOST_FAST_EXIT_PORTS))
-            filters.append(InverseFilter(SameNetworkFilter(FastExitFilter())))
+                                          ALMOST_FAST_EXIT_PORTS,
+                                          snapshot=self.snapshot))
+            filters.append(InverseFilter(SameNetworkFilter(FastExitFilter(snapshot=self.snapshot),
+                                                           ipv4_prefix=options.ipv4_prefix,
+                                                           ipv6_prefix=options.ipv6_prefix)))
         elif options.exit_filter == 'fast_exits_only_any_network':
-            filters.append(FastExitFilter())
+            filters.append(FastExitFilter(snapshot=self.snapshot))
         return filters
 
-    def _get_group_function(self, options):
-        if options.by_country and options.by_as:
-            return lambda relay: (relay.get('country', None), relay.get('as_number', None))
-        elif options.by_country:
-            return lambda relay: relay.get('country', None)
-        elif options.by_as:
-            return lambda relay: relay.get('as_number', None)
-        else:
-            return lambda relay: relay.get('fingerprint')
+    def _get_group_keys(self, options):
+        if not options.by:
+            return [('fingerprint', lambda relay: relay.fingerprint)]
+        return [group_key_function(name, self.snapshot) for name in options.by]
+
+    def _get_group_function(self, group_keys):
+        if len(group_keys) == 1:
+            return group_keys[0][1]
+        extracts = [extract for _, extract in group_keys]
+        return lambda relay: tuple([extract(relay) for extract in extracts])
 
     def add_relay(self, relay):
         key = self._get_group(relay)
@@ -289,151 +2430,359 @@ class RelayStats(object):
         print(line[:options.short])
 
     def sort_and_reduce(self, relay_set, options):
+      with self.timings.stage("sort") as stage:
+        selection = self._sort_and_reduce(relay_set, Query.from_options(options))
+        stage.rows = len(selection['results'])
+      return selection
+
+    def iter_sort_and_reduce(self, relay_set, options):
+      """
+      Like sort_and_reduce, but yield the selection row by row as
+      (kind, Result) pairs, where kind is 'result' for the selected
+      results, in order, followed by 'excluded' and 'total' for the
+      summary lines that apply.  Output can be streamed from it without
+      holding all of it.
+      """
+      return self._iter_sort_and_reduce(relay_set, Query.from_options(options))
+
+    def _sort_and_reduce(self, relay_set, options):
+      selection = {'results': [], 'excluded': None, 'total': None}
+      for kind, result in self._iter_sort_and_reduce(relay_set, options):
+        if kind == 'result':
+          selection['results'].append(result)
+        else:
+          selection[kind] = result
+      return selection
+
+    def _iter_sort_and_reduce(self, relay_set, options):
       """
       Take a set of relays (has already been grouped and
       filtered), sort it and return the ones requested
       in the 'top' option.  Add index numbers to them as well.
 
-      Returns a hash with three values: 
-        *results*: A list of Result objects representing the selected
-                   relays
-        *excluded*: A Result object representing the stats for the 
-                    filtered out relays. May be None
+      Yields the selection as (kind, Result) pairs:
+        *result*: A Result object for each of the selected relays
+        *excluded*: A Result object representing the stats for the
+                    filtered out relays, if there are any
         *total*: A Result object representing the stats for all of the
-                 relays in this filterset.
+                 relays in this filterset, unless that is all relays.
       """
-      output_relays = list()
-      excluded_relays = None
-      total_relays = None
 
       # We need a simple sorting key function
       def sort_fn(r):
         return getattr(r,options.sort)
-      
-      relay_set.sort(key=sort_fn,reverse=options.sort_reverse)
 
-      if options.top < 0:
-        options.top = len(relay_set)
+      top = options.top
+      if top < 0:
+        top = len(relay_set)
+
+      # Only the top relays need to be ordered, so pick them with a heap
+      # unless all of them are requested.  nlargest/nsmallest keep ties in
+      # input order, just like the stable sort does.
+      if top < len(relay_set):
+        if options.sort_reverse:
+          selected = heapq.nlargest(top, relay_set, key=sort_fn)
+        else:
+          selected = heapq.nsmallest(top, relay_set, key=sort_fn)
+      else:
+        selected = sorted(relay_set, key=sort_fn, reverse=options.sort_reverse)
 
       # Set up to handle the special lines at the bottom
       excluded_relays = util.Result(zero_probs=True)
       total_relays = util.Result(zero_probs=True)
-      if options.by_country and options.by_as:
-          filtered = "countries and ASes"
-      elif options.by_country:
-          filtered = "countries"
-      elif options.by_as:
-          filtered = "ASes"
-      else:
-          filtered = "relays"
+      filtered = filtered_label(options.by)
 
       # Add selected relays to the result set
-      for i,relay in enumerate(relay_set):
+      output_ids = set()
+      for i,relay in enumerate(selected):
         # We have no links if we're grouping
-        if options.by_country or options.by_as:
+        if options.by:
           relay.link = False
-
-        if i < options.top:
-          relay.index = i + 1
-          output_relays.append(relay)
-
-        if i >= options.top:
-          excluded_relays.p_guard += relay.p_guard
-          excluded_relays.p_exit += relay.p_exit
-          excluded_relays.p_middle += relay.p_middle
-          excluded_relays.adv_bw += relay.adv_bw
-          excluded_relays.cw += relay.cw
-
-        total_relays.p_guard += relay.p_guard
-        total_relays.p_exit += relay.p_exit
-        total_relays.p_middle += relay.p_middle
-        total_relays.adv_bw += relay.adv_bw
-        total_relays.cw += relay.cw
-
+        relay.index = i + 1
+        output_ids.add(id(relay))
+        yield 'result', relay
+
+      # Sum up all relays and those not selected with fsum, which does
+      # not depend on the order of the relays, so the sums come out the
+      # same to the last bit however they were selected and sorted.
+      excluded = [relay for relay in relay_set if id(relay) not in output_ids]
+      for field in ResultOrdering.WEIGHTS:
+        setattr(excluded_relays, field,
+                math.fsum(getattr(relay, field) for relay in excluded))
+        setattr(total_relays, field,
+                math.fsum(getattr(relay, field) for relay in relay_set))
+
+      if relay_set:
         excluded_relays.nick = "(%d other %s)" % (
-                                  len(relay_set) - options.top,
+                                  len(relay_set) - top,
                                   filtered)
         total_relays.nick = "(total in selection)"
 
       # Only include the excluded line if
-      if len(relay_set) <= options.top:
-        excluded_relays = None
+      if len(relay_set) > top:
+        yield 'excluded', excluded_relays
 
       # Only include the last line if
-      if total_relays.cw > 99.9:
-        total_relays = None
-
-      return {
-              'results': output_relays,
-              'excluded': excluded_relays,
-              'total': total_relays
-              }
+      if total_relays.cw <= 99.9:
+        yield 'total', total_relays
 
 
     def select_relays(self, grouped_relays, options): 
       """
       Return a Pythonic representation of the relays result set. Return it as a set of Result objects.
       """
-      results = []
-      for group in grouped_relays.itervalues():
-        #Initialize some stuff
-        group_weights = dict.fromkeys(RelayStats.WEIGHTS, 0)
-        relays_in_group, exits_in_group, guards_in_group = 0, 0, 0
-        ases_in_group = set()
-        result = util.Result()
-        for relay in group:
-            for weight in RelayStats.WEIGHTS:
-                group_weights[weight] += relay.get(weight, 0)
+      with self.timings.stage("select") as stage:
+        results = self._select_relays(grouped_relays, Query.from_options(options))
+        stage.rows = len(results)
+      return results
 
-            result.nick = relay['nickname']
-            result.fp = relay['fingerprint']
-            result.link = options.links
+    def _select_relays(self, grouped_relays, options):
+      if not isinstance(grouped_relays, AggregatedGroups):
+        grouped_relays = aggregate_groups(grouped_relays)
+      return [self._group_result(*group, options=options) for group in grouped_relays]
 
-            if 'Exit' in set(relay['flags']) and not 'BadExit' in set(relay['flags']):
-                result.exit = 'Exit'
-                exits_in_group += 1
-            else:
-                result.exit = '-'
-            if 'Guard' in set(relay['flags']):
-                result.guard = 'Guard'
-                guards_in_group += 1
-            else:
-                result.guard = '-'
-            result.cc = relay.get('country', '??').upper()
-            result.as_no = relay.get('as_number', '??')
-            result.as_name = relay.get('as_name', '??')
-            result.as_info = "%s %s" %(result.as_no, result.as_name)
-            ases_in_group.add(result.as_info)
-            relays_in_group += 1
-
-        # If we want to group by things, we need to handle some fields
-        # specially
-        if options.by_country or options.by_as:
-            result.nick = "*"
-            result.fp = "(%d relays)" % relays_in_group
-            result.exit = "(%d)" % exits_in_group
-            result.guard = "(%d)" % guards_in_group
-            if not options.by_as and not options.ases:
-                result.as_info = "(%s)" % len(ases_in_group)
-            if not options.by_country and not options.country:
-                options.country = "*"
-
-        #Include our weight values
-        for weight in group_weights.iterkeys():
-          result['cw'] = group_weights['consensus_weight_fraction'] * 100.0
-          result['adv_bw'] = group_weights['advertised_bandwidth_fraction'] * 100.0
-          result['p_guard'] = group_weights['guard_probability'] * 100.0
-          result['p_middle'] = group_weights['middle_probability'] * 100.0
-          result['p_exit'] = group_weights['exit_probability'] * 100.0
-
-        results.append(result)
-
-      return results
+    def _group_result(self, relay, group_weights, relays_in_group, exits_in_group,
+                      guards_in_group, ases_in_group, options):
+      """
+      Build the Result for a group of relays from its last relay and its
+      aggregates.
+      """
+      result = util.Result()
+      result.nick = relay.nickname
+      result.fp = relay.fingerprint
+      result.link = options.links
+
+      mask = _position_mask(relay.flags)
+      if mask & EXIT_BIT:
+          result.exit = 'Exit'
+      else:
+          result.exit = '-'
+      if mask & GUARD_BIT:
+          result.guard = 'Guard'
+      else:
+          result.guard = '-'
+      result.cc = getattr(relay, 'country', '??').upper()
+      result.as_no = getattr(relay, 'as_number', '??')
+      result.as_name = getattr(relay, 'as_name', '??')
+      result.as_info = "%s %s" %(result.as_no, result.as_name)
+
+      # If we want to group by things, we need to handle some fields
+      # specially
+      if options.by:
+          result.nick = "*"
+          if self._get_labels:
+              result.nick = ", ".join(label(relay) or "??" for label in self._get_labels)
+          result.fp = "(%d relays)" % relays_in_group
+          result.exit = "(%d)" % exits_in_group
+          result.guard = "(%d)" % guards_in_group
+          if not options.by_as and not options.ases:
+              result.as_info = "(%s)" % ases_in_group
+
+      #Include our weight values
+      result['cw'] = group_weights['consensus_weight_fraction'] * 100.0
+      result['adv_bw'] = group_weights['advertised_bandwidth_fraction'] * 100.0
+      result['p_guard'] = group_weights['guard_probability'] * 100.0
+      result['p_middle'] = group_weights['middle_probability'] * 100.0
+      result['p_exit'] = group_weights['exit_probability'] * 100.0
+
+      return result
+
+def run_query(query, snapshot, engine="dict", timings=None, memo=None):
+    """
+    Answer query against snapshot and return the JSON encoded selection.
+    """
+    stats = RelayStats(query, snapshot=snapshot, engine=engine, timings=timings, memo=memo)
+    # Queries that only differ in how they are sorted and cut share their
+    # results.  sort_and_reduce numbers the results it picks, which is
+    # fine as they are encoded right away.
+    results = _memoized(memo, ('results', engine, query.selection(), query.by, query.links),
+                        lambda: stats.select_relays(stats.relays, query))
+    selection = stats.sort_and_reduce(results, query)
+    with stats.timings.stage("encode"):
+        return json.dumps(selection, cls=util.ResultEncoder)
+
+def stream_query(query, snapshot, output_format, engine="dict", timings=None):
+    """
+    Answer query against snapshot and return a generator of its
+    selection encoded in output_format, one of util.STREAM_FORMATS,
+    line by line.  Results are encoded as they are picked, and the
+    excluded and total lines come last.
+    """
+    encode, _ = util.STREAM_FORMATS[output_format]
+    stats = RelayStats(query, snapshot=snapshot, engine=engine, timings=timings)
+    results = stats.select_relays(stats.relays, query)
+    return encode(stats.iter_sort_and_reduce(results, query))
+
+class StaleCursor(ValueError):
+    """
+    A cursor issued against a snapshot that has since been replaced.
+    """
+
+class ResultOrdering(object):
+    """
+    All results of a query in sorted order and numbered, with running
+    sums of their weights, so that a page of them and the weight of the
+    results around it take time in the size of the page only.
+    """
+    WEIGHTS = ('cw', 'adv_bw', 'p_guard', 'p_exit', 'p_middle')
+
+    def __init__(self, results, query):
+        self.results = sorted(results, key=operator.attrgetter(query.sort),
+                              reverse=query.sort_reverse)
+        self._filtered = filtered_label(query.by)
+        sums = [0.0] * len(self.WEIGHTS)
+        self._sums = [tuple(sums)]
+        for i, result in enumerate(self.results):
+            if query.by:
+                result.link = False
+            result.index = i + 1
+            for j, field in enumerate(self.WEIGHTS):
+                sums[j] += getattr(result, field)
+            self._sums.append(tuple(sums))
+        # The total is summed with fsum, like sort_and_reduce does.
+        self.total = util.Result(zero_probs=True)
+        for field in self.WEIGHTS:
+            setattr(self.total, field, math.fsum(getattr(result, field) for result in results))
+        if results:
+            self.total.nick = "(total in selection)"
+
+    def __len__(self):
+        return len(self.results)
+
+    def page(self, offset, limit):
+        """
+        Return the selection of the results from offset to offset +
+        limit, with the same keys as that of sort_and_reduce.
+        """
+        end = min(offset + limit, len(self.results))
+        offset = min(offset, end)
+        results = self.results[offset:end]
+        excluded = None
+        if len(results) < len(self.results):
+            excluded = util.Result(zero_probs=True)
+            for field, total, before, after in zip(self.WEIGHTS, self._sums[-1],
+                                                   self._sums[offset], self._sums[end]):
+                setattr(excluded, field, total - (after - before))
+            excluded.nick = "(%d other %s)" % (len(self.results) - len(results), self._filtered)
+        return {
+                'results': results,
+                'excluded': excluded,
+                'total': self.total if self.total.cw <= 99.9 else None
+                }
+
+def encode_cursor(snapshot, query, offset, limit):
+    """
+    Return an opaque cursor for the page of query's results from offset
+    to offset + limit against snapshot.  Snapshots of the same version
+    have their relays in the same order, whether they were loaded or
+    updated, so the cursor can be followed on any worker.
+    """
+    state = json.dumps([snapshot.version, offset, limit, query._asdict()],
+                       separators=(',', ':'))
+    return base64.urlsafe_b64encode(zlib.compress(state)).rstrip("=")
+
+def decode_cursor(cursor, snapshot):
+    """
+    Return the query, offset and limit of the page cursor points to.
+    Raises StaleCursor if the cursor was issued against another snapshot
+    and ValueError if it is not a cursor at all.
+    """
+    try:
+        cursor = str(cursor)
+        state = zlib.decompress(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        version, offset, limit, values = json.loads(state)
+        query = Query.from_dict(values)
+    except (TypeError, ValueError, zlib.error):
+        raise ValueError("Not a valid cursor: %s" % cursor)
+    if version != snapshot.version:
+        raise StaleCursor("The cursor is for relays published before %s, start over" %
+                          snapshot.relays_published)
+    return query, offset, limit
+
+def page_query(query, snapshot, offset, limit, engine="dict", timings=None):
+    """
+    Answer query against snapshot with the limit results from offset on,
+    ignoring its top, and return the JSON encoded selection.  Besides
+    the keys of run_query's, it has the offset of the page, the number
+    of results there are and a cursor for the next page, or None.  The
+    sorted results are kept with the snapshot, so later pages only cost
+    their size.
+    """
+    if (not isinstance(offset, (int, long)) or not isinstance(limit, (int, long))
+        or offset < 0 or limit < 1):
+        raise ValueError("Need an offset of 0 or more and a limit of 1 or more")
+    if timings is None:
+        timings = util.Timings()
+    def compute():
+        stats = RelayStats(query, snapshot=snapshot, engine=engine, timings=timings)
+        results = stats.select_relays(stats.relays, query)
+        with timings.stage("sort") as stage:
+            ordering = ResultOrdering(results, query)
+            stage.rows = len(ordering)
+        return ordering
+    ordering = snapshot.ordering(('ordering', engine, query.selection(), query.by, query.links,
+                                  query.sort, query.sort_reverse), compute)
+    with timings.stage("page"):
+        selection = ordering.page(offset, limit)
+    selection['offset'] = offset
+    selection['count'] = len(ordering)
+    selection['next'] = None
+    if offset + limit < len(ordering):
+        selection['next'] = encode_cursor(snapshot, query, offset + limit, limit)
+    with timings.stage("encode"):
+        return json.dumps(selection, cls=util.ResultEncoder)
+
+def _run_batch(queries, snapshot, engine, timings):
+    memo = {}
+    return [run_query(query, snapshot, engine, timings, memo) for query in queries]
+
+# The snapshot and engine of a batch worker process.
+_worker = None
+
+def _init_worker(snapshot, engine):
+    global _worker
+    _worker = (snapshot, engine)
+
+def _run_worker_batch(queries):
+    snapshot, engine = _worker
+    return _run_batch(queries, snapshot, engine, util.Timings())
+
+def run_queries(queries, snapshot, engine="dict", timings=None, processes=0):
+    """
+    Answer a batch of queries against snapshot and return their JSON
+    encoded selections in order.  Queries with common filters share the
+    index lookups, masks and selections of those filters.  With more than
+    one process, queries are spread over a pool of forked worker
+    processes, which inherit snapshot, keeping queries that select the
+    same relays together.
+    """
+    if timings is None:
+        timings = util.Timings()
+    if processes <= 1 or len(queries) < 2:
+        return _run_batch(queries, snapshot, engine, timings)
+    batches = OrderedDict()
+    for position, query in enumerate(queries):
+        batches.setdefault(query.selection(), []).append(position)
+    with timings.stage("pool", "%d batches, %d processes" % (len(batches), processes)):
+        pool = multiprocessing.Pool(processes, _init_worker, (snapshot, engine))
+        try:
+            outputs = pool.map(_run_worker_batch, [[queries[position] for position in positions]
+                                                   for positions in batches.itervalues()])
+        finally:
+            pool.terminate()
+            pool.join()
+    results = [None] * len(queries)
+    for positions, batch in zip(batches.itervalues(), outputs):
+        for position, output in zip(positions, batch):
+            results[position] = output
+    return results
 
 def create_option_parser():
     parser = OptionParser()
     parser.add_option("-d", "--download", action="store_true",
                       help="download details.json from Onionoo service")
+    parser.add_option("--used-fields-only", action="store_true",
+                      help="with --download, only fetch the relay fields compass uses")
     group = OptionGroup(parser, "Filtering options")
     group.add_option("-i", "--inactive", action="store_true", default=False,
                      help="include relays in selection that aren't currently running")
@@ -449,9 +2798,7 @@ def create_option_parser():
     group.add_option("-g", "--guards-only", action="store_true",
                      help="select only relays suitable for guard position")
     group.add_option("--exit-filter",type="choice", dest="exit_filter",
-                     choices=["fast_exits_only","almost_fast_exits_only",
-                              "all_relays","fast_exits_only_any_network"],
-                              metavar="{fast_exits_only|almost_fast_exits_only|all_relays|fast_exits_only_any_network}",
+                     choices=EXIT_FILTERS, metavar="{%s}" % "|".join(EXIT_FILTERS),
                      default='all_relays')
     group.add_option("--fast-exits-only", action="store_true",
                      help="select only fast exits (%d+ Mbit/s, %d+ KB/s, %s, %d- per /24)" %
@@ -469,18 +2816,25 @@ def create_option_parser():
                           (FAST_EXIT_BANDWIDTH_RATE / (125 * 1024),
                            FAST_EXIT_ADVERTISED_BANDWIDTH / 1024,
                            '/'.join(map(str, FAST_EXIT_PORTS))))
+    group.add_option("--ipv4-prefix", type="int", default=FAST_EXIT_IPV4_PREFIX, metavar="BITS",
+                     help="with fast exit filters, limit fast exits per IPv4 /BITS network "
+                          "(default: %default)")
+    group.add_option("--ipv6-prefix", type="int", default=FAST_EXIT_IPV6_PREFIX, metavar="BITS",
+                     help="with fast exit filters, also limit fast exits per IPv6 /BITS network, "
+                          "e.g. 32 or 48 (default: %default, no limit)")
     parser.add_option_group(group)
     group = OptionGroup(parser, "Grouping options")
     group.add_option("-A", "--by-as", action="store_true", default=False,
                      help="group relays by AS")
     group.add_option("-C", "--by-country", action="store_true", default=False,
                      help="group relays by country")
+    group.add_option("--by", action="append", metavar="KEY",
+                     help="group relays by KEY, one of %s (repeat or separate with "
+                          "commas to group by several keys)" % ", ".join(GROUP_KEY_NAMES))
     parser.add_option_group(group)
     group = OptionGroup(parser, "Sorting options")
     group.add_option("--sort", type="choice",
-                     choices=["cw","adv_bw","p_guard","p_exit","p_middle",
-                              "nick","fp"],
-                     metavar="{cw|adv_bw|p_guard|p_exit|p_middle|nick|fp}",
+                     choices=SORT_KEYS, metavar="{%s}" % "|".join(SORT_KEYS),
                      default="cw",
                      help="sort by this field")
     group.add_option("--sort_reverse", action="store_true", default=True, 
@@ -496,17 +2850,130 @@ def create_option_parser():
                      help="cut the length of the line output at 70 chars")
     group.add_option("-j", "--json", action="store_true",
                      help="output in JSON rather than human-readable format")
+    group.add_option("--stream", type="choice", choices=list(util.STREAM_FORMATS),
+                     metavar="{%s}" % "|".join(util.STREAM_FORMATS),
+                     help="write the results line by line in this format as they are "
+                          "selected, followed by the excluded and total lines")
     group.add_option("--datafile", default="details.json",
                      help="use a custom datafile (Default: 'details.json')")
+    group.add_option("--no-cache", action="store_false", dest="cache", default=True,
+                     help="do not read or write the binary cache of the datafile")
+    group.add_option("--engine", type="choice", choices=ENGINES, default="dict",
+                     metavar="{%s}" % "|".join(ENGINES),
+                     help="evaluate queries with this engine (default: %default)")
+    group.add_option("--profile", action="store_true",
+                     help="print the time spent in each stage of the query to stderr")
+    group.add_option("--changes-since", metavar="FILE",
+                     help="summarize how the relays of the datafile differ from those of the "
+                          "earlier details document FILE")
+    group.add_option("--list-families", action="store_true",
+                     help="list all families of two or more relays with their consensus weight")
+    group.add_option("--queries", metavar="FILE",
+                     help="answer the queries in FILE, a JSON list of objects with the fields "
+                          "of the web interface's queries, and print their results as JSON")
+    group.add_option("--processes", type="int", default=0, metavar="NUM",
+                     help="with --queries, spread the queries over NUM worker processes")
     parser.add_option_group(group)
     return parser
 
-def download_details_file():
-    url = urllib.urlopen('https://onionoo.torproject.org/details?type=relay')
-    details_file = open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'details.json'), 'w')
-    details_file.write(url.read())
-    url.close()
-    details_file.close()
+def details_url(url=DETAILS_URL, fields=None):
+    """
+    Return url restricted to fields with Onionoo's fields parameter.
+    """
+    if not fields:
+        return url
+    return "%s%sfields=%s" % (url, "&" if "?" in url else "?", ",".join(fields))
+
+def _validators_path(path):
+    return path + ".meta"
+
+def _load_validators(path, url):
+    """
+    Return the Last-Modified and ETag values of the download of url
+    that path holds, or an empty dict if path came from elsewhere.
+    """
+    try:
+        with open(_validators_path(path)) as validators_file:
+            validators = json.load(validators_file)
+        if validators['url'] != url or validators['source_key'] != list(_source_key(path)):
+            return {}
+    except (IOError, OSError, ValueError, KeyError):
+        return {}
+    return validators
+
+def _download(url, path):
+    """
+    Download url into a new file next to path, asking for gzip and
+    decompressing while writing, and return its name and the response's
+    validators.  Responses that break off or do not decompress raise
+    IOError.  If path holds an earlier download of url, the request
+    is conditional and None is returned when it is still up to date.
+    """
+    request = urllib2.Request(url, headers={'Accept-Encoding': 'gzip'})
+    previous = _load_validators(path, url)
+    if previous.get('last_modified'):
+        request.add_header('If-Modified-Since', previous['last_modified'])
+    if previous.get('etag'):
+        request.add_header('If-None-Match', previous['etag'])
+    try:
+        response = urllib2.urlopen(request)
+    except urllib2.HTTPError, e:
+        if e.code == 304:
+            return None
+        raise
+    except httplib.HTTPException, e:
+        raise IOError("Broken response from %s: %r" % (url, e))
+    try:
+        headers = response.info()
+        decompressor = None
+        if headers.get('Content-Encoding') == 'gzip':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        fd, tmp_path = tempfile.mkstemp(prefix=".%s-" % os.path.basename(path),
+                                        dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                for chunk in iter(lambda: response.read(DOWNLOAD_CHUNK_SIZE), ''):
+                    if decompressor:
+                        chunk = decompressor.decompress(chunk)
+                    tmp_file.write(chunk)
+                if decompressor:
+                    tmp_file.write(decompressor.flush())
+            os.chmod(tmp_path, 0644)
+        except (zlib.error, httplib.HTTPException), e:
+            # Broken responses fail like any other I/O error, so that a
+            # refresh can be tried again.
+            os.unlink(tmp_path)
+            raise IOError("Broken response from %s: %r" % (url, e))
+        except:
+            os.unlink(tmp_path)
+            raise
+    finally:
+        response.close()
+    return tmp_path, {'url': url, 'last_modified': headers.get('Last-Modified'),
+                      'etag': headers.get('ETag')}
+
+def _install_download(tmp_path, path, validators):
+    """
+    Replace path with the download in tmp_path and remember its
+    validators for the next conditional request.
+    """
+    os.rename(tmp_path, path)
+    validators = dict(validators, source_key=list(_source_key(path)))
+    with open(_validators_path(path), 'w') as validators_file:
+        json.dump(validators, validators_file)
+
+def download_details_file(url=DETAILS_URL, datafile="details.json", fields=None):
+    """
+    Download datafile from url, optionally with only the given fields.
+    The old datafile stays in place until the download is complete.
+    Returns False if datafile was already up to date.
+    """
+    path = datafile_path(datafile)
+    download = _download(details_url(url, fields), path)
+    if download is None:
+        return False
+    _install_download(download[0], path, download[1])
+    return True
 
 def fix_exit_filter_options(options):
   """
@@ -548,19 +3015,80 @@ if '__main__' == __name__:
         parser.error("Can only filter by one fast-exit option.")
 
     if options.download:
-        download_details_file()
-        print "Downloaded details.json.  Re-run without --download option."
+        if download_details_file(datafile=options.datafile,
+                                 fields=DETAILS_FIELDS if options.used_fields_only else None):
+            print "Downloaded %s.  Re-run without --download option." % options.datafile
+        else:
+            print "%s is up to date.  Re-run without --download option." % options.datafile
+        exit()
+    if not os.path.exists(datafile_path(options.datafile)):
+        parser.error("Did not find %s.  Re-run with --download." % options.datafile)
+
+    if options.changes_since:
+        try:
+            previous = RelaySnapshot.load(options.changes_since)
+            _, changes = previous.update_from(datafile_path(options.datafile))
+        except (IOError, OSError, ValueError), e:
+            parser.error("Cannot compare with %s: %s" % (options.changes_since, e))
+        print(changes.summary())
         exit()
-    if not os.path.exists(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'details.json')):
-        parser.error("Did not find details.json.  Re-run with --download.")
 
-    stats = RelayStats(options,options.datafile)
-    results = stats.select_relays(stats.relays,options)
+    if options.list_families:
+        families = get_snapshot(options.datafile, options.cache).family_graph.families()
+        if options.top >= 0:
+            families = families[:options.top]
+        for family in families:
+            line = "%.4f%%   %-5d %s" % (family_weight(family) * 100.0, len(family),
+                                         ", ".join(relay.nickname for relay in family))
+            print(line[:options.short])
+        exit()
 
-    sorted_results = stats.sort_and_reduce(results,options)
+    if options.engine == "numpy" and numpy is None:
+        parser.error("The numpy engine requires NumPy.")
+
+    if options.queries:
+        try:
+            queries = [Query.from_dict(values) for values in json.load(open(options.queries))]
+        except (IOError, ValueError), e:
+            parser.error("Cannot read queries from %s: %s" % (options.queries, e))
+        timings = util.Timings()
+        with timings.stage("load"):
+            snapshot = get_snapshot(options.datafile, options.cache)
+        outputs = run_queries(queries, snapshot, options.engine, timings, options.processes)
+        print("[%s]" % ", ".join(outputs))
+        if options.profile:
+            sys.stderr.write(timings.report() + "\n")
+        exit()
+
+    try:
+        query = Query.from_options(options)
+    except ValueError, e:
+        parser.error(str(e))
+    timings = util.Timings()
+    with timings.stage("load"):
+        snapshot = get_snapshot(options.datafile, options.cache)
+    if options.stream:
+        lines = stream_query(query, snapshot, options.stream, options.engine, timings)
+        with timings.stage("stream"):
+            for line in lines:
+                sys.stdout.write(line)
+        if options.profile:
+            sys.stderr.write(timings.report() + "\n")
+        exit()
+    stats = RelayStats(query, snapshot=snapshot, engine=options.engine,
+                       timings=timings)
+    results = stats.select_relays(stats.relays, query)
+
+    sorted_results = stats.sort_and_reduce(results, query)
 
     if options.json:
-      print(json.dumps(sorted_results,cls=util.ResultEncoder))
+      with timings.stage("encode"):
+        output = json.dumps(sorted_results,cls=util.ResultEncoder)
+      print(output)
     else:
-      stats.print_selection(sorted_results,options)
+      with timings.stage("print"):
+        stats.print_selection(sorted_results,options)
+
+    if options.profile:
+      sys.stderr.write(timings.report() + "\n")
 
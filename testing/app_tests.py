@@ -1,11 +1,16 @@
+import os
+import shutil
+import tempfile
 import unittest
+import warnings
 import json
-from app import app
+from app import app, result_cache
 
 class TestCase(unittest.TestCase):
   def setUp(self):
     app.config['TESTING'] = True
     app.config["TESTING_DATAFILE"] = "testing/testdata.json"
+    result_cache.clear()
     self.app = app.test_client()
 
   def tearDown(self):
@@ -18,6 +23,10 @@ class TestCase(unittest.TestCase):
     self.assertItemsEqual(received,expected)
 
 
+  def test_invalid_values(self):
+    for params in ["country=5", "country=[5]", "country={\"de\": 1}"]:
+      self.assertEqual(self.app.get("/result.json?" + params).status_code, 400)
+
   def test_select_nonexistent_AS(self):
     received= json.loads(self.app.get("/result.json?ases=AS3320").data)
     expected = json.loads(
@@ -58,5 +67,118 @@ class TestCase(unittest.TestCase):
     expected = json.loads(open("testing/expectations/top5.expected").read())
     self.assertItemsEqual(received,expected)
 
+  def test_server_timing(self):
+    response = self.app.get("/result.json?top=5")
+    stages = [metric.split(";")[0] for metric in response.headers['Server-Timing'].split(", ")]
+    self.assertEqual(stages[0], "load")
+    self.assertTrue("select" in stages)
+    self.assertEqual(stages[-1], "encode")
+
+  def test_result_cache(self):
+    before = result_cache.stats()
+    first = self.app.get("/result.json?top=5&country=[\"de\",\"us\"]")
+    second = self.app.get("/result.json?country=[\"US\",\"de\"]&top=5")
+    self.assertEqual(first.data, second.data)
+    self.assertEqual(first.headers['ETag'], second.headers['ETag'])
+    self.assertTrue('cache;dur=' in second.headers['Server-Timing'])
+    self.assertTrue('desc="hit"' in second.headers['Server-Timing'])
+    stats = result_cache.stats()
+    self.assertEqual(stats['hits'] - before['hits'], 1)
+    self.assertEqual(stats['misses'] - before['misses'], 1)
+    self.assertEqual(stats['entries'], 1)
+
+  def test_conditional_request(self):
+    etag = self.app.get("/result.json?top=5").headers['ETag']
+    response = self.app.get("/result.json?top=5", headers={'If-None-Match': etag})
+    self.assertEqual(response.status_code, 304)
+    self.assertEqual(response.data, "")
+    response = self.app.get("/result.json?top=4", headers={'If-None-Match': etag})
+    self.assertEqual(response.status_code, 200)
+
+  def test_profile(self):
+    profile_dir = tempfile.mkdtemp()
+    app.config['PROFILE_DIR'] = profile_dir
+    try:
+      response = self.app.get("/result.json?top=5&profile=1")
+      self.assertEqual(len(json.loads(response.data)['results']), 5)
+      self.assertEqual(len(os.listdir(profile_dir)), 1)
+    finally:
+      del app.config['PROFILE_DIR']
+      shutil.rmtree(profile_dir)
+
+  def test_batch_results(self):
+    queries = [{"top": 5}, {"ases": ["AS7922"]}, {"by_country": True, "top": -1}]
+    cached = self.app.get("/result.json?top=5").data
+    response = self.app.post("/results.json", data=json.dumps(queries))
+    received = json.loads(response.data)
+    self.assertEqual(len(received), 3)
+    self.assertEqual(received[0], json.loads(cached))
+    self.assertEqual(received[1], json.loads(self.app.get("/result.json?ases=AS7922").data))
+    self.assertTrue('desc="3 queries, 1 cached"' in response.headers['Server-Timing'])
+    self.assertEqual(result_cache.stats()['entries'], 3)
+
+  def test_batch_single_as(self):
+    response = self.app.post("/results.json", data='[{"ases": "AS7922"}]')
+    self.assertEqual(json.loads(response.data)[0],
+                     json.loads(self.app.get("/result.json?ases=AS7922").data))
+
+  def test_invalid_batch(self):
+    for data in ['{"top": 5}', '[{"by": "nickname"}]', 'not json', '[{"family": 5}]',
+                 '[{"sort": "bogus"}]', '[{"exit_filter": "nope"}]',
+                 '[{"sort_reverse": "false"}]', '[{"links": "x"}]', '[{"ases": [7922]}]']:
+      self.assertEqual(self.app.post("/results.json", data=data).status_code, 400)
+
+  def test_stream_results(self):
+    expected = json.loads(self.app.get("/result.json?top=5").data)
+    response = self.app.get("/result.ndjson?top=5")
+    self.assertEqual(response.mimetype, "application/x-ndjson")
+    lines = response.data.splitlines()
+    self.assertEqual(json.loads(lines[0]), expected['results'][0])
+    self.assertEqual(json.loads(lines[-1]), {'total': expected['total']})
+    response = self.app.get("/result.csv?top=5")
+    self.assertEqual(response.mimetype, "text/csv")
+    self.assertEqual(len(response.data.splitlines()), len(lines) + 1)
+    self.assertEqual(self.app.get("/result.csv?by=nickname").status_code, 400)
+    self.assertEqual(self.app.get("/result.csv?sort=bogus").status_code, 400)
+    self.assertEqual(self.app.get("/result.ndjson?country=[5]").status_code, 400)
+
+  def test_paged_results(self):
+    expected = json.loads(self.app.get("/result.json?top=-1").data)['results']
+    page = json.loads(self.app.get("/result.json?offset=2&limit=3").data)
+    self.assertEqual(page['results'], expected[2:5])
+    page = json.loads(self.app.get("/result.json?cursor=%s" % page['next']).data)
+    self.assertEqual(page['results'], expected[5:8])
+    for params in ["limit=0", "limit=ten", "offset=-1&limit=5", "cursor=garbage",
+                   "limit=5&sort=bogus", "limit=5&exit_filter=nope", "limit=5&country=5"]:
+      self.assertEqual(self.app.get("/result.json?" + params).status_code, 400)
+
+  def test_shared_snapshot_needs_numpy(self):
+    tmpdir = tempfile.mkdtemp()
+    try:
+      datafile = os.path.join(tmpdir, "details.json")
+      shutil.copy("testing/testdata.json", datafile)
+      app.config["TESTING_DATAFILE"] = datafile
+      app.config["COMPASS_SHARED_SNAPSHOT"] = True
+      with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        self.assertEqual(self.app.get("/result.json").status_code, 200)
+      self.assertEqual([w.category for w in caught], [RuntimeWarning])
+    finally:
+      del app.config["COMPASS_SHARED_SNAPSHOT"]
+      shutil.rmtree(tmpdir)
+
+  def test_stale_cursor(self):
+    tmpdir = tempfile.mkdtemp()
+    try:
+      datafile = os.path.join(tmpdir, "details.json")
+      shutil.copy("testing/testdata.json", datafile)
+      app.config["TESTING_DATAFILE"] = datafile
+      cursor = json.loads(self.app.get("/result.json?limit=3").data)['next']
+      self.assertEqual(self.app.get("/result.json?cursor=" + cursor).status_code, 200)
+      os.utime(datafile, (0, 0))
+      self.assertEqual(self.app.get("/result.json?cursor=" + cursor).status_code, 410)
+    finally:
+      shutil.rmtree(tmpdir)
+
 if __name__ == '__main':
   unittest.main()
@@ -0,0 +1,129 @@
+#!/usr/bin/python
+"""
+Benchmark compass on synthetic details documents of different sizes.
+
+For every size a document is generated (see testing/generate.py) and
+the time to load it, to build the snapshot's derived structures and to
+run each option combination of testing/test.sh is measured, broken down
+into filters, selection, select_relays, sort_and_reduce and JSON
+encoding.  Results are written as JSON so runs can be compared:
+
+  python -m testing.benchmark --sizes 1000,10000,100000 -o before.json
+
+Each stage is run --repeat times and the fastest time (in seconds) is
+reported.
+"""
+
+import json
+import os
+import re
+import shlex
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+import compass
+import util
+from testing import generate
+
+TEST_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test.sh")
+
+def option_matrix():
+  """
+  Return the option combinations exercised by testing/test.sh as lists
+  of command line arguments.
+  """
+  script = open(TEST_SCRIPT).read()
+  cases = re.search(r"testcases=\((.*?)\n\s*\)", script, re.S).group(1)
+  return [shlex.split(case) for case in shlex.split(cases)]
+
+def parse_options(args):
+  options, _ = compass.create_option_parser().parse_args(args)
+  return compass.fix_exit_filter_options(options)
+
+def timed(fn, repeat, setup=None):
+  """
+  Call fn repeat times and return the fastest time and the last result.
+  If setup is given, its (untimed) result is passed to fn.
+  """
+  best, result = None, None
+  for _ in xrange(repeat):
+    args = (setup(),) if setup else ()
+    start = time.time()
+    result = fn(*args)
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best, result
+
+def benchmark_case(snapshot, args, engine, repeat):
+  timings = {'filters': {}}
+  options = parse_options(args)
+  stats = compass.RelayStats(options, snapshot=snapshot, engine=engine)
+  for f in stats._filters:
+    timings['filters'][f.describe()], _ = timed(lambda: f.load(snapshot.relays), repeat)
+
+  def select():
+    return compass.RelayStats(options, snapshot=snapshot, engine=engine).relays
+  timings['selection'], grouped = timed(select, repeat)
+  timings['select_relays'], results = timed(lambda: stats.select_relays(grouped, options),
+                                            repeat)
+
+  # sort_and_reduce numbers the results it selects, so start afresh.
+  timings['sort_and_reduce'], selection = timed(lambda r: stats.sort_and_reduce(r, options),
+                                                repeat,
+                                                lambda: stats.select_relays(grouped, options))
+  timings['json'], _ = timed(lambda: json.dumps(selection, cls=util.ResultEncoder), repeat)
+  timings['results'] = len(results)
+  return timings
+
+def benchmark_size(size, seed, engine, repeat, tmpdir):
+  path = os.path.join(tmpdir, "details-%d.json" % size)
+  generate.write_document(size, path, seed)
+  run = {'size': size, 'bytes': os.path.getsize(path), 'build': {}, 'cases': []}
+  run['build']['load'], snapshot = timed(lambda: compass.RelaySnapshot.load(path), repeat)
+  structures = ['index', 'exit_policies', 'family_graph']
+  if engine == 'numpy':
+    structures.append('table')
+  for name in structures:
+    attribute = '_%s' % name
+    def build():
+      setattr(snapshot, attribute, None)
+      return getattr(snapshot, name)
+    run['build'][name], _ = timed(build, repeat)
+  for args in option_matrix():
+    case = benchmark_case(snapshot, args, engine, repeat)
+    case['args'] = " ".join(args)
+    run['cases'].append(case)
+  return run
+
+def run(sizes, seed=1, engine='dict', repeat=3):
+  report = {'python': sys.version.split()[0], 'engine': engine, 'seed': seed,
+            'repeat': repeat, 'runs': []}
+  tmpdir = tempfile.mkdtemp()
+  try:
+    for size in sizes:
+      sys.stderr.write("Benchmarking %d relays\n" % size)
+      report['runs'].append(benchmark_size(size, seed, engine, repeat, tmpdir))
+  finally:
+    shutil.rmtree(tmpdir)
+  return report
+
+if __name__ == "__main__":
+  parser = OptionParser()
+  parser.add_option("--sizes", default="1000,10000,50000",
+                    help="comma separated document sizes (default: %default)")
+  parser.add_option("--seed", type="int", default=1, help="random seed (default: %default)")
+  parser.add_option("--engine", type="choice", choices=compass.ENGINES, default="dict",
+                    help="compass engine to benchmark (default: %default)")
+  parser.add_option("--repeat", type="int", default=3,
+                    help="runs per stage, the fastest is reported (default: %default)")
+  parser.add_option("-o", "--output", metavar="FILE", help="write to FILE instead of stdout")
+  options, args = parser.parse_args()
+  report = run([int(size) for size in options.sizes.split(",")], options.seed,
+               options.engine, options.repeat)
+  output = open(options.output, "w") if options.output else sys.stdout
+  json.dump(report, output, indent=2, sort_keys=True)
+  output.write("\n")
@@ -0,0 +1,30 @@
+#!/usr/bin/python
+"""
+Time the almost_fast_exits_only selection, which runs an InverseFilter
+over the whole relay set, against synthetic documents of growing size.
+Run from the compass directory:
+
+  python -m testing.benchmark_inverse [SIZE ...]
+
+The time per relay should stay roughly constant as the size grows.
+"""
+
+import sys
+import time
+import compass
+from app import Opt
+from testing import generate
+
+def run(sizes):
+  options = Opt({'exit_filter': 'almost_fast_exits_only'})
+  for size in sizes:
+    snapshot = compass.RelaySnapshot(generate.document(size))
+    start = time.time()
+    stats = compass.RelayStats(options, snapshot=snapshot)
+    selected = len(stats.relays)
+    elapsed = time.time() - start
+    print "%7d relays: %8.3fs  %6.2fus/relay  (%d selected)" % (
+      size, elapsed, elapsed * 1000000 / size, selected)
+
+if __name__ == "__main__":
+  run([int(x) for x in sys.argv[1:]] or [5000, 10000, 20000, 50000, 100000])
@@ -0,0 +1,55 @@
+#!/usr/bin/python
+"""
+Measure the memory held per relay by a parsed details document and by
+the Relay records compass keeps of it.  Run from the compass directory:
+
+  python -m testing.benchmark_memory [SIZE ...]
+
+Sizes are numbers of relays of synthetic documents (the default is
+about the size of the current network); a path to a details.json
+measures that document instead.  Objects shared between relays, such
+as interned strings, are counted once.
+"""
+
+import json
+import os
+import sys
+import compass
+from testing import generate
+
+def deep_size(obj, seen):
+  """
+  Return the size in bytes of obj and everything it references that is
+  not in seen, adding what it counts to seen.
+  """
+  size = 0
+  pending = [obj]
+  while pending:
+    obj = pending.pop()
+    if id(obj) in seen:
+      continue
+    seen.add(id(obj))
+    size += sys.getsizeof(obj)
+    if isinstance(obj, dict):
+      pending.extend(obj.iterkeys())
+      pending.extend(obj.itervalues())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+      pending.extend(obj)
+    elif isinstance(obj, compass.Relay):
+      pending.extend(value for _, value in obj.iteritems())
+  return size
+
+def measure(name, document):
+  relays = document['relays']
+  before = deep_size(relays, set())
+  after = deep_size(compass.Relay.project(relays), set())
+  print "%-16s %7d relays: %6d bytes/relay as parsed, %5d as Relay (%.1fx smaller)" % (
+    name, len(relays), before // len(relays), after // len(relays), float(before) / after)
+
+if __name__ == "__main__":
+  for arg in sys.argv[1:] or ["7000"]:
+    if os.path.exists(arg):
+      measure(os.path.basename(arg), json.load(open(arg)))
+    else:
+      # Round trip through JSON to get the strings json.load returns.
+      measure("generated", json.loads(json.dumps(generate.document(int(arg)))))
@@ -0,0 +1,822 @@
+import csv
+import os
+import gzip
+import json
+import shutil
+import StringIO
+import tempfile
+import threading
+import time
+import unittest
+import urllib2
+import zlib
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+import compass
+import util
+from app import Opt
+from testing import generate
+from testing.benchmark import option_matrix
+
+class SnapshotTestCase(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.datafile = os.path.join(self.tmpdir, "details.json")
+    shutil.copy("testing/testdata.json", self.datafile)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_snapshot_is_shared(self):
+    first = compass.get_snapshot(self.datafile)
+    second = compass.get_snapshot(self.datafile)
+    self.assertTrue(first is second)
+    self.assertEqual(len(first.relays), 10)
+
+  def test_snapshot_reloaded_on_change(self):
+    first = compass.get_snapshot(self.datafile)
+    document = json.load(open(self.datafile))
+    document['relays'] = document['relays'][:3]
+    json.dump(document, open(self.datafile, "w"))
+    os.utime(self.datafile, (0, 0))
+    second = compass.get_snapshot(self.datafile)
+    self.assertFalse(first is second)
+    self.assertNotEqual(first.version, second.version)
+    self.assertEqual(len(second.relays), 3)
+
+  def test_broken_datafile_keeps_snapshot(self):
+    first = compass.get_snapshot(self.datafile)
+    open(self.datafile, "w").write('{"relays": [')
+    self.assertTrue(compass.get_snapshot(self.datafile) is first)
+
+class SnapshotCacheTestCase(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.datafile = os.path.join(self.tmpdir, "details.json")
+    generate.write_document(200, self.datafile, seed=3)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_cached_snapshot(self):
+    parsed = compass.RelaySnapshot.load(self.datafile, cache=True)
+    self.assertTrue(os.path.exists(self.datafile + ".cache"))
+    cached = compass.RelaySnapshot.load(self.datafile, cache=True)
+    self.assertTrue(cached._cache is not None)
+    self.assertEqual(cached.relays, parsed.relays)
+    self.assertEqual(cached.relays_published, parsed.relays_published)
+    self.assertEqual(cached.version, parsed.version)
+    self.assertEqual(cached.index.state(), parsed.index.state())
+    self.assertEqual(cached.family_graph.state(), parsed.family_graph.state())
+
+  def test_stale_cache_is_replaced(self):
+    compass.RelaySnapshot.load(self.datafile, cache=True)
+    generate.write_document(100, self.datafile, seed=4)
+    snapshot = compass.RelaySnapshot.load(self.datafile, cache=True)
+    self.assertTrue(snapshot._cache is None)
+    self.assertEqual(len(snapshot.relays), 100)
+    snapshot = compass.RelaySnapshot.load(self.datafile, cache=True)
+    self.assertTrue(snapshot._cache is not None)
+    self.assertEqual(len(snapshot.relays), 100)
+
+  def test_shared_snapshot(self):
+    parsed = compass.RelaySnapshot.load(self.datafile)
+    shared = compass.RelaySnapshot.load(self.datafile, shared=True)
+    self.assertTrue(isinstance(shared.relays, compass.RelayRecords))
+    self.assertEqual(len(shared.relays), 200)
+    self.assertEqual(shared.relays[-1], parsed.relays[-1])
+    self.assertEqual(list(shared.relays), parsed.relays)
+    self.assertRaises(IndexError, shared.relays.__getitem__, 200)
+    for args in option_matrix():
+      self.assertEqual(engine_output(shared, args, "dict"), engine_output(parsed, args, "dict"),
+                       "Shared snapshot differs for %s" % " ".join(args))
+
+  @unittest.skipIf(compass.numpy is None, "NumPy is not installed")
+  def test_shared_table(self):
+    parsed = compass.RelaySnapshot.load(self.datafile)
+    shared = compass.RelaySnapshot.load(self.datafile, shared=True)
+    self.assertFalse(shared.table.flags.flags.writeable)
+    self.assertTrue((shared.table.flags == parsed.table.flags).all())
+    for args in option_matrix() + [["-C", "-A"], ["-f", parsed.relays[0]['fingerprint']]]:
+      self.assertEqual(engine_output(shared, args, "numpy"), engine_output(parsed, args, "dict"),
+                       "Shared snapshot differs for %s" % " ".join(args))
+
+  def test_broken_cache_is_ignored(self):
+    compass.RelaySnapshot.load(self.datafile, cache=True)
+    data = open(self.datafile + ".cache", "rb").read()
+    open(self.datafile + ".cache", "wb").write(data[:len(data) // 2])
+    snapshot = compass.RelaySnapshot.load(self.datafile, cache=True)
+    self.assertEqual(len(snapshot.relays), 200)
+
+class DetailsHandler(BaseHTTPRequestHandler):
+  """
+  Serve server.body like Onionoo: gzipped if asked for, with an ETag,
+  and answering matching conditional requests with a 304.
+  """
+  def do_GET(self):
+    self.server.requests.append((self.path, self.headers))
+    body = self.server.body
+    if body is None:
+      self.send_response(500)
+      self.end_headers()
+      return
+    etag = '"%x"' % zlib.crc32(body)
+    if self.headers.get('If-None-Match') == etag:
+      self.send_response(304)
+      self.end_headers()
+      return
+    self.send_response(200)
+    self.send_header('ETag', etag)
+    self.send_header('Last-Modified', 'Fri, 16 Nov 2012 21:00:00 GMT')
+    if self.server.broken_gzip:
+      self.send_header('Content-Encoding', 'gzip')
+    elif 'gzip' in self.headers.get('Accept-Encoding', ''):
+      buf = StringIO.StringIO()
+      gzip_file = gzip.GzipFile(fileobj=buf, mode='wb')
+      gzip_file.write(body)
+      gzip_file.close()
+      body = buf.getvalue()
+      self.send_header('Content-Encoding', 'gzip')
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+class DetailsServerTestCase(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.datafile = os.path.join(self.tmpdir, "details.json")
+    shutil.copy("testing/testdata.json", self.datafile)
+    document = json.load(open(self.datafile))
+    document['relays'] = document['relays'][:3]
+    self.server = HTTPServer(("127.0.0.1", 0), DetailsHandler)
+    self.server.body = json.dumps(document)
+    self.server.requests = []
+    self.server.broken_gzip = False
+    threading.Thread(target=self.server.serve_forever).start()
+    self.url = "http://127.0.0.1:%d/details?type=relay" % self.server.server_port
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.tmpdir)
+
+class DownloadTestCase(DetailsServerTestCase):
+  def test_conditional_compressed_download(self):
+    self.assertTrue(compass.download_details_file(self.url, self.datafile))
+    self.assertEqual(open(self.datafile).read(), self.server.body)
+    path, headers = self.server.requests[-1]
+    self.assertEqual(headers.get('Accept-Encoding'), 'gzip')
+    self.assertEqual(headers.get('If-None-Match'), None)
+
+    self.assertFalse(compass.download_details_file(self.url, self.datafile))
+    path, headers = self.server.requests[-1]
+    self.assertEqual(headers.get('If-Modified-Since'), 'Fri, 16 Nov 2012 21:00:00 GMT')
+    self.assertEqual(headers.get('If-None-Match'), '"%x"' % zlib.crc32(self.server.body))
+
+    self.server.body = '{"relays": []}'
+    self.assertTrue(compass.download_details_file(self.url, self.datafile))
+    self.assertEqual(open(self.datafile).read(), self.server.body)
+    self.assertEqual(sorted(os.listdir(self.tmpdir)), ["details.json", "details.json.meta"])
+
+  def test_fields(self):
+    compass.download_details_file(self.url, self.datafile, fields=["nickname", "flags"])
+    self.assertEqual(self.server.requests[-1][0], "/details?type=relay&fields=nickname,flags")
+    # A download of other fields is not conditional on this one.
+    compass.download_details_file(self.url, self.datafile)
+    self.assertEqual(self.server.requests[-1][1].get('If-None-Match'), None)
+
+  def test_broken_response(self):
+    self.server.broken_gzip = True
+    self.assertRaises(IOError, compass.download_details_file, self.url, self.datafile)
+    self.assertEqual(os.listdir(self.tmpdir), ["details.json"])
+
+  def test_changed_datafile_is_downloaded(self):
+    compass.download_details_file(self.url, self.datafile)
+    open(self.datafile, "a").write(" ")
+    self.assertTrue(compass.download_details_file(self.url, self.datafile))
+
+class RefresherTestCase(DetailsServerTestCase):
+  def setUp(self):
+    DetailsServerTestCase.setUp(self)
+    self.refresher = compass.SnapshotRefresher(self.datafile, self.url, interval=0.05)
+
+  def tearDown(self):
+    self.refresher.stop()
+    DetailsServerTestCase.tearDown(self)
+
+  def test_refresh_swaps_snapshot(self):
+    first = compass.get_snapshot(self.datafile)
+    snapshot = self.refresher.refresh()
+    self.assertTrue(compass.get_snapshot(self.datafile) is snapshot)
+    self.assertNotEqual(snapshot.version, first.version)
+    self.assertEqual(len(snapshot.relays), 3)
+    self.assertTrue(snapshot._index is not None)
+    self.assertEqual(len(self.refresher.changes.left), len(first.relays) - 3)
+    self.assertEqual(self.refresher.refresh(), None)
+    self.assertTrue(compass.get_snapshot(self.datafile) is snapshot)
+    self.assertEqual(sorted(os.listdir(self.tmpdir)), ["details.json", "details.json.meta"])
+
+  def test_shared_refresh(self):
+    refresher = compass.SnapshotRefresher(self.datafile, self.url, shared=True)
+    snapshot = refresher.refresh()
+    self.assertTrue(isinstance(snapshot.relays, compass.RelayRecords))
+    self.assertTrue(compass.get_snapshot(self.datafile, shared=True) is snapshot)
+    self.assertTrue(compass.RelaySnapshot.load(self.datafile, shared=True)._cache is not None)
+
+  def test_failed_refresh_keeps_snapshot(self):
+    first = compass.get_snapshot(self.datafile)
+    self.server.body = None
+    self.assertRaises(urllib2.HTTPError, self.refresher.refresh)
+    self.server.body = '{"relays": ['
+    self.assertRaises(ValueError, self.refresher.refresh)
+    self.assertTrue(compass.get_snapshot(self.datafile) is first)
+    self.assertEqual(os.listdir(self.tmpdir), ["details.json"])
+
+  def test_background_refresh(self):
+    compass.get_snapshot(self.datafile)
+    self.refresher.start()
+    for _ in xrange(100):
+      if len(compass.get_snapshot(self.datafile).relays) == 3:
+        break
+      time.sleep(0.05)
+    self.assertEqual(len(compass.get_snapshot(self.datafile).relays), 3)
+
+  def test_background_refresh_survives_broken_response(self):
+    self.server.broken_gzip = True
+    self.refresher.start()
+    for _ in xrange(100):
+      if len(self.server.requests) >= 2:
+        break
+      time.sleep(0.05)
+    self.assertTrue(len(self.server.requests) >= 2)
+    self.assertTrue(self.refresher.is_alive())
+
+class ExitPolicyTestCase(unittest.TestCase):
+  def test_port_ranges_are_merged(self):
+    self.assertEqual(compass.port_ranges(["443", "80", "81-90", "1-79", "100"]),
+                     ((1, 90), (100, 100), (443, 443)))
+
+  def test_accept_policy(self):
+    policy = compass.ExitPolicy.from_summary({"accept": ["20-23", "80-81", "443"]})
+    self.assertTrue(policy.allows_all(compass.port_ranges(["80", "443"])))
+    self.assertFalse(policy.allows_all(compass.port_ranges(["80", "443", "554"])))
+
+  def test_reject_policy(self):
+    policy = compass.ExitPolicy.from_summary({"reject": ["1-65535"]})
+    self.assertFalse(policy.allows_all(compass.port_ranges(["80"])))
+    policy = compass.ExitPolicy.from_summary({"reject": ["25", "119", "135-139"]})
+    self.assertTrue(policy.allows_all(compass.port_ranges(["80", "443", "554", "1755"])))
+    self.assertFalse(policy.allows_all(compass.port_ranges(["80", "137"])))
+
+  def test_missing_summary(self):
+    self.assertEqual(compass.ExitPolicy.from_summary({}), None)
+
+class ResultCacheTestCase(unittest.TestCase):
+  def test_lru_eviction(self):
+    cache = util.ResultCache(max_entries=2, max_bytes=10)
+    cache.put("v1", "a", "aaaa")
+    cache.put("v1", "b", "bbbb")
+    self.assertEqual(cache.get("v1", "a"), "aaaa")
+    cache.put("v1", "c", "cccc")
+    self.assertEqual(cache.get("v1", "b"), None)
+    self.assertEqual(cache.get("v1", "a"), "aaaa")
+    cache.put("v1", "d", "dddddddd")
+    self.assertEqual(cache.stats()['entries'], 1)
+    self.assertEqual(cache.stats()['bytes'], 8)
+    self.assertEqual(cache.stats()['evictions'], 3)
+    cache.put("v1", "e", "e" * 11)
+    self.assertEqual(cache.get("v1", "e"), None)
+
+  def test_versions_are_kept_apart(self):
+    cache = util.ResultCache(max_entries=3)
+    cache.put("v1", "a", "aaaa")
+    self.assertEqual(cache.get("v2", "a"), None)
+    cache.put("v2", "a", "AAAA")
+    # A request still holding the old snapshot does not drop the new
+    # version's entries.
+    cache.put("v1", "b", "bbbb")
+    self.assertEqual(cache.get("v2", "a"), "AAAA")
+    self.assertEqual(cache.get("v1", "a"), "aaaa")
+    cache.put("v2", "b", "BBBB")
+    cache.put("v2", "c", "CCCC")
+    self.assertEqual(cache.get("v1", "b"), None)
+    self.assertEqual(cache.get("v2", "b"), "BBBB")
+
+def network_relay(fingerprint, or_addresses, exit_probability):
+  return {'fingerprint': fingerprint * 40, 'nickname': fingerprint, 'flags': ['Exit'],
+          'or_addresses': or_addresses, 'exit_probability': exit_probability}
+
+class SameNetworkFilterTestCase(unittest.TestCase):
+  class AcceptAll(compass.BaseFilter):
+    def accept(self, relay):
+      return True
+
+  def kept(self, relays, **options):
+    network_filter = compass.SameNetworkFilter(self.AcceptAll(), **options)
+    return "".join(relay.nickname for relay in network_filter.load(compass.Relay.project(relays)))
+
+  def test_highest_exit_probabilities_are_kept(self):
+    relays = [network_relay('A', ['1.2.3.4:9001'], 0.1), network_relay('B', ['1.2.3.5:9001'], 0.3),
+              network_relay('C', ['1.2.3.6:443'], 0.1), network_relay('D', ['1.2.3.7:443'], 0.2),
+              network_relay('E', ['1.2.4.1:443'], 0.0), network_relay('F', ['[::1]:443'], 0.5)]
+    self.assertEqual(self.kept(relays), "BDE")
+    # D displaces the first of A and C.
+    self.assertEqual(self.kept(relays, max_per_network=3), "BCDE")
+    self.assertEqual(self.kept(relays, ipv4_prefix=16), "BD")
+    self.assertEqual(self.kept(relays, ipv4_prefix=23, max_per_network=1), "BE")
+    self.assertEqual(self.kept(relays, ipv6_prefix=48), "BDEF")
+
+  def test_ipv6_networks(self):
+    relays = [network_relay('A', ['[2001:db8:1:2::1]:443'], 0.1),
+              network_relay('B', ['[2001:db8:1:3::1]:443'], 0.2),
+              network_relay('C', ['[2001:db8:2::1]:443'], 0.3)]
+    self.assertEqual(self.kept(relays, ipv6_prefix=48, max_per_network=1), "BC")
+    self.assertEqual(self.kept(relays, ipv6_prefix=32, max_per_network=1), "C")
+    self.assertEqual(self.kept(relays, ipv6_prefix=64, max_per_network=1), "ABC")
+
+  def test_multiple_addresses(self):
+    relays = [network_relay('A', ['1.2.3.4:9001', '5.6.7.8:9001', '1.2.3.9:443'], 0.2),
+              network_relay('B', ['5.6.7.9:9001'], 0.3), network_relay('C', ['1.2.3.5:443'], 0.1)]
+    self.assertEqual(self.kept(relays, max_per_network=2), "ABC")
+    # A gives way to B in 5.6.7.0/24, so it is dropped although it is
+    # the first choice in 1.2.3.0/24, where C takes its place.
+    self.assertEqual(self.kept(relays, max_per_network=1), "BC")
+
+  def test_network_of_or_address(self):
+    self.assertEqual(compass.or_address_network('1.2.3.4:9001'), '1.2.3.0/24')
+    self.assertEqual(compass.or_address_network('1.2.255.4:9001', 20), '1.2.240.0/20')
+    self.assertEqual(compass.or_address_network('[2001:db8:1234::1]:443'), None)
+    self.assertEqual(compass.or_address_network('[2001:db8:1234::1]:443', ipv6_prefix=32),
+                     '2001:db8::/32')
+
+def family_relay(fingerprint, family, named=None, cw=0.1):
+  return {'fingerprint': fingerprint * 40, 'nickname': named or 'Unnamed',
+          'flags': ['Named'] if named else [], 'family': family,
+          'consensus_weight_fraction': cw}
+
+class FamilyGraphTestCase(unittest.TestCase):
+  def setUp(self):
+    self.relays = compass.Relay.project([family_relay('A', ['$' + 'B' * 40], named='alpha'),
+                                         family_relay('B', ['alpha', '$' + 'D' * 40]),
+                                         family_relay('C', ['$' + 'A' * 40]),
+                                         family_relay('D', ['$' + 'B' * 40], cw=0.3),
+                                         family_relay('E', [])])
+    self.graph = compass.FamilyGraph(self.relays)
+
+  def test_members_are_mutually_listed(self):
+    a, b, c, d, e = self.relays
+    self.assertEqual(self.graph.members('A' * 40), [a, b])
+    self.assertEqual(self.graph.members('alpha'), [a, b])
+    self.assertEqual(self.graph.members('B' * 40), [a, b, d])
+    self.assertEqual(self.graph.members('C' * 40), [c])
+    self.assertEqual(self.graph.members('Unnamed'), [])
+
+  def test_families_are_connected_components(self):
+    a, b, c, d, e = self.relays
+    self.assertEqual(self.graph.families(), [[a, b, d]])
+    self.assertAlmostEqual(compass.family_weight([a, b, d]), 0.5)
+
+class RelayIndexTestCase(unittest.TestCase):
+  def setUp(self):
+    self.snapshot = compass.get_snapshot("testing/testdata.json")
+
+  def assertLookupMatchesAccept(self, f):
+    expected = set(row for row, relay in enumerate(self.snapshot.relays) if f.accept(relay))
+    self.assertEqual(list(f.lookup(self.snapshot)), sorted(expected))
+
+  def test_lookups_match_accept(self):
+    self.assertLookupMatchesAccept(compass.RunningFilter())
+    self.assertLookupMatchesAccept(compass.CountryFilter(["DE", "us", "xx"]))
+    self.assertLookupMatchesAccept(compass.ASFilter(["24940", "AS7922"]))
+    self.assertLookupMatchesAccept(compass.ExitFilter())
+    self.assertLookupMatchesAccept(compass.GuardFilter())
+    self.assertLookupMatchesAccept(compass.FamilyFilter("darwinfish", self.snapshot))
+
+class SortAndReduceTestCase(unittest.TestCase):
+  def results(self, weights):
+    results = []
+    for i, cw in enumerate(weights):
+      result = util.Result(zero_probs=True)
+      result.nick = "relay%d" % i
+      result.cw = cw
+      results.append(result)
+    return results
+
+  def test_top_keeps_tie_order(self):
+    stats = compass.RelayStats(Opt({}), snapshot=compass.get_snapshot("testing/testdata.json"))
+    for reverse in ("true", "false"):
+      options = Opt({'top': '3', 'sort_reverse': reverse})
+      results = self.results([1.0, 3.0, 2.0, 3.0, 1.0, 2.0])
+      expected = sorted(results, key=lambda r: r.cw, reverse=options.sort_reverse)
+      selection = stats.sort_and_reduce(results, options)
+      self.assertEqual(selection['results'], expected[:3])
+      self.assertEqual([r.index for r in selection['results']], [1, 2, 3])
+      self.assertEqual(selection['excluded'].cw, sum(r.cw for r in expected[3:]))
+      self.assertEqual(selection['excluded'].nick, "(3 other relays)")
+      self.assertEqual(selection['total'].cw, 12.0)
+
+  def test_sums_in_sorted_order(self):
+    stats = compass.RelayStats(Opt({}), snapshot=compass.get_snapshot("testing/testdata.json"))
+    results = self.results([0.1, 0.2, 0.3, 0.05])
+    selection = stats.sort_and_reduce(results, Opt({'top': '1'}))
+    self.assertEqual(selection['total'].cw, 0.3 + 0.2 + 0.1 + 0.05)
+    self.assertEqual(selection['excluded'].cw, 0.2 + 0.1 + 0.05)
+    self.assertNotEqual(selection['total'].cw, 0.1 + 0.2 + 0.3 + 0.05)
+
+  def test_options_not_modified(self):
+    stats = compass.RelayStats(Opt({}), snapshot=compass.get_snapshot("testing/testdata.json"))
+    options = Opt({'top': '-1'})
+    selection = stats.sort_and_reduce(self.results([1.0, 2.0]), options)
+    self.assertEqual(len(selection['results']), 2)
+    self.assertEqual(options.top, -1)
+
+class QueryTestCase(unittest.TestCase):
+  def test_equivalent_queries(self):
+    first = Opt({'country': '["DE", "us"]', 'ases': '12,AS3'}).query()
+    second = Opt({'country': '["us", "de", "de"]', 'ases': 'AS3,AS12'}).query()
+    self.assertEqual(first, second)
+    self.assertEqual(hash(first), hash(second))
+    self.assertEqual(first.country, ('de', 'us'))
+    self.assertEqual(first.ases, ('AS12', 'AS3'))
+    self.assertNotEqual(first, Opt({'country': '["de"]'}).query())
+
+  def test_single_as(self):
+    self.assertEqual(compass.Query.from_dict({'ases': 'AS7922'}).ases, ('AS7922',))
+    self.assertEqual(compass.Query.from_dict({'ases': '7922'}).ases, ('AS7922',))
+
+  def test_from_options(self):
+    options = compass.create_option_parser().parse_args(["-c", "DE", "-t", "-5"])[0]
+    query = compass.Query.from_options(options)
+    self.assertEqual(query.country, ('de',))
+    self.assertEqual(query.top, -1)
+    self.assertTrue(compass.Query.from_options(query) is query)
+    self.assertRaises(AttributeError, setattr, query, 'top', 3)
+
+  def test_group_keys(self):
+    query = Opt({'by': 'flags,Country', 'by_as': 'true'}).query()
+    self.assertEqual(query.by, ('country', 'as', 'flags'))
+    self.assertTrue(query.by_country and query.by_as)
+    self.assertEqual(query, Opt({'by_country': 'true', 'by': 'as,flags'}).query())
+    options = compass.create_option_parser().parse_args(["--by", "network24", "--by", "as"])[0]
+    self.assertEqual(compass.Query.from_options(options).by, ('as', 'network24'))
+    self.assertRaises(ValueError, Opt({'by': 'nickname'}).query)
+
+class GroupByTestCase(unittest.TestCase):
+  def setUp(self):
+    self.snapshot = compass.RelaySnapshot(generate.document(500, seed=4))
+
+  def groups(self, by):
+    options = Opt({'by': by, 'inactive': 'true', 'top': '-1'})
+    stats = compass.RelayStats(options, snapshot=self.snapshot)
+    return dict((result.nick, result) for result in stats.select_relays(stats.relays, options))
+
+  def test_network_groups(self):
+    expected = {}
+    for relay in self.snapshot.relays:
+      expected.setdefault(compass.first_ipv4_network(relay, 24), []).append(relay)
+    groups = self.groups('network24')
+    self.assertEqual(len(groups), len(expected))
+    for network, relays in expected.iteritems():
+      result = groups[network]
+      self.assertEqual(result.fp, "(%d relays)" % len(relays))
+      exits = [r for r in relays if 'Exit' in r.flags and 'BadExit' not in r.flags]
+      self.assertEqual(result.exit, "(%d)" % len(exits))
+      self.assertAlmostEqual(result.cw, 100.0 * compass.family_weight(relays))
+
+  def test_family_groups(self):
+    groups = self.groups('family')
+    families = self.snapshot.family_graph.families()
+    self.assertEqual(len(groups), len(self.snapshot.relays) -
+                     sum(len(family) - 1 for family in families))
+    for family in families:
+      self.assertEqual(groups[family[0].fingerprint].fp, "(%d relays)" % len(family))
+
+  def test_parse_platform(self):
+    self.assertEqual(compass.parse_platform("Tor 0.2.3.25 on Windows 7"), ("0.2.3.25", "Windows 7"))
+    self.assertEqual(compass.parse_platform("Tor 0.2.2.39 (git-bec76476efb71549) on Linux x86_64"),
+                     ("0.2.2.39", "Linux x86_64"))
+    self.assertEqual(compass.parse_platform("Tor 0.2.4.5-alpha"), ("0.2.4.5-alpha", None))
+    self.assertEqual(compass.parse_platform(None), (None, None))
+
+class BatchTestCase(unittest.TestCase):
+  def setUp(self):
+    self.snapshot = compass.RelaySnapshot(generate.document(500, seed=7))
+    self.queries = [compass.Query.from_dict(values) for values in [
+      {'country': ['de']}, {'country': ['de'], 'by_as': True, 'top': 3},
+      {'country': ['DE'], 'exits_only': True}, {'exit_filter': 'fast_exits_only'},
+      {'exit_filter': 'fast_exits_only', 'by': 'network16', 'sort': 'p_exit'}, {}]]
+
+  def test_batch_matches_single_queries(self):
+    expected = [compass.run_query(query, self.snapshot) for query in self.queries]
+    self.assertEqual(compass.run_queries(self.queries, self.snapshot), expected)
+    self.assertEqual(compass.run_queries(self.queries, self.snapshot, processes=2), expected)
+
+  def test_filters_are_shared(self):
+    memo = {}
+    for query in self.queries:
+      compass.run_query(query, self.snapshot, memo=memo)
+    selections = [key for key in memo if key[0] == 'relays']
+    self.assertEqual(len(selections), 4)
+    self.assertEqual(len([key for key in memo if key == ('lookup', ('CountryFilter', ('de',)))]), 1)
+
+  def test_invalid_queries(self):
+    for values in [[], {'country': ['de'], 'colour': 'red'}, {'top': 'ten'}, {'ases': 3},
+                   {'ipv4_prefix': 33}, {'ipv6_prefix': -1}, {'family': 5}, {'sort': 'bogus'},
+                   {'exit_filter': 'nope'}, {'sort_reverse': 'false'}, {'links': 'x'},
+                   {'by_as': 1}, {'ases': [7922]}, {'ases': {'AS7922': True}},
+                   {'country': 5}, {'country': [5]}, {'by': ['as', 5]}, {'top': [1]}]:
+      self.assertRaises(ValueError, compass.Query.from_dict, values)
+
+class StreamTestCase(unittest.TestCase):
+  def setUp(self):
+    self.snapshot = compass.RelaySnapshot(generate.document(300, seed=3))
+
+  def test_streams_match_json(self):
+    for values in [{'top': 5}, {'top': -1, 'by_country': True}, {'country': ['de'], 'top': 1000}]:
+      query = compass.Query.from_dict(values)
+      expected = json.loads(compass.run_query(query, self.snapshot))
+      lines = list(compass.stream_query(query, self.snapshot, 'ndjson'))
+      summary = dict((key, None) for key in ('excluded', 'total'))
+      results = []
+      for line in lines:
+        self.assertTrue(line.endswith("\n"))
+        row = json.loads(line)
+        if len(row) == 1:
+          summary.update(row)
+        else:
+          results.append(row)
+      self.assertEqual(results, expected['results'])
+      self.assertEqual(summary['excluded'], expected['excluded'])
+      self.assertEqual(summary['total'], expected['total'])
+
+      rows = list(csv.reader(compass.stream_query(query, self.snapshot, 'csv')))
+      self.assertEqual(tuple(rows[0]), util.CSV_HEADER)
+      self.assertEqual([row[0] for row in rows[1:]],
+                       ['result'] * len(results) + [key for key in ('excluded', 'total')
+                                                    if expected[key] is not None])
+      self.assertEqual([row[8] for row in rows[1:len(results) + 1]],
+                       [result['fp'] for result in results])
+
+class PageTestCase(unittest.TestCase):
+  def setUp(self):
+    self.snapshot = compass.RelaySnapshot(generate.document(300, seed=3))
+
+  def test_pages_match_top(self):
+    for values in [{}, {'by_country': True, 'sort': 'p_exit'}, {'sort': 'nick', 'sort_reverse': False}]:
+      query = compass.Query.from_dict(dict(values, top=-1))
+      everything = json.loads(compass.run_query(query, self.snapshot))['results']
+      page = json.loads(compass.page_query(query, self.snapshot, 0, 7))
+      self.assertEqual(page['results'], everything[:7])
+      self.assertEqual(page['count'], len(everything))
+      self.assertEqual(page['total'], json.loads(compass.run_query(query, self.snapshot))['total'])
+      self.assertAlmostEqual(page['excluded']['cw'], sum(r['cw'] for r in everything[7:]))
+      results = page['results']
+      while page['next']:
+        next_query, offset, limit = compass.decode_cursor(page['next'], self.snapshot)
+        self.assertEqual((next_query, offset, limit), (query, len(results), 7))
+        page = json.loads(compass.page_query(next_query, self.snapshot, offset, limit))
+        results.extend(page['results'])
+      self.assertEqual(results, everything)
+
+  def test_orderings_are_cached(self):
+    query = compass.Query.from_dict({})
+    compass.page_query(query, self.snapshot, 0, 10)
+    timings = util.Timings()
+    compass.page_query(query, self.snapshot, 10, 10, timings=timings)
+    self.assertEqual([stage.name for stage in timings.stages], ['page', 'encode'])
+
+  def test_invalid_pages(self):
+    query = compass.Query.from_dict({})
+    for offset, limit in [(-1, 10), (0, 0), (None, 10)]:
+      self.assertRaises(ValueError, compass.page_query, query, self.snapshot, offset, limit)
+    cursor = compass.encode_cursor(self.snapshot, query, 10, 10)
+    other = compass.RelaySnapshot(generate.document(300, seed=3))
+    self.assertRaises(compass.StaleCursor, compass.decode_cursor, cursor, other)
+    for cursor in ["", "garbage", cursor[:-3], u"\u2603"]:
+      self.assertRaises(ValueError, compass.decode_cursor, cursor, self.snapshot)
+
+class GroupAggregatesTestCase(unittest.TestCase):
+  def setUp(self):
+    self.snapshot = compass.RelaySnapshot(generate.document(500, seed=5))
+
+  def regular_results(self, query, engine):
+    stats = compass.RelayStats(query, snapshot=self.snapshot, engine=engine)
+    return compass.aggregate_groups(stats._execute())
+
+  def test_matches_regular_path(self):
+    engines = compass.ENGINES if compass.numpy is not None else ["dict"]
+    for engine in engines:
+      for by in ['country', 'as']:
+        for inactive, exits_only, guards_only in compass.GroupAggregates.FLAG_OPTIONS:
+          query = compass.Query.create(by=by, inactive=inactive, exits_only=exits_only,
+                                       guards_only=guards_only, links=False)
+          stats = compass.RelayStats(query, snapshot=self.snapshot, engine=engine)
+          self.assertTrue(isinstance(stats.relays, compass.AggregatedGroups))
+          self.assertEqual(stats.relays, self.regular_results(query, engine))
+      self.assertTrue(self.snapshot.group_aggregates(engine) is
+                      self.snapshot.group_aggregates(engine))
+
+  def test_only_flag_queries(self):
+    key = compass.GroupAggregates.key
+    self.assertEqual(key(compass.Query.create(by_as=True, exits_only=True)),
+                     (('as',), False, True, False))
+    for values in [{}, {'by': 'network24'}, {'by_country': True, 'by_as': True},
+                   {'by_country': True, 'country': 'de'}, {'by_as': True, 'ases': ['3']},
+                   {'by_as': True, 'exit_filter': 'fast_exits_only'}]:
+      self.assertEqual(key(compass.Query.create(**values)), None)
+
+class UpdateTestCase(unittest.TestCase):
+  STRUCTURES = ['index', 'exit_policies', 'family_graph', 'aggregates']
+
+  def setUp(self):
+    self.document = json.loads(json.dumps(generate.document(400, seed=11)))
+    self.snapshot = compass.RelaySnapshot(self.document)
+    self.snapshot.build(self.STRUCTURES)
+
+  def next_document(self):
+    relays = [dict(relay) for relay in self.document['relays']]
+    self.left = [relays.pop(row)['fingerprint'] for row in xrange(360, 0, -30)]
+    for relay in relays[5::37][:10]:
+      relay['consensus_weight_fraction'] = relay.get('consensus_weight_fraction', 0) + 0.01
+      relay['country'] = 'zz'
+      relay.pop('family', None)
+    self.changed = [relay['fingerprint'] for relay in relays[5::37][:10]]
+    joined = json.loads(json.dumps(generate.document(5, seed=12)))['relays']
+    self.joined = [relay['fingerprint'] for relay in joined]
+    for i, relay in enumerate(joined):
+      relays.insert(1 + 70 * i, relay)
+    return {'relays': relays}
+
+  def assertMatchesLoad(self, updated, document):
+    loaded = compass.RelaySnapshot(document)
+    self.assertEqual(updated.relays, loaded.relays)
+    for by in compass.GroupAggregates.GROUP_KEYS:
+      for flags in compass.GroupAggregates.FLAG_OPTIONS:
+        key = (by,) + flags
+        self.assertEqual(updated.group_aggregates().get(key), loaded.group_aggregates().get(key))
+    engines = ["dict"] if compass.numpy is None else ["dict", "numpy"]
+    fingerprint = document['relays'][3]['fingerprint']
+    for args in option_matrix() + [["-A", "-t", "-1"], ["-C", "-i"], ["-f", fingerprint]]:
+      for engine in engines:
+        self.assertEqual(engine_output(updated, args, engine), engine_output(loaded, args, engine))
+    return loaded
+
+  def test_update_matches_load(self):
+    document = self.next_document()
+    updated, _ = self.snapshot.update(document)
+    self.assertTrue(updated.relays[0] is self.snapshot.relays[0])
+    self.assertNotEqual(updated._index, None)
+    self.assertNotEqual(updated._family_graph, None)
+    state = (updated._index.state(), updated._family_graph.state(),
+             sorted(updated._exit_policies))
+    loaded = self.assertMatchesLoad(updated, document)
+    self.assertEqual(state, (loaded.index.state(), loaded.family_graph.state(),
+                             sorted(loaded.exit_policies)))
+
+  def test_reordered_document_rebuilds(self):
+    document = {'relays': self.document['relays'][::-1]}
+    updated, changes = self.snapshot.update(document)
+    self.assertEqual(changes.summary(), "0 relays joined, 0 left, 0 changed")
+    self.assertEqual(updated._index, None)
+    self.assertMatchesLoad(updated, document)
+
+  def test_changes(self):
+    updated, changes = self.snapshot.update(self.next_document())
+    self.assertEqual(sorted(changes.joined), sorted(self.joined))
+    self.assertEqual(sorted(changes.left), sorted(self.left))
+    self.assertEqual(sorted(changes.changed), sorted(self.changed))
+    self.assertTrue(changes.country_weights['zz'] > 0)
+    self.assertTrue(changes.summary().startswith("5 relays joined, 12 left, 10 changed; "))
+    _, changes = updated.update({'relays': updated.relays})
+    self.assertEqual(changes.summary(), "0 relays joined, 0 left, 0 changed")
+
+  def test_high_churn_rebuilds(self):
+    document = {'relays': [dict(relay, consensus_weight_fraction=0.001)
+                           for relay in self.document['relays']]}
+    updated, changes = self.snapshot.update(document)
+    self.assertEqual(len(changes.changed), 400)
+    self.assertEqual(updated._index, None)
+
+  def test_get_snapshot_updates(self):
+    tmpdir = tempfile.mkdtemp()
+    try:
+      datafile = os.path.join(tmpdir, "details.json")
+      json.dump(self.document, open(datafile, "w"))
+      first = compass.get_snapshot(datafile)
+      json.dump(self.next_document(), open(datafile, "w"))
+      os.utime(datafile, (0, 0))
+      second = compass.get_snapshot(datafile)
+      self.assertEqual(len(second.relays), 393)
+      self.assertTrue(second.relays[0] is first.relays[0])
+    finally:
+      shutil.rmtree(tmpdir)
+
+  def test_cursors_follow_across_updates(self):
+    tmpdir = tempfile.mkdtemp()
+    try:
+      datafile = os.path.join(tmpdir, "details.json")
+      json.dump(self.document, open(datafile, "w"))
+      compass.get_snapshot(datafile)
+      json.dump(self.next_document(), open(datafile, "w"))
+      os.utime(datafile, (0, 0))
+      updated = compass.get_snapshot(datafile)
+      loaded = compass.RelaySnapshot.load(datafile)
+      self.assertEqual(updated.version, loaded.version)
+      for values in [{}, {'by_as': True}, {'by_country': True, 'sort': 'p_guard'}]:
+        query = compass.Query.from_dict(values)
+        page = json.loads(compass.page_query(query, updated, 0, 7))
+        self.assertEqual(compass.decode_cursor(page['next'], loaded), (query, 7, 7))
+        self.assertEqual(compass.page_query(query, loaded, 7, 7),
+                         compass.page_query(query, updated, 7, 7))
+    finally:
+      shutil.rmtree(tmpdir)
+
+class ReadDetailsTestCase(unittest.TestCase):
+  def read(self, text, chunk_size=7):
+    return compass.read_details(StringIO.StringIO(text), chunk_size)
+
+  def test_matches_json(self):
+    document = generate.document(30, seed=6)
+    document['relays'][0]['nickname'] = u"caf\xe9 \u2603"
+    document['bridges'] = [{'nickname': 'bridge'}]
+    document['version'] = 12345
+    text = json.dumps(document, indent=1)
+    for chunk_size in [1, 100, 4096]:
+      read = self.read(text, chunk_size)
+      self.assertEqual(read['relays'], compass.Relay.project(json.loads(text)['relays']))
+      self.assertEqual(read['relays_published'], document['relays_published'])
+      self.assertEqual(read['version'], 12345)
+      self.assertFalse('bridges' in read)
+
+  def test_empty_document(self):
+    self.assertEqual(self.read(' {} '), {})
+    self.assertEqual(self.read('{"relays": []}'), {'relays': []})
+
+  def test_broken_documents(self):
+    for text in ['{"relays": [{"nickname": "a"', '{"relays": [] "x": 1}', '[]', '{} {}', '']:
+      self.assertRaises(ValueError, self.read, text)
+
+class RelayTestCase(unittest.TestCase):
+  def test_projection(self):
+    document = generate.document(50, seed=2)
+    first, = compass.Relay.project(document['relays'][:1])
+    self.assertFalse('host_name' in first)
+    self.assertEqual(first['nickname'], document['relays'][0]['nickname'])
+    self.assertEqual(first.get('last_restarted', 'none'), 'none')
+    self.assertRaises(KeyError, first.__getitem__, 'last_restarted')
+
+  def test_values_are_shared(self):
+    relays = compass.RelaySnapshot(generate.document(500, seed=2)).relays
+    for field in ['country', 'flags', 'exit_policy_summary', 'platform', 'contact']:
+      seen = {}
+      for relay in relays:
+        value = relay.get(field)
+        key = json.dumps(value, sort_keys=True)
+        self.assertTrue(seen.setdefault(key, value) is value, field)
+
+  def test_result_json(self):
+    result = util.Result(zero_probs=True)
+    result.nick = "relay"
+    encoded = json.loads(json.dumps(result, cls=util.ResultEncoder))
+    self.assertEqual(sorted(encoded), sorted(util.Result.__slots__))
+    self.assertEqual(encoded['nick'], "relay")
+    self.assertEqual(encoded['cw'], 0.0)
+
+class GenerateTestCase(unittest.TestCase):
+  def test_generated_document(self):
+    document = generate.document(500, seed=5)
+    self.assertEqual(document, generate.document(500, seed=5))
+    relays = document['relays']
+    self.assertEqual(len(relays), 500)
+    self.assertEqual(len(set(relay['fingerprint'] for relay in relays)), 500)
+    running = [relay for relay in relays if relay['running']]
+    self.assertAlmostEqual(sum(r['consensus_weight_fraction'] for r in running), 1.0, places=4)
+    self.assertTrue(compass.RelaySnapshot(document).family_graph.families())
+
+def engine_output(snapshot, args, engine):
+  options, _ = compass.create_option_parser().parse_args(args)
+  options = compass.fix_exit_filter_options(options)
+  stats = compass.RelayStats(options, snapshot=snapshot, engine=engine)
+  results = stats.select_relays(stats.relays, options)
+  return json.dumps(stats.sort_and_reduce(results, options), cls=util.ResultEncoder)
+
+@unittest.skipIf(compass.numpy is None, "NumPy is not installed")
+class EngineTestCase(unittest.TestCase):
+  def test_engines_match(self):
+    self.assertEnginesMatch(compass.get_snapshot("testing/testdata.json"))
+
+  def test_engines_match_on_generated_document(self):
+    self.assertEnginesMatch(compass.RelaySnapshot(generate.document(2000, seed=3)))
+
+  def assertEnginesMatch(self, snapshot):
+    for args in option_matrix() + [["-C", "-A"], ["-C", "-i", "-t", "-1"], ["-f", "darwinfish"],
+                                   ["--sort", "p_exit"], ["--fast-exits-only-any-network"],
+                                   ["--by", "network16,flags"], ["-C", "--by", "version", "-t", "-1"],
+                                   ["--by", "family", "-i"], ["--by", "contact"]]:
+      self.assertEqual(engine_output(snapshot, args, "dict"),
+                       engine_output(snapshot, args, "numpy"),
+                       "Engines differ for %s" % " ".join(args))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,283 @@
+#!/usr/bin/python
+"""
+Generate synthetic Onionoo details documents of arbitrary size.
+
+The documents look like the output of
+https://onionoo.torproject.org/details?type=relay and are meant for
+benchmarking compass at and beyond the size of the real network:
+
+  python -m testing.generate 50000 --seed 7 -o /tmp/details-50k.json
+
+Generation is deterministic for a given size and seed.
+"""
+
+import json
+import sys
+from optparse import OptionParser
+import random
+
+# Rough share of relays per country, the remainder is spread evenly over
+# OTHER_COUNTRIES.
+COUNTRIES = [('de', 0.19), ('us', 0.17), ('fr', 0.09), ('nl', 0.08), ('ru', 0.05),
+             ('gb', 0.04), ('se', 0.03), ('ca', 0.03), ('ch', 0.02), ('ua', 0.02),
+             ('at', 0.02), ('pl', 0.02), ('ro', 0.015), ('fi', 0.015), ('cz', 0.01)]
+OTHER_COUNTRIES = ['it', 'es', 'jp', 'br', 'au', 'no', 'dk', 'lu', 'be', 'hu', 'bg',
+                   'lv', 'lt', 'ie', 'sg', 'hk', 'in', 'il', 'za', 'ar', 'md', 'is']
+
+PLATFORMS = ['Tor 0.2.3.24-rc on Linux', 'Tor 0.2.3.25 on Linux', 'Tor 0.2.4.5-alpha on Linux',
+             'Tor 0.2.3.25 on Windows 7', 'Tor 0.2.3.25 on FreeBSD', 'Tor 0.2.2.39 on Linux',
+             'Tor 0.2.3.25 on Darwin', 'Tor 0.2.4.6-alpha on Linux', 'Tor 0.2.3.22-rc on OpenBSD']
+
+REJECT_ALL = {'reject': ['1-65535']}
+EXIT_POLICIES = [
+  (0.35, {'reject': ['25', '119', '135-139', '445', '563', '1214', '4661-4666',
+                     '6346-6429', '6699', '6881-6999']}),
+  (0.25, {'accept': ['20-23', '43', '53', '79-81', '88', '110', '143', '194', '220',
+                     '389', '443', '464-465', '531', '543-544', '554', '563', '636',
+                     '706', '749', '873', '902-904', '981', '989-995', '1194', '1220',
+                     '1293', '1500', '1533', '1677', '1723', '1755', '1863',
+                     '2082-2083', '2086-2087', '2095-2096', '2102-2104', '3128',
+                     '3389', '3690', '4321', '4643', '5050', '5190', '5222-5223',
+                     '5228', '5900', '6660-6669', '6679', '6697', '8000', '8008',
+                     '8074', '8080', '8087-8088', '8332-8333', '8443', '8888',
+                     '9418', '9999-10000', '11371', '12350', '19294', '19638',
+                     '23456', '33033', '64738']}),
+  (0.15, {'accept': ['80', '443']}),
+  (0.10, {'accept': ['1-65535']}),
+  (0.10, {'reject': ['25']}),
+  (0.05, {'accept': ['53', '80', '443', '554', '1755', '6667']}),
+]
+
+WORDS = ['tor', 'relay', 'onion', 'node', 'exit', 'guard', 'free', 'speech', 'privacy',
+         'anon', 'bunny', 'kitten', 'zebra', 'falcon', 'orbit', 'nova', 'pirate', 'ninja',
+         'mars', 'lambda', 'delta', 'echo', 'fox', 'oak', 'river', 'stone', 'cloud']
+
+def weighted_choice(rng, choices):
+  x = rng.random() * sum(weight for weight, _ in choices)
+  for weight, value in choices:
+    x -= weight
+    if x < 0:
+      return value
+  return choices[-1][1]
+
+class Generator(object):
+  def __init__(self, size, seed=1):
+    self.size = size
+    self.rng = random.Random(seed)
+    self._fingerprints = set()
+    self._prefixes = set()
+    self._build_ases()
+
+  def _country(self):
+    x = self.rng.random()
+    for country, share in COUNTRIES:
+      x -= share
+      if x < 0:
+        return country
+    return self.rng.choice(OTHER_COUNTRIES)
+
+  def _build_ases(self):
+    """
+    Create autonomous systems with a heavy-tailed popularity, each with
+    a home country and a few IPv4 /16 prefixes.
+    """
+    rng = self.rng
+    count = max(20, self.size // 6)
+    numbers = rng.sample(xrange(1, 400000), count)
+    self.ases = []
+    for i, number in enumerate(numbers):
+      prefixes = [self._prefix() for _ in xrange(rng.randint(1, 4))]
+      self.ases.append({'as_number': 'AS%d' % number,
+                        'as_name': '%s %s Networks' % (rng.choice(WORDS).title(),
+                                                       rng.choice(WORDS).title()),
+                        'country': self._country(),
+                        'prefixes': prefixes,
+                        'ipv6': '2a%02x:%x' % (rng.randint(0, 255), rng.randint(0, 0xffff))})
+    cumulative, total = [], 0.0
+    for i in xrange(count):
+      total += 1.0 / (i + 1) ** 1.1
+      cumulative.append(total)
+    self._as_weights = cumulative
+
+  def _prefix(self):
+    while True:
+      prefix = (self.rng.randint(1, 223), self.rng.randint(0, 255))
+      if prefix[0] not in (10, 127) and prefix not in self._prefixes:
+        self._prefixes.add(prefix)
+        return prefix
+
+  def _pick_as(self):
+    x = self.rng.random() * self._as_weights[-1]
+    lo, hi = 0, len(self._as_weights) - 1
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self._as_weights[mid] < x:
+        lo = mid + 1
+      else:
+        hi = mid
+    return self.ases[lo]
+
+  def _fingerprint(self):
+    while True:
+      fingerprint = '%040X' % self.rng.getrandbits(160)
+      if fingerprint not in self._fingerprints:
+        self._fingerprints.add(fingerprint)
+        return fingerprint
+
+  def _ipv4(self, autonomous_system):
+    first, second = self.rng.choice(autonomous_system['prefixes'])
+    # Concentrate relays on few /24s so that network limits matter.
+    return '%d.%d.%d.%d' % (first, second, self.rng.randint(0, 7), self.rng.randint(1, 254))
+
+  def relay(self, index):
+    rng = self.rng
+    autonomous_system = self._pick_as()
+    nickname = '%s%s%d' % (rng.choice(WORDS), rng.choice(WORDS).title(), rng.randint(0, 999))
+    nickname = nickname[:19]
+    ip = self._ipv4(autonomous_system)
+    port = rng.choice([443, 9001, 9001, 9090, 8080])
+    or_addresses = ['%s:%d' % (ip, port)]
+    if rng.random() < 0.25:
+      or_addresses.append('[%s::%x]:%d' % (autonomous_system['ipv6'], rng.getrandbits(16), port))
+    if rng.random() < 0.01:
+      or_addresses.append('%s:%d' % (self._ipv4(autonomous_system), port))
+
+    running = rng.random() < 0.85
+    stable = rng.random() < 0.7
+    fast = rng.random() < 0.9
+    exit = rng.random() < 0.15
+    flags = ['Valid']
+    if running:
+      flags.append('Running')
+    if fast:
+      flags.append('Fast')
+    if stable:
+      flags.append('Stable')
+    if stable and fast and rng.random() < 0.45:
+      flags.append('Guard')
+    if exit:
+      flags.append('Exit')
+      if rng.random() < 0.01:
+        flags.append('BadExit')
+    if rng.random() < 0.1:
+      flags.append('Named')
+    if rng.random() < 0.4:
+      flags.append('HSDir')
+    if rng.random() < 0.6:
+      flags.append('V2Dir')
+    flags.sort()
+
+    advertised = int(min(rng.lognormvariate(13.5, 1.5), 120 * 1024 * 1024))
+    rate = max(advertised, int(rng.choice([1, 1, 2, 4]) * advertised))
+    relay = {
+      'nickname': nickname,
+      'fingerprint': self._fingerprint(),
+      'or_addresses': or_addresses,
+      'dir_address': '%s:%d' % (ip, rng.choice([80, 9030])),
+      'last_restarted': '2012-11-%02d %02d:%02d:%02d' % (
+        rng.randint(1, 16), rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59)),
+      'running': running,
+      'flags': flags,
+      'host_name': 'host-%s.example.net' % ip.replace('.', '-'),
+      'consensus_weight': max(1, int(advertised / 1000 * rng.uniform(0.2, 2.0))),
+      'bandwidth_rate': rate,
+      'bandwidth_burst': rate * 2,
+      'observed_bandwidth': advertised,
+      'advertised_bandwidth': advertised,
+      'exit_policy_summary': weighted_choice(rng, EXIT_POLICIES) if exit else REJECT_ALL,
+      'exit_policy': ['reject *:*'],
+      'contact': '%s <%s AT example DOT org>' % (rng.choice(WORDS).title(), nickname.lower()),
+      'platform': rng.choice(PLATFORMS),
+    }
+    if rng.random() < 0.99:
+      if rng.random() < 0.95:
+        relay['country'] = autonomous_system['country']
+      else:
+        relay['country'] = self._country()
+      relay['latitude'] = rng.uniform(-60, 70)
+      relay['longitude'] = rng.uniform(-180, 180)
+    if rng.random() < 0.98:
+      relay['as_number'] = autonomous_system['as_number']
+      relay['as_name'] = autonomous_system['as_name']
+    return relay
+
+  def _add_families(self, relays):
+    """
+    Put about a third of the relays into families of 2 to 20 relays
+    sharing an operator.  Most declarations are mutual, some only one
+    sided.
+    """
+    rng = self.rng
+    order = range(len(relays))
+    rng.shuffle(order)
+    pos = 0
+    while pos < len(order) * 0.3:
+      size = min(20, 2 + int(rng.expovariate(0.4)))
+      members = [relays[i] for i in order[pos:pos + size]]
+      pos += size
+      contact = members[0]['contact']
+      for relay in members:
+        relay['contact'] = contact
+        family = []
+        for other in members:
+          if other is relay or rng.random() < 0.05:
+            continue
+          if 'Named' in other['flags'] and rng.random() < 0.5:
+            family.append(other['nickname'])
+          else:
+            family.append('$' + other['fingerprint'])
+        if family:
+          relay['family'] = family
+
+  def _add_fractions(self, relays):
+    """
+    Fill in the weight fractions and path selection probabilities of
+    running relays from their consensus weights.
+    """
+    running = [r for r in relays if r['running']]
+    total_cw = float(sum(r['consensus_weight'] for r in running)) or 1.0
+    total_bw = float(sum(r['advertised_bandwidth'] for r in running)) or 1.0
+    guards = [r for r in running if 'Guard' in r['flags']]
+    exits = [r for r in running if 'Exit' in r['flags'] and 'BadExit' not in r['flags']]
+    total_guard = float(sum(r['consensus_weight'] for r in guards)) or 1.0
+    total_exit = float(sum(r['consensus_weight'] for r in exits)) or 1.0
+    guard_ids = set(id(r) for r in guards)
+    exit_ids = set(id(r) for r in exits)
+    for relay in running:
+      cw = relay['consensus_weight']
+      relay['consensus_weight_fraction'] = round(cw / total_cw, 9)
+      relay['advertised_bandwidth_fraction'] = round(relay['advertised_bandwidth'] / total_bw, 9)
+      relay['guard_probability'] = round(cw / total_guard, 9) if id(relay) in guard_ids else 0.0
+      relay['exit_probability'] = round(cw / total_exit, 9) if id(relay) in exit_ids else 0.0
+      relay['middle_probability'] = 0.0 if id(relay) in exit_ids else round(cw / total_cw, 9)
+
+  def document(self):
+    relays = [self.relay(i) for i in xrange(self.size)]
+    self._add_families(relays)
+    self._add_fractions(relays)
+    return {'relays_published': '2012-11-16 21:00:00',
+            'relays': relays,
+            'bridges_published': '2012-11-16 20:37:04',
+            'bridges': []}
+
+def document(size, seed=1):
+  """
+  Return a synthetic details document with size relays.
+  """
+  return Generator(size, seed).document()
+
+def write_document(size, path, seed=1):
+  with open(path, 'w') as details_file:
+    json.dump(document(size, seed), details_file)
+
+if __name__ == "__main__":
+  parser = OptionParser(usage="%prog [options] SIZE")
+  parser.add_option("--seed", type="int", default=1, help="random seed (default: %default)")
+  parser.add_option("-o", "--output", metavar="FILE", help="write to FILE instead of stdout")
+  options, args = parser.parse_args()
+  if len(args) != 1 or not args[0].isdigit():
+    parser.error("Need the number of relays to generate.")
+  if options.output:
+    write_document(int(args[0]), options.output, options.seed)
+  else:
+    json.dump(document(int(args[0]), options.seed), sys.stdout)
@@ -4,7 +4,7 @@
 # the output to a file.
 
 if [[ $# -lt 3 ]]; then
-  echo "Usage: test.sh <compass_py_loc> <scratch_dir> <test_name>"
+  echo "Usage: test.sh <compass_py_loc> <scratch_dir> <test_name> [<datafile>]"
   exit 1
 fi
 
@@ -13,6 +13,7 @@ scratch="$2"
 [[ -f $1 ]] || echo "'$1' is not a file" || exit 1
 
 name="$3"
+datafile="${4:-details.json}"
 
 i=1
 
@@ -35,7 +36,7 @@ declare -a testcases=(
                      )
  
 for i in $(seq 0 "${#testcases[@]}"); do 
-  $bin ${testcases[$i]} > "$scratch/$name.$i"
+  $bin ${testcases[$i]} --datafile "$datafile" > "$scratch/$name.$i"
 done
 
 
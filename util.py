@@ -1,5 +1,12 @@
+import csv
 import json
 import shlex
+from cStringIO import StringIO
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 
 def JSON(val):
   try:
@@ -35,7 +42,10 @@ def Boolean(val):
 
   return False
 
-class Result():
+class Result(object):
+    __slots__ = ('index', 'cw', 'adv_bw', 'p_guard', 'p_exit', 'p_middle', 'nick', 'fp',
+                 'link', 'exit', 'guard', 'cc', 'as_no', 'as_name', 'as_info')
+
     WEIGHT_FIELDS = {
     'consensus_weight_fraction': 'cw', 
     'advertised_bandwidth_fraction': 'adv_bw',
@@ -68,7 +78,7 @@ class Result():
       setattr(self,prop,val)
 
     def jsonify(self):
-      return self.__dict__
+      return dict((field, getattr(self, field)) for field in Result.__slots__)
 
     def printable_fields(self,links=False):
       """
@@ -85,6 +95,175 @@ class Result():
 class ResultEncoder(json.JSONEncoder):
   def default(self,obj):
     if isinstance(obj,Result):
-      return obj.__dict__
+      return obj.jsonify()
     return json.JSONEncoder.default(self,obj)
 
+
+def ndjson_lines(rows):
+  """
+  Encode the (kind, Result) rows of a selection as newline delimited
+  JSON, one object per line.  Results are encoded as in the JSON
+  output, the excluded and total lines as {"excluded": {...}} and
+  {"total": {...}}.
+  """
+  for kind, result in rows:
+    if kind == 'result':
+      yield json.dumps(result.jsonify()) + "\n"
+    else:
+      yield json.dumps({kind: result.jsonify()}) + "\n"
+
+CSV_HEADER = ('row',) + Result.__slots__
+
+def _csv_value(value):
+  if isinstance(value, float):
+    return repr(value)
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  return value
+
+def csv_lines(rows):
+  """
+  Encode the (kind, Result) rows of a selection as CSV lines, after a
+  header line.  The first column tells results from the excluded and
+  total lines.
+  """
+  buf = StringIO()
+  writer = csv.writer(buf, lineterminator="\n")
+  def line(values):
+    writer.writerow(values)
+    value = buf.getvalue()
+    buf.seek(0)
+    buf.truncate()
+    return value
+  yield line(CSV_HEADER)
+  for kind, result in rows:
+    yield line([kind] + [_csv_value(getattr(result, field)) for field in Result.__slots__])
+
+STREAM_FORMATS = OrderedDict([
+  ('ndjson', (ndjson_lines, 'application/x-ndjson')),
+  ('csv', (csv_lines, 'text/csv')),
+])
+
+class Stage(object):
+    __slots__ = ('name', 'detail', 'seconds', 'rows')
+
+    def __init__(self, name, detail=None):
+        self.name = name
+        self.detail = detail
+        self.seconds = 0.0
+        self.rows = None
+
+class Timings(object):
+    """
+    Wall clock time and, where known, the number of rows produced by
+    each stage of a query, in the order the stages ran.
+    """
+    def __init__(self):
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name, detail=None):
+        stage = Stage(name, detail)
+        self.stages.append(stage)
+        start = time.time()
+        try:
+            yield stage
+        finally:
+            stage.seconds = time.time() - start
+
+    def total(self):
+        return sum(stage.seconds for stage in self.stages)
+
+    def _description(self, stage):
+        parts = []
+        if stage.detail:
+            parts.append(stage.detail)
+        if stage.rows is not None:
+            parts.append("%d rows" % stage.rows)
+        return ", ".join(parts)
+
+    def server_timing(self):
+        """
+        Format the stages as the value of a Server-Timing header.
+        """
+        metrics = []
+        for stage in self.stages:
+            metric = "%s;dur=%.3f" % (stage.name, stage.seconds * 1000.0)
+            description = self._description(stage)
+            if description:
+                metric += ';desc="%s"' % description.replace('"', "'")
+            metrics.append(metric)
+        return ", ".join(metrics)
+
+    def report(self):
+        """
+        Format the stages as a table for the command line version.
+        """
+        lines = ["%-10s %10s %8s  %s" % ("Stage", "ms", "Rows", "Detail")]
+        for stage in self.stages:
+            lines.append("%-10s %10.3f %8s  %s" % (
+                stage.name, stage.seconds * 1000.0,
+                "" if stage.rows is None else stage.rows, stage.detail or ""))
+        lines.append("%-10s %10.3f" % ("total", self.total() * 1000.0))
+        return "\n".join(lines)
+
+class ResultCache(object):
+    """
+    A thread-safe LRU cache of encoded query results, bounded both by the
+    number of entries and by their total size in bytes.  Entries belong
+    to a snapshot version and are only found for that version.  Those of
+    earlier versions are not dropped when a new one comes along, since
+    requests still holding an earlier snapshot may store results for it
+    meanwhile; they are no longer asked for and so are evicted first.
+    """
+    def __init__(self, max_entries=256, max_bytes=32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def etag(version, key):
+        """
+        Return the entity tag of the result for key under version.
+        """
+        return hashlib.sha1("%s %r" % (version, key)).hexdigest()
+
+    def get(self, version, key):
+        with self._lock:
+            body = self._entries.pop((version, key), None)
+            if body is None:
+                self.misses += 1
+                return None
+            self._entries[(version, key)] = body
+            self.hits += 1
+            return body
+
+    def put(self, version, key, body):
+        with self._lock:
+            if len(body) > self.max_bytes:
+                return
+            old = self._entries.pop((version, key), None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._entries[(version, key)] = body
+            self._bytes += len(body)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes,
+                    'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}